@@ -1,4 +1,3 @@
-import datetime
 from decimal import *
 from django.contrib import admin
 from django.core.exceptions import ValidationError
@@ -7,7 +6,9 @@ from django.forms.models import BaseInlineFormSet
 from reversion.admin import VersionAdmin
 from .models import Disbursement, Loan, Notification, PhotoSignature, RepaymentScheduleLine, Repayment, \
     ReasonForDelayedRepayment, SuperUsertoLenderPayment, LOAN_REPAID, DISBURSEMENT_SENT, DISB_METHOD_WAVE_TRANSFER, \
-    DISB_METHOD_BANK_TRANSFER, DISB_METHOD_WAVE_N_CASH_OUT, Reconciliation, DefaultPrediction
+    DISB_METHOD_BANK_TRANSFER, DISB_METHOD_WAVE_N_CASH_OUT, Reconciliation, DefaultPrediction, ScheduleUpdateRun, \
+    LoanBalance, PortfolioSnapshot, ScheduleShift
+from .schedules import ScheduleGenerator
 from borrowers.models import Borrower
 from django.forms import DateInput, NumberInput
 from django.db import models
@@ -24,21 +25,11 @@ class RepaymentScheduleLineFormset(BaseInlineFormSet):
         """
         super(RepaymentScheduleLineFormset, self).__init__(*args, **kwargs)
         if self.request.method == 'GET':
-            if kwargs['instance'] and kwargs['instance'].normal_repayment_amount is not None and kwargs['instance'].bullet_repayment_amount is not None and RepaymentScheduleLine.objects.filter(loan=kwargs['instance']).count() == 0:
-                loan = kwargs['instance']
-                self.initial = []
-                no_of_lines = Loan.get_number_of_repayments(loan.loan_amount, loan.normal_repayment_amount, loan.bullet_repayment_amount)
-
-                for line_no in range(no_of_lines):
-                    # FIXME: this should be granular to a level that makes sense per currency
-
-                    line = {'date': loan.uploaded_at + datetime.timedelta(days=line_no + 1),
-                            'principal': loan.bullet_repayment_amount if line_no == no_of_lines - 1 else loan.normal_repayment_amount,
-                            'fee': loan.loan_fee if line_no == 0 else 0,
-                            'interest': 0,
-                            'penalty': 0,
-                            }
-                    self.initial.append(line)
+            loan = kwargs['instance']
+            # the formset queryset is evaluated here, and reused to build the forms
+            if loan and loan.normal_repayment_amount is not None and loan.bullet_repayment_amount is not None and len(self.get_queryset()) == 0:
+                # FIXME: this should be granular to a level that makes sense per currency
+                self.initial = ScheduleGenerator(loan, loan.uploaded_at).initial()
 
     def clean(self):
         """
@@ -263,7 +254,17 @@ class LoanAdmin(VersionAdmin, admin.ModelAdmin):
         """show the agent in the list of loans"""
         return obj.borrower.agent
 
-    list_display = ('borrower', 'loan_agent', 'uploaded_at', 'loan_amount', 'contract_due_date', 'repaid_on', 'passed_credit')
+    def outstanding(self, obj):
+        """the outstanding from the LoanBalance table, sortable"""
+        try:
+            return obj.balance.total_outstanding
+        except LoanBalance.DoesNotExist:
+            return None
+    outstanding.admin_order_field = 'balance__total_outstanding'
+
+    list_display = ('borrower', 'loan_agent', 'uploaded_at', 'loan_amount', 'contract_due_date', 'repaid_on',
+                    'outstanding', 'passed_credit')
+    list_select_related = ('borrower__agent', 'balance')
     list_filter = ('borrower__name_en', 'loan_amount', 'borrower__agent__name', )
 
     exclude = (
@@ -291,6 +292,11 @@ class LoanAdmin(VersionAdmin, admin.ModelAdmin):
             return True
         return super(LoanAdmin, self).lookup_allowed(key, value)
 
+    def save_related(self, request, form, formsets, change):
+        """the lines and repayments are saved with the inlines, refresh the balance once they are all saved"""
+        super(LoanAdmin, self).save_related(request, form, formsets, change)
+        LoanBalance.refresh([form.instance.pk])
+
     # redefine add_view and change_view to create loans in 2 steps:
     # 1- loan amount, and repayment details (normal amount, bullet)
     # 2- everything else
@@ -463,6 +469,24 @@ class DefaultPredictionAdmin(admin.ModelAdmin):
         return obj.loan.loan_amount
 
 
+class ScheduleUpdateRunAdmin(admin.ModelAdmin):
+    list_display = ('date', 'started_at', 'finished_at', 'loans_total', 'loans_processed', 'failures')
+    ordering = ['-date']
+
+
+class ScheduleShiftAdmin(admin.ModelAdmin):
+    list_display = ('start_date', 'end_date', 'shift_days', 'agent', 'mfi_branch', 'loans_shifted', 'lines_shifted',
+                    'started_at', 'finished_at')
+    ordering = ['-started_at']
+
+
+class PortfolioSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('date', 'agent', 'mfi_branch', 'active_loans', 'total_outstanding', 'collected', 'disbursed')
+    list_filter = ('date', 'mfi_branch')
+    list_select_related = ('agent', 'mfi_branch')
+    ordering = ['-date']
+
+
 admin.site.register(Reconciliation, ReconciliationAdmin)
 admin.site.register(Disbursement, DisbursementAdmin)
 # admin.site.register(Loan, LoanAdmin)
@@ -473,3 +497,6 @@ admin.site.register(ReasonForDelayedRepayment, ReasonForDelayedRepaymentAdmin)
 admin.site.register(PhotoSignature, PhotoSignatureAdmin)
 admin.site.register(SuperUsertoLenderPayment, SuperUsertoLenderPaymentAdmin)
 admin.site.register(DefaultPrediction, DefaultPredictionAdmin)
+admin.site.register(ScheduleUpdateRun, ScheduleUpdateRunAdmin)
+admin.site.register(PortfolioSnapshot, PortfolioSnapshotAdmin)
+admin.site.register(ScheduleShift, ScheduleShiftAdmin)
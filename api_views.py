@@ -1,10 +1,13 @@
 import logging
+from collections import defaultdict
 from datetime import date as d
 from datetime import datetime, timedelta, timezone
 
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
 from rest_framework import mixins, status, views, viewsets
 from rest_framework.decorators import action
-from rest_framework.exceptions import NotAuthenticated
+from rest_framework.exceptions import NotAuthenticated, NotFound
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
@@ -30,9 +33,12 @@ from .models import (
     Repayment,
     RepaymentScheduleLine,
     SuperUsertoLenderPayment,
+    SyncTombstone,
+    record_repayments,
 )
 from .permissions import DisbursePermissions, LoanViewPermissions, SuperUserOnlyView
 from .serializers import (
+    BulkRepaymentSerializer,
     CashTransferSerializer,
     DisbursementDisburseSerializer,
     DisbursementSerializer,
@@ -41,6 +47,7 @@ from .serializers import (
     LoanRequestReviewSerializer,
     LoanSerializer,
     LoanSerializerFullDetail,
+    LoanSummarySerializer,
     NewRepaymentSerializer,
     NoteSerializer,
     NotificationSerializer,
@@ -52,6 +59,7 @@ from .serializers import (
     SuperUsertoLenderFullPaymentSerializer,
     SuperUsertoLenderPaymentCustomSerializer,
     SuperUsertoLenderPaymentSerializer,
+    repayment_error_detail,
 )
 from .signals import reconcile_with_intermediary
 
@@ -62,14 +70,76 @@ class StandardResultsSetPagination(PageNumberPagination):
     max_page_size = 1000
 
 
-class LoanViewSet(viewsets.ModelViewSet):
+# longer than the longest write transaction (eg: a chunk of the nightly schedule update), see DeltaSyncMixin
+SYNC_TOKEN_SAFETY_MARGIN = timedelta(minutes=15)
+
+
+class DeltaSyncMixin(object):
+    """
+    Add a `?since=<token>` parameter to the list action of a viewset, for the app to only download
+    what changed since its last sync. The response is then:
+    {
+        "token": <token to send as ?since= next time>,
+        "results": [objects created or changed since the token],
+        "deleted": [ids of the objects deleted since the token]
+    }
+    Without `?since=`, the list action is unchanged.
+    updated_at is set when a row is written, not when its transaction commits, so a row can become visible
+    after a token later than its updated_at was issued. The token is therefore SYNC_TOKEN_SAFETY_MARGIN before
+    the time of the request: objects changed within the margin are sent again next time, and the app must
+    update them by id instead of adding them twice.
+    """
+
+    def get_changed_since_filter(self, since):
+        return Q(updated_at__gt=since)
+
+    def list(self, request, *args, **kwargs):
+        since = request.query_params.get("since")
+        if since is None:
+            return super(DeltaSyncMixin, self).list(request, *args, **kwargs)
+        try:
+            since = parse_datetime(since)
+        except ValueError:
+            since = None
+        if since is None:
+            return Response(
+                {"since": "Invalid sync token"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        # take the new token before reading, and before the start of any transaction still running,
+        # so nothing saved meanwhile is missed next time
+        token = datetime.now(timezone.utc) - SYNC_TOKEN_SAFETY_MARGIN
+
+        queryset = (
+            self.filter_queryset(self.get_queryset())
+            .filter(self.get_changed_since_filter(since))
+            .distinct()
+        )
+        deleted = SyncTombstone.objects.filter(
+            model=queryset.model.__name__, deleted_at__gt=since
+        )
+        if not request.user.is_staff:
+            deleted = deleted.filter(agent__user=request.user)
+        return Response(
+            {
+                "token": token.isoformat(),
+                "results": self.get_serializer(queryset, many=True).data,
+                "deleted": list(deleted.values_list("object_id", flat=True)),
+            }
+        )
+
+
+class LoanViewSet(DeltaSyncMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows viewing and editing Loan objects
     """
 
     serializer_class = LoanSerializer
     permission_classes = (LoanViewPermissions,)
-    # pagination_class = StandardResultsSetPagination
+    # pagination is only used if the client asks for it with ?page= or ?page_size=
+    # so the versions of the app which expect the full list keep working
+    pagination_class = StandardResultsSetPagination
 
     def get_queryset(self):
         user = self.request.user
@@ -77,11 +147,33 @@ class LoanViewSet(viewsets.ModelViewSet):
             return None
 
         if user.is_staff:
-            return Loan.objects.all()
+            queryset = Loan.objects.all()
         else:
-            return Loan.objects.filter(borrower__agent__user=user).order_by(
-                "-uploaded_at"
-            )
+            queryset = Loan.objects.filter(borrower__agent__user=user)
+        # a total order, so that the pages don't overlap
+        queryset = queryset.order_by("-uploaded_at", "pk")
+        if self.request.method == "GET":
+            # lines and repayments are serialized (or used to compute days_late in the summary)
+            # for every loan, fetch them all at once
+            queryset = queryset.prefetch_related("lines", "repayments")
+        return queryset
+
+    @property
+    def paginator(self):
+        if not (
+            "page" in self.request.query_params
+            or "page_size" in self.request.query_params
+        ):
+            return None
+        return super(LoanViewSet, self).paginator
+
+    def get_changed_since_filter(self, since):
+        # the lines and repayments are sent with their loan, so send the loan again if any of them changed
+        return (
+            Q(updated_at__gt=since)
+            | Q(lines__updated_at__gt=since)
+            | Q(repayments__updated_at__gt=since)
+        )
 
     def get_serializer_class(self):
         """
@@ -89,6 +181,9 @@ class LoanViewSet(viewsets.ModelViewSet):
         This allows to customize the behaviour of the serializer and do some finer
         error handling.
         """
+        if self.request.method == "GET" and self.request.query_params.get("view") == "summary":
+            # lighter version without the lines and repayments, for slow connections
+            return LoanSummarySerializer
         if self.request.method in ("GET", "POST",):
             # reading: send the entire loan data, including repayments
             return LoanSerializer
@@ -97,16 +192,63 @@ class LoanViewSet(viewsets.ModelViewSet):
         elif self.request.method in ("PUT",):
             return LoanPUTSerializer
 
+    @staticmethod
+    def not_modified_or_etag(request, queryset, pk, variant):
+        """
+        Look up the version of the loan and build its ETag for the representation `variant`.
+        Return (etag, response) where response is a 304 Not Modified if the client already has
+        this version (If-None-Match header), None otherwise.
+        """
+        try:
+            version = (
+                queryset.filter(pk=pk)
+                .prefetch_related(None)
+                .values_list("version", flat=True)
+                .first()
+            )
+        except (ValueError, TypeError):
+            # not a valid pk, eg: /api/v1/loans/abc/
+            version = None
+        if version is None:
+            raise NotFound()
+        etag = '"{}-{}-{}"'.format(pk, version, variant)
+        # If-None-Match is a comma separated list of ETags, or *. It uses the weak comparison, ignore W/
+        if_none_match = [tag.strip() for tag in request.META.get("HTTP_IF_NONE_MATCH", "").split(",")]
+        if_none_match = [tag[2:] if tag.startswith("W/") else tag for tag in if_none_match]
+        if etag in if_none_match or "*" in if_none_match:
+            return etag, Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        return etag, None
+
+    def retrieve(self, request, *args, **kwargs):
+        if request.query_params.get("view") == "summary":
+            # days_late and next_disbursement_date change every day without the loan being saved
+            variant = "summary-{}".format(d.today().isoformat())
+        else:
+            variant = "loan"
+        etag, not_modified = self.not_modified_or_etag(
+            request, self.get_queryset(), kwargs["pk"], variant
+        )
+        if not_modified is not None:
+            return not_modified
+        response = super(LoanViewSet, self).retrieve(request, *args, **kwargs)
+        response["ETag"] = etag
+        return response
+
     @action(detail=True, methods=["get"], url_path="full")
     def get_full_loan(self, request, pk=None):
         """
         Return the full detail of loan.
+        The version of the loan is checked first, so clients sending If-None-Match get a
+        304 Not Modified without the loan being serialized.
         """
         if not request.user.is_authenticated:
             raise NotAuthenticated()
 
+        etag, not_modified = self.not_modified_or_etag(request, Loan.objects.all(), pk, "full")
+        if not_modified is not None:
+            return not_modified
         obj = Loan.objects.get(pk=pk)
-        return Response(LoanSerializerFullDetail(obj).data)
+        return Response(LoanSerializerFullDetail(obj).data, headers={"ETag": etag})
 
     @action(detail=True, methods=["POST"], url_path="sign")
     def sign_loan(self, request, pk=None):
@@ -156,7 +298,7 @@ class LoanViewSet(viewsets.ModelViewSet):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class RepaymentScheduleLineViewSet(viewsets.ModelViewSet):
+class RepaymentScheduleLineViewSet(DeltaSyncMixin, viewsets.ModelViewSet):
     """
     API endpoint to view and edit Loan schedule lines. Not to be used
     directly, but as part of a loan creation/edit.
@@ -175,7 +317,7 @@ class RepaymentScheduleLineViewSet(viewsets.ModelViewSet):
             )
 
 
-class RepaymentViewSet(viewsets.ModelViewSet):
+class RepaymentViewSet(DeltaSyncMixin, viewsets.ModelViewSet):
     """
     API endpoint to view and edit Loan repayments.
     """
@@ -204,6 +346,68 @@ class RepaymentViewSet(viewsets.ModelViewSet):
         obj = Repayment.objects.get(pk=pk)
         return Response(RepaymentFullSerializer(obj).data)
 
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk_upload(self, request):
+        """
+        Record many repayments, of any number of loans, in one request: POST a list of
+        {"idempotency_key", "loan", "date", "amount", "recorded_at", "reason_for_delay", "note"}.
+        The idempotency_key is generated by the app (eg: a uuid) so that retrying an upload is safe:
+        a repayment already recorded is not recorded again.
+        The repayments of each loan are saved together, in date order (see models.record_repayments).
+        Return one result per repayment, in the same order:
+        {"idempotency_key", "status": "created"|"duplicate"|"error", "repayment": {...}, "errors": {...}}
+        """
+        if not isinstance(request.data, list):
+            return Response({"detail": "Expected a list of repayments."}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = [None] * len(request.data)
+        valid = []
+        for i, item in enumerate(request.data):
+            serializer = BulkRepaymentSerializer(data=item)
+            if serializer.is_valid():
+                valid.append((i, serializer.validated_data))
+            else:
+                results[i] = {
+                    "idempotency_key": item.get("idempotency_key") if isinstance(item, dict) else None,
+                    "status": "error",
+                    "errors": serializer.errors,
+                }
+
+        loans = Loan.objects.filter(pk__in=set(data["loan"] for i, data in valid))
+        if not request.user.is_staff:
+            loans = loans.filter(borrower__agent__user=request.user)
+        loans = loans.in_bulk()
+        by_loan = defaultdict(list)
+        for i, data in valid:
+            if data["loan"] not in loans:
+                results[i] = {
+                    "idempotency_key": data["idempotency_key"],
+                    "status": "error",
+                    "errors": {"loan": ["Loan not found."]},
+                }
+                continue
+            loan = loans[data.pop("loan")]
+            by_loan[loan].append((i, Repayment(loan=loan, recorded_by=request.user, **data)))
+
+        for loan, items in by_loan.items():
+            try:
+                recorded = record_repayments(loan, [r for i, r in items])
+            except Exception as e:
+                logger = logging.getLogger("root")
+                logger.error("bulk repayment upload error", exc_info=True, extra={"loan": loan.pk, "exception": e})
+                recorded = [(r, {"message": "Could not record the repayment.", "error": "server_error"})
+                            for i, r in items]
+            for (i, r), (repayment, error) in zip(items, recorded):
+                result = {"idempotency_key": r.idempotency_key}
+                if error is None or error == "duplicate":
+                    result["status"] = "duplicate" if error else "created"
+                    result["repayment"] = RepaymentSerializer(repayment).data
+                else:
+                    result["status"] = "error"
+                    result["errors"] = error if isinstance(error, dict) else repayment_error_detail(error)
+                results[i] = result
+        return Response(results)
+
 
 class ReasonForDelayedRepaymentViewSet(
     mixins.CreateModelMixin, mixins.ListModelMixin, viewsets.GenericViewSet
@@ -0,0 +1,31 @@
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from loans.reports import build_portfolio_snapshot
+
+
+class Command(BaseCommand):
+    """
+    Build (or rebuild) the PortfolioSnapshot rows of a range of past days, eg: to backfill
+    the history. The nightly task only writes the snapshot of the previous day.
+    """
+    help = 'Build the portfolio snapshots of every day between start_date and end_date (included).'
+
+    def date_string(self, string):
+        return datetime.strptime(string, '%Y-%m-%d').date()
+
+    def add_arguments(self, parser):
+        parser.add_argument('start_date', help='the first day to build, in YYYY-MM-DD format', type=self.date_string)
+        parser.add_argument('end_date', help='the last day to build, in YYYY-MM-DD format', type=self.date_string)
+
+    def handle(self, *args, **options):
+        start_date = options['start_date']
+        end_date = options['end_date']
+        if end_date < start_date:
+            raise CommandError('end_date must be on or after start_date')
+
+        day = start_date
+        while day <= end_date:
+            snapshots = build_portfolio_snapshot(day)
+            self.stdout.write('{}: {} agent(s)'.format(day, len(snapshots)))
+            day += timedelta(days=1)
+        self.stdout.write('Done')
@@ -0,0 +1,33 @@
+from celery import group
+from django.core.management.base import BaseCommand
+from loans.models import Loan, LoanBalance
+from loans.tasks import refresh_loan_balances_chunk
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the LoanBalance of every loan, eg: to backfill the table after adding it,
+    or after fixing lines or repayments directly in the database.
+    """
+    help = 'Recompute the balance (due, paid, outstanding, days late) of all loans, in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='number of loans refreshed per chunk')
+        parser.add_argument('--sync', action='store_true',
+                            help='refresh the chunks one after the other in this process, instead of in parallel '
+                                 'in the celery workers')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        loan_ids = list(Loan.objects.order_by('pk').values_list('pk', flat=True))
+        chunks = [loan_ids[i:i + chunk_size] for i in range(0, len(loan_ids), chunk_size)]
+        self.stdout.write('Found {} loan(s) to refresh in {} chunk(s).'.format(len(loan_ids), len(chunks)))
+
+        if options['sync']:
+            for i, chunk in enumerate(chunks, 1):
+                LoanBalance.refresh(chunk)
+                self.stdout.write('Chunk {}/{} done.'.format(i, len(chunks)))
+        else:
+            group(refresh_loan_balances_chunk.si(chunk) for chunk in chunks).apply_async()
+            self.stdout.write('Chunks sent to the celery workers.')
+        self.stdout.write('Done')
@@ -1,9 +1,11 @@
 from django.core.management.base import BaseCommand, CommandError
-from django.utils.text import slugify
-from faker import Faker
-from datetime import date, datetime, timedelta
-from borrowers.models import Borrower, Agent, Market, Relative
-from loans.models import Loan, RepaymentScheduleLine
+from django.db import transaction
+from django.db.models import Count, DateField, ExpressionWrapper, F
+from django.utils import timezone
+from datetime import datetime, timedelta
+from borrowers.models import Agent
+from loans.models import Loan, LoanBalance, RepaymentScheduleLine, ScheduleShift
+from org.models import MFIBranch
 
 
 class Command(BaseCommand):
@@ -11,21 +13,34 @@ class Command(BaseCommand):
     Shift all repayments scheduled for a defined period.
     Can be used for holiday seasons when borrowers won't repay any loans.
     This does not affect actual repayments, only the schedule.
+    The lines are moved with one UPDATE per chunk of loans, each chunk in its own transaction
+    so the tables are never locked for long. The progress is saved in a ScheduleShift after each chunk:
+    if the command is interrupted, run it again with the same arguments to resume.
     """
     help = 'Shift all planned repayments by the specified number of days. Can only be used for dates in the future.'
 
     def date_string(self, string):
-        return datetime.strptime(string, '%Y-%m-%d')
+        return datetime.strptime(string, '%Y-%m-%d').date()
 
     def add_arguments(self, parser):
-                parser.add_argument('start_date', help='the first day to shift the payments from, in YYYY-MM-DD format', type=self.date_string)
-                parser.add_argument('end_date', help='the last day to shift the payments, in YYYY-MM-DD format', type=self.date_string)
-                parser.add_argument('shift_days', help='the number of days to shift by', type=int)
+        parser.add_argument('start_date', help='the first day to shift the payments from, in YYYY-MM-DD format', type=self.date_string)
+        parser.add_argument('end_date', help='the last day to shift the payments, in YYYY-MM-DD format', type=self.date_string)
+        parser.add_argument('shift_days', help='the number of days to shift by', type=int)
+        parser.add_argument('--agent', type=int, help='only shift the loans of the borrowers of this agent (pk)')
+        parser.add_argument('--branch', type=int, help='only shift the loans of the agents of this MFI branch (pk)')
+        parser.add_argument('--chunk-size', type=int, default=500, help='number of loans shifted per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='only count the loans and lines to shift')
+        parser.add_argument('--force', action='store_true', help='shift again, even if the same shift was already done')
 
     def handle(self, *args, **options):
         start_date = options['start_date']
         end_date = options['end_date']
         shift_days = options['shift_days']
+        try:
+            agent = Agent.objects.get(pk=options['agent']) if options['agent'] else None
+            mfi_branch = MFIBranch.objects.get(pk=options['branch']) if options['branch'] else None
+        except (Agent.DoesNotExist, MFIBranch.DoesNotExist) as e:
+            raise CommandError(e)
 
         # find the repayment lines that are impacted by the shift
         lines_to_shift = RepaymentScheduleLine.objects.filter(
@@ -33,18 +48,57 @@ class Command(BaseCommand):
         ).filter(
             date__lte=end_date
         )
+        if agent is not None:
+            lines_to_shift = lines_to_shift.filter(loan__borrower__agent=agent)
+        if mfi_branch is not None:
+            lines_to_shift = lines_to_shift.filter(loan__borrower__agent__field_officer__mfi_branch=mfi_branch)
         # we need to shift all repayment lines for the loans impacted by the shift
         # otherwise we would get 2 repayments for a few days after the shift period
-        loans_impacted = set()  # use a set to avoid duplicate loan IDs
-        for l in lines_to_shift:
-            loans_impacted.add(l.loan.id)
-        self.stdout.write('Found {} loan(s) to amend.'.format(len(loans_impacted)))
-
-        for l in loans_impacted:
-            loan = Loan.objects.get(pk=l)
-            lines = loan.lines.filter(date__gte=start_date)
-            self.stdout.write('Moving {} line(s) for loan #{}.'.format(lines.count(), l))
-            for line in lines:
-                line.date = line.date + timedelta(days=shift_days)
-                line.save()
+        loans_impacted = lines_to_shift.values('loan_id')
+
+        if options['dry_run']:
+            counts = RepaymentScheduleLine.objects.filter(
+                loan__in=loans_impacted, date__gte=start_date
+            ).aggregate(loans=Count('loan', distinct=True), lines=Count('pk'))
+            self.stdout.write('Would move {} line(s) of {} loan(s).'.format(counts['lines'], counts['loans']))
+            return
+
+        shift_args = dict(start_date=start_date, end_date=end_date, shift_days=shift_days,
+                          agent=agent, mfi_branch=mfi_branch)
+        if not options['force'] and ScheduleShift.objects.filter(finished_at__isnull=False, **shift_args).exists():
+            raise CommandError('This shift was already done, use --force to shift again.')
+        shift = ScheduleShift.objects.filter(finished_at=None, **shift_args).first()
+        if shift is None:
+            shift = ScheduleShift.objects.create(**shift_args)
+        elif shift.last_loan_id:
+            self.stdout.write('Resuming after loan #{}.'.format(shift.last_loan_id))
+
+        loan_ids = list(
+            Loan.objects.filter(
+                pk__in=loans_impacted, pk__gt=shift.last_loan_id
+            ).order_by('pk').values_list('pk', flat=True)
+        )
+        self.stdout.write('Found {} loan(s) to amend.'.format(len(loan_ids)))
+
+        chunk_size = options['chunk_size']
+        for i in range(0, len(loan_ids), chunk_size):
+            chunk = loan_ids[i:i + chunk_size]
+            with transaction.atomic():
+                moved = RepaymentScheduleLine.objects.filter(
+                    loan_id__in=chunk, date__gte=start_date
+                ).update(
+                    date=ExpressionWrapper(F('date') + timedelta(days=shift_days), output_field=DateField()),
+                    updated_at=timezone.now(),
+                )
+                Loan.bump_version(chunk)
+                # the contract due date may have moved
+                LoanBalance.refresh(chunk)
+                ScheduleShift.objects.filter(pk=shift.pk).update(
+                    last_loan_id=chunk[-1],
+                    loans_shifted=F('loans_shifted') + len(chunk),
+                    lines_shifted=F('lines_shifted') + moved,
+                )
+            self.stdout.write('Moved {} line(s) for loans #{} to #{}.'.format(moved, chunk[0], chunk[-1]))
+
+        ScheduleShift.objects.filter(pk=shift.pk).update(finished_at=timezone.now())
         self.stdout.write('Done')
@@ -0,0 +1,31 @@
+# Generated by Django 2.2 on 2026-10-17 02:15
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0080_auto_20200610_0450'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loan',
+            name='lines_updated_on',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ScheduleUpdateRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('loans_total', models.PositiveIntegerField(default=0)),
+                ('loans_processed', models.PositiveIntegerField(default=0)),
+                ('failures', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
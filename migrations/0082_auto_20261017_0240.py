@@ -0,0 +1,17 @@
+# Generated by Django 2.2 on 2026-10-17 02:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0081_auto_20261017_0215'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='repayment',
+            index=models.Index(fields=['reconciliation_status', 'date'], name='repayment_recon_status_date'),
+        ),
+    ]
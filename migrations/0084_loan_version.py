@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-17 04:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0083_auto_20261017_0330'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loan',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
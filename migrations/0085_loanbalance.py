@@ -0,0 +1,35 @@
+# Generated by Django 2.2 on 2026-10-17 04:40
+
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0084_loan_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoanBalance',
+            fields=[
+                ('loan', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='balance', serialize=False, to='loans.Loan')),
+                ('principal_due', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=12)),
+                ('fee_due', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=12)),
+                ('interest_due', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=12)),
+                ('subscription_due', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=12)),
+                ('principal_paid', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=12)),
+                ('fee_paid', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=12)),
+                ('interest_paid', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=12)),
+                ('subscription_paid', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=12)),
+                ('total_outstanding', models.DecimalField(db_index=True, decimal_places=2, default=Decimal('0'), max_digits=12)),
+                ('last_repayment_date', models.DateField(blank=True, null=True)),
+                ('contract_due_date', models.DateField(blank=True, null=True)),
+                ('days_late', models.IntegerField(db_index=True, default=0)),
+                ('computed_on', models.DateField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 2.2 on 2026-10-17 05:05
+
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('org', '0006_auto_20170516_1928'),
+        ('borrowers', '0015_agent_last_money_transfer'),
+        ('loans', '0085_loanbalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('active_loans', models.PositiveIntegerField(default=0)),
+                ('principal_outstanding', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14)),
+                ('fee_outstanding', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14)),
+                ('subscription_outstanding', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14)),
+                ('total_outstanding', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14)),
+                ('par_1_30_loans', models.PositiveIntegerField(default=0)),
+                ('par_1_30_outstanding', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14)),
+                ('par_31_60_loans', models.PositiveIntegerField(default=0)),
+                ('par_31_60_outstanding', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14)),
+                ('par_61_90_loans', models.PositiveIntegerField(default=0)),
+                ('par_61_90_outstanding', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14)),
+                ('par_over_90_loans', models.PositiveIntegerField(default=0)),
+                ('par_over_90_outstanding', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14)),
+                ('planned', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14)),
+                ('collected', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14)),
+                ('disbursed', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('agent', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='portfolio_snapshots', to='borrowers.Agent')),
+                ('mfi_branch', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='portfolio_snapshots', to='org.MFIBranch')),
+            ],
+            options={
+                'unique_together': {('date', 'agent')},
+            },
+        ),
+    ]
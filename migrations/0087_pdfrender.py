@@ -0,0 +1,27 @@
+# Generated by Django 2.2 on 2026-10-17 05:40
+
+from django.db import migrations, models
+import loans.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0086_portfoliosnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PDFRender',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('filename', models.CharField(max_length=100)),
+                ('file', models.FileField(blank=True, upload_to=loans.models.pdf_render_path)),
+                ('state', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='pending', max_length=10)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-17 06:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0087_pdfrender'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repayment',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+    ]
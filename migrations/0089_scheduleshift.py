@@ -0,0 +1,33 @@
+# Generated by Django 2.2 on 2026-10-17 06:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('org', '0006_auto_20170516_1928'),
+        ('borrowers', '0015_agent_last_money_transfer'),
+        ('loans', '0088_repayment_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduleShift',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField()),
+                ('shift_days', models.IntegerField()),
+                ('last_loan_id', models.IntegerField(default=0)),
+                ('loans_shifted', models.PositiveIntegerField(default=0)),
+                ('lines_shifted', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('agent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='borrowers.Agent')),
+                ('mfi_branch', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='org.MFIBranch')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-17 09:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0089_scheduleshift'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='loanbalance',
+            old_name='days_late',
+            new_name='current_delay',
+        ),
+    ]
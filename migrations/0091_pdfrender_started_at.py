@@ -0,0 +1,19 @@
+# Generated by Django 2.2 on 2026-10-17 09:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0090_rename_loanbalance_days_late'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdfrender',
+            name='started_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -10,8 +10,8 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from jsonfield import JSONField
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
-from django.db import models, transaction
-from django.db.models import Max, Sum
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Max, Sum
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
@@ -52,6 +52,13 @@ class RepaymentTooBigError(ZWBaseError, ValidationError):
     pass
 
 
+class IdempotencyKeyConflictError(ZWBaseError, ValidationError):
+    """
+    The idempotency key of the Repayment being saved was already used by a repayment of another Loan.
+    """
+    pass
+
+
 class PosteriorRepaymentAlreadyRecorded(ZWBaseError):
     """
     A Repayment with a date later than the current one has already been recorded in the database.
@@ -234,6 +241,164 @@ class Notification(models.Model):
     new_state = models.CharField(max_length=50, choices=LOAN_STATUS_CHOICES)
 
 
+class LoanLedger(object):
+    """
+    An in-memory snapshot of the schedule lines and repayments of a Loan.
+    Lines and repayments are loaded once (or taken from the prefetch cache if the loan was
+    fetched with prefetch_related('lines', 'repayments')), then every due/paid/outstanding
+    figure is computed from that snapshot without going back to the database.
+    Don't instantiate this directly, use Loan.ledger so the snapshot is shared between
+    the loan properties, and call Loan.invalidate_ledger() after changing lines or repayments.
+    """
+    COMPONENTS = ('principal', 'fee', 'interest', 'penalty', 'subscription')
+
+    def __init__(self, loan):
+        self.loan = loan
+        self.lines = sorted(loan.lines.all(), key=lambda l: l.date)
+        self.repayments = sorted(loan.repayments.all(), key=lambda r: r.date)
+        # totals for the whole loan, ie: what aggregate(Sum(...)) would return (or 0)
+        self.due = {c: sum(getattr(l, c) for l in self.lines) for c in self.COMPONENTS}
+        self.paid = {c: sum(getattr(r, c) for r in self.repayments) for c in self.COMPONENTS + ('amount',)}
+
+    def lines_until(self, date):
+        """return the lines scheduled on or before `date`"""
+        return [l for l in self.lines if l.date <= date]
+
+    def repayments_until(self, date):
+        """return the repayments received on or before `date`"""
+        return [r for r in self.repayments if r.date <= date]
+
+    def paid_until(self, date, component):
+        """return the sum of `component` repaid on or before `date`"""
+        return sum(getattr(r, component) for r in self.repayments_until(date))
+
+    @property
+    def principal_outstanding(self):
+        return self.loan.loan_amount - self.paid['principal']
+
+    @property
+    def fee_outstanding(self):
+        return self.loan.loan_fee - self.paid['fee']
+
+    @property
+    def subscription_outstanding(self):
+        return self.due['subscription'] - self.paid['subscription']
+
+    @property
+    def sum_of_subscription(self):
+        """Sum of the subscription of all lines, None if there are no lines (same as aggregate())"""
+        if not self.lines:
+            return None
+        return self.due['subscription']
+
+    @property
+    def contract_due_date(self):
+        try:
+            return self.lines[-1].date
+        except IndexError:
+            return None
+
+    @property
+    def latest_repayment_date(self):
+        try:
+            return self.repayments[-1].date
+        except IndexError:
+            return None
+
+
+def _principal_changes(entries, sign=1, shift_days=0):
+    """
+    Fold (date, principal) pairs into a dict {date: signed principal total}, with
+    dates moved by `shift_days`. Helper for the delay sweeps below.
+    """
+    changes = {}
+    shift = timedelta(days=shift_days)
+    for day, principal in entries:
+        changes[day + shift] = changes.get(day + shift, 0) + sign * principal
+    return changes
+
+
+def _merge_changes(*dicts):
+    merged = {}
+    for changes in dicts:
+        for day, value in changes.items():
+            merged[day] = merged.get(day, 0) + value
+    return merged
+
+
+def _balance_segments(changes, start, end):
+    """
+    Sweep the sorted `changes` between `start` and `end` (both included) and return
+    a list of (first_day, last_day, balance) where balance is the running total of the
+    changes, constant over [first_day, last_day].
+    """
+    points = sorted(set(day for day in changes if start <= day <= end) | {start})
+    segments = []
+    balance = 0
+    for i, day in enumerate(points):
+        balance += changes.get(day, 0)
+        last_day = points[i + 1] - timedelta(days=1) if i + 1 < len(points) else end
+        segments.append((day, last_day, balance))
+    return segments
+
+
+def count_days_late(lines, repayments, today=None):
+    """
+    Linear time version of the original day by day scan in Loan.get_delay().
+    Count the days, from the first line/repayment until yesterday, where the principal
+    scheduled so far is higher than the principal repaid so far.
+    :param lines: list of (date, principal) of the scheduled lines
+    :param repayments: list of (date, principal) of the repayments
+    :param today: defaults to date.today()
+    """
+    today = today or d.today()
+    end_date = today - timedelta(days=1)
+    lines = [(day, principal) for day, principal in lines if day <= end_date]
+    start_date = min([end_date] + [day for day, _ in lines] + [day for day, _ in repayments])
+
+    changes = _merge_changes(_principal_changes(lines), _principal_changes(repayments, sign=-1))
+    delay = 0
+    for first_day, last_day, balance in _balance_segments(changes, start_date, end_date):
+        if balance > 0:
+            delay += (last_day - first_day).days + 1
+    return delay
+
+
+def count_current_delay(lines, repayments, date, today=None):
+    """
+    Linear time version of the original backward day by day scan in Loan.current_delay_at().
+    See Loan.current_delay_at() for the rules, they are applied to whole segments of days
+    where the balance doesn't change instead of one day at a time.
+    :param lines: list of (date, principal) of the scheduled lines
+    :param repayments: list of (date, principal) of the repayments
+    :param date: the day to calculate the delay at
+    :param today: defaults to date.today()
+    """
+    today = today or d.today()
+    lines = [(day, principal) for day, principal in lines if day <= date]
+    repayments = [(day, principal) for day, principal in repayments if day <= date]
+    start_date = min([date] + [day for day, _ in lines] + [day for day, _ in repayments])
+
+    # the balance of a day counts the lines scheduled until the day before,
+    # and the repayments received until that day included
+    changes = _merge_changes(_principal_changes(lines, shift_days=1), _principal_changes(repayments, sign=-1))
+    lines_on = _principal_changes(lines)
+
+    delay = 0
+    for first_day, last_day, balance in reversed(_balance_segments(changes, start_date, date)):
+        if balance > 0:
+            # every day of the segment is late, except today which is still ongoing
+            delay += (last_day - first_day).days + 1
+            if first_day <= today <= last_day:
+                delay -= 1
+        else:
+            # the scan stops on the last day of this segment, consider the lines planned that day
+            if last_day != today and balance + lines_on.get(last_day, 0) > 0:
+                delay += 1
+            return delay
+    return delay
+
+
 class Loan(models.Model):
     """
     A class that represents a loan contract (nano, micro, whatever, they work the same way in the end.)
@@ -256,6 +421,62 @@ class Loan(models.Model):
         """
         super(Loan, self).__init__(*args, **kwargs)
         self.__subscription_total__ = 0
+        # lazily loaded snapshot of lines and repayments, see the `ledger` property
+        self._ledger = None
+        # the fields of the LoanBalance read from the loan itself, as loaded (without loading deferred fields)
+        self._balance_fields = (self.__dict__.get('loan_amount'), self.__dict__.get('loan_fee'))
+
+    @property
+    def ledger(self):
+        """
+        Return the LoanLedger used by the outstanding/paid properties below.
+        It is loaded on first access and kept until invalidate_ledger() is called.
+        """
+        if self._ledger is None:
+            self._ledger = LoanLedger(self)
+        return self._ledger
+
+    def invalidate_ledger(self):
+        """
+        Drop the cached LoanLedger. Must be called whenever lines or repayments
+        of this loan are saved, so the next read reloads them.
+        The lines and repayments prefetched with the loan are dropped too, or the ledger would be rebuilt from them.
+        """
+        self._ledger = None
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        prefetched.pop('lines', None)
+        prefetched.pop('repayments', None)
+
+    def refresh_from_db(self, *args, **kwargs):
+        self.invalidate_ledger()
+        super(Loan, self).refresh_from_db(*args, **kwargs)
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            super(Loan, self).save(*args, **kwargs)
+            return
+        # increment in the database, the lines and repayments may have changed it since this object was loaded
+        self.version = F('version') + 1
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = list(kwargs['update_fields']) + ['version']
+        super(Loan, self).save(*args, **kwargs)
+        super(Loan, self).refresh_from_db(fields=['version'])
+        if (self.loan_amount, self.loan_fee) != self._balance_fields:
+            self._balance_fields = (self.loan_amount, self.loan_fee)
+            LoanBalance.refresh([self.pk])
+
+    def delete(self, *args, **kwargs):
+        # keep a trace of the deleted loan for the delta sync of the app
+        SyncTombstone.record(Loan, [self.pk], self.borrower.agent)
+        return super(Loan, self).delete(*args, **kwargs)
+
+    @classmethod
+    def bump_version(cls, loan_ids):
+        """
+        increment the version of the loans with pks `loan_ids` (a list or a values() queryset),
+        when their lines, repayments or signatures are changed
+        """
+        cls.objects.filter(pk__in=loan_ids).update(version=F('version') + 1)
 
     def generate_contract_number():
         return str(uuid.uuid4().int)[0:12]
@@ -265,10 +486,18 @@ class Loan(models.Model):
     guarantor = models.ForeignKey(Borrower, related_name='loans_guaranteed', on_delete=models.PROTECT, blank=True,
                                   null=True)
 
+    # the last day the nightly task updated the schedule lines, see tasks.update_attributes_for_loans_lines
+    lines_updated_on = models.DateField(blank=True, null=True)
+
+    # incremented every time the loan, its lines, repayments or signatures change, used as ETag by the api
+    version = models.PositiveIntegerField(default=0)
+
     # the date on which the MFI approves the contract (which is later than uploaded_at)
     contract_date = models.DateField(default=d.today)
     # the date/time this object was first created, this does not get updated after that
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # the date/time this object was last saved, used for the delta sync of the app (?since=)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     state = FSMField(
         default=LOAN_REQUEST_DRAFT,
@@ -370,40 +599,58 @@ class Loan(models.Model):
         program end
         """
 
-        def reverse_daterange(start, end):
-            curr = end
-            while curr >= start:
-                yield curr
-                curr += timedelta(days=-1)
+        return count_current_delay(self._delay_lines(), self._delay_repayments(), date)
 
-        delay = 0
+    def _delay_lines(self):
+        return [(l.date, l.principal) for l in self.ledger.lines]
 
-        lines = self.lines.filter(date__lte=date)
-        repayments = self.repayments.filter(date__lte=date)
+    def _delay_repayments(self):
+        return [(r.date, r.principal) for r in self.ledger.repayments]
 
-        start_date = min([date] + [l.date for l in lines] + [r.date for r in repayments])
+    @property
+    def delays(self):
+        """
+        Return both days_late and current_delay from a single load of lines and repayments.
+        """
+        lines = self._delay_lines()
+        repayments = self._delay_repayments()
+        return {
+            'days_late': count_days_late(lines, repayments),
+            'current_delay': count_current_delay(lines, repayments, d.today()),
+        }
 
-        for day in reverse_daterange(start_date, date):
-            due = 0
-            # for a given day, do not consider planned repayment at first
-            for line in [l for l in lines if l.date <= day - timedelta(days=1)]:
-                due += getattr(line, 'principal', 0)
-            for r in [r for r in repayments if r.date <= day]:
-                due -= getattr(r, 'principal', 0)
-            # delay only if it is not today
-            if due > 0 and day != d.today():
-                delay += 1
-            elif due <= 0:
-                # if it is not today, check planned repayment for that day
-                # FIXME: this may have problem with timezone
-                if day != d.today():
-                    for line in [l for l in lines if l.date == day]:
-                        due += getattr(line, 'principal', 0)
-                    if due > 0:
-                        delay += 1
-                return delay
-        # there is no repayments for this loan
-        return delay
+    @classmethod
+    def get_delays_for_loans(cls, queryset, date=None):
+        """
+        Bulk version of `delays` for a queryset of loans, using 2 queries in total.
+        Return a dict {loan_id: {'days_late': x, 'current_delay': y}} where current_delay
+        is calculated at `date` (today by default).
+        Loans with neither lines nor repayments are never late, so they are not included:
+        use .get(loan.pk) and treat None as no delay.
+        """
+        today = d.today()
+        date = date or today
+        lines = {}
+        for loan_id, day, principal in RepaymentScheduleLine.objects.filter(
+            loan__in=queryset,
+            date__lte=max(date, today - timedelta(days=1))
+        ).values_list('loan_id', 'date', 'principal'):
+            lines.setdefault(loan_id, []).append((day, principal))
+        repayments = {}
+        for loan_id, day, principal in Repayment.objects.filter(
+            loan__in=queryset
+        ).values_list('loan_id', 'date', 'principal'):
+            repayments.setdefault(loan_id, []).append((day, principal))
+
+        delays = {}
+        for loan_id in set(lines) | set(repayments):
+            loan_lines = lines.get(loan_id, [])
+            loan_repayments = repayments.get(loan_id, [])
+            delays[loan_id] = {
+                'days_late': count_days_late(loan_lines, loan_repayments, today),
+                'current_delay': count_current_delay(loan_lines, loan_repayments, date, today),
+            }
+        return delays
 
     @property
     def next_loan_max_amount(self):
@@ -414,10 +661,7 @@ class Loan(models.Model):
 
     @property
     def contract_due_date(self):
-        try:
-            return self.lines.order_by('-date')[0].date
-        except:
-            return None
+        return self.ledger.contract_due_date
 
     @property
     def latest_repayment_date(self):
@@ -425,10 +669,7 @@ class Loan(models.Model):
         return the latest repayment received for this loan. This is just a date comparison,
         it does not imply anything on the status of the loan.
         """
-        try:
-            return self.repayments.order_by('-date')[0].date
-        except IndexError:
-            return None
+        return self.ledger.latest_repayment_date
 
     """Set to the date of the last payment, that closes the loan. None if the loan is active/open"""
 
@@ -460,8 +701,7 @@ class Loan(models.Model):
         """
         return how much of the principal is left to repay at the time of the function call
         """
-        principal_repaid = self.repayments.aggregate(paid=Sum('principal'))['paid'] or 0
-        po = self.loan_amount - principal_repaid
+        po = self.ledger.principal_outstanding
         if po < 0:
             raise PrincipalOutstandingNegativeError(self)
         return po
@@ -472,8 +712,7 @@ class Loan(models.Model):
         this function is intended to use for PortfolioStats calculation.
         if this function is called for today, this will probably the same as the function 'principal_outstanding' above
         """
-        principal_repaid = self.repayments.filter(date__lte=day).aggregate(paid=Sum('principal'))['paid'] or 0
-        po = self.loan_amount - principal_repaid
+        po = self.loan_amount - self.ledger.paid_until(day, 'principal')
         if po < 0:
             raise PrincipalOutstandingNegativeError(self)
         return po
@@ -483,8 +722,7 @@ class Loan(models.Model):
         """
         return how much of the fee is left to repay at the time of the function call
         """
-        fee_paid = self.repayments.aggregate(fee_paid=Sum('fee'))['fee_paid'] or 0
-        fo = self.loan_fee - fee_paid
+        fo = self.ledger.fee_outstanding
         if fo < 0:
             raise FeeOutstandingNegativeError(self)
         return fo
@@ -494,22 +732,18 @@ class Loan(models.Model):
         """
         return how much of the subscription is left to repay at the time of the function call
         """
-        subscription_paid = self.repayments.aggregate(subscription_paid=Sum('subscription'))['subscription_paid'] or 0
-        total_subscription_due = self.lines.aggregate(subscription_due=Sum('subscription'))['subscription_due'] or 0
-        so = total_subscription_due - subscription_paid
+        so = self.ledger.subscription_outstanding
         if so < 0:
             raise SubscriptionOutstandingNegativeError(self)
         return so
 
     @property
     def is_subscription(self):
-        total_subscription_due = self.lines.aggregate(subscription_due=Sum('subscription'))['subscription_due'] or 0
-        return total_subscription_due != 0
+        return self.ledger.due['subscription'] != 0
 
     @property
     def sum_of_subscription(self):
-        total_subscription_due = self.lines.aggregate(subscription_sum=Sum('subscription'))['subscription_sum']
-        return total_subscription_due
+        return self.ledger.sum_of_subscription
 
     # interest related methods
     # Warning: always call update_attributes_for_lines on the start of the day for interest of future lines to correct
@@ -656,6 +890,39 @@ class Loan(models.Model):
                                                            interest_period, number_of_repayments, 1)['repayment']
 
     # Repayment Schedule Line updating methods
+    def _line_on(self, date):
+        """
+        return the schedule line on `date` from the ledger, the in-memory equivalent of self.lines.get(date=date)
+        """
+        lines = [l for l in self.ledger.lines if l.date == date]
+        if not lines:
+            raise RepaymentScheduleLine.DoesNotExist('No line on {} for loan {}'.format(date, self.pk))
+        if len(lines) > 1:
+            raise RepaymentScheduleLine.MultipleObjectsReturned('Several lines on {} for loan {}'.format(date, self.pk))
+        return lines[0]
+
+    def _principal_due_for_dates(self, dates):
+        """
+        return [self.amount_due_for_date(date)['principal'] for date in dates] with a single sweep
+        over the ledger. `dates` must be sorted.
+        """
+        if self.repaid_on is not None or self.state in [LOAN_REQUEST_APPROVED, LOAN_REQUEST_SUBMITTED]:
+            return [self.amount_due_for_date(date)['principal'] for date in dates]
+        lines = self.ledger.lines
+        repayments = self.ledger.repayments
+        due = []
+        balance = 0
+        i = j = 0
+        for date in dates:
+            while i < len(lines) and lines[i].date <= date:
+                balance += lines[i].principal
+                i += 1
+            while j < len(repayments) and repayments[j].date <= date:
+                balance -= repayments[j].principal
+                j += 1
+            due.append(balance if balance > 0 else 0)
+        return due
+
     def _update_interest_for_today_and_future_lines_for_actual_360_or_365(self):
         """
         This method is to update interest of today and future lines when loan_interest_type is ACTUAL_360 or ACTUAL_365
@@ -667,13 +934,13 @@ class Loan(models.Model):
         Calculate today interest depending on yesterday_principal_outstanding
         Then interest of future lines are calculated depending on today data
         p.s This function update immediately (unlike update function for equal repayments) when repayment is received
+
+        The whole schedule is computed in memory from the ledger, and the changed lines are saved
+        with a single bulk_update.
         """
+        today = d.today()
         # yesterday principal outstanding which may be used to calculate today interest
-        principal_repaid_until_yesterday = self.repayments.filter(
-            date__lt=d.today()
-        ).aggregate(
-            paid=Sum('principal')
-        )['paid'] or 0
+        principal_repaid_until_yesterday = self.ledger.paid_until(today - timedelta(days=1), 'principal')
         yesterday_principal_outstanding = self.loan_amount - principal_repaid_until_yesterday
         if yesterday_principal_outstanding < 0:
             raise PrincipalOutstandingNegativeError(self)
@@ -681,24 +948,35 @@ class Loan(models.Model):
         # some variables that will be useful in updating future lines
         today_principal_outstanding = self.principal_outstanding
         today_due_principal = 0
+        lines_to_update = []
 
         # there is no line on contract date and after due date
         # calculate interest for today depending on yesterday principal outstanding
-        if self.uploaded_at.date() < d.today() <= self.contract_due_date:
-            today_line = self.lines.get(date=d.today())
-            today_line.interest = self.calculate_interest(yesterday_principal_outstanding)
-            today_line.save()
+        if self.uploaded_at.date() < today <= self.contract_due_date:
+            today_line = self._line_on(today)
+            interest = self.calculate_interest(yesterday_principal_outstanding)
+            if today_line.interest != interest:
+                today_line.interest = interest
+                lines_to_update.append(today_line)
             # keep today data for following days
-            today_principal_outstanding = self.principal_outstanding
-            today_due_principal = self.amount_due_for_date(today_line.date)['principal']
+            today_due_principal = self._principal_due_for_dates([today])[0]
 
         # update future lines
-        for line in self.lines.filter(date__gt=d.today()).order_by('date'):
+        future_lines = [l for l in self.ledger.lines if l.date > today]
+        principal_due = self._principal_due_for_dates([l.date for l in future_lines])
+        for line, line_due_principal in zip(future_lines, principal_due):
             remaining_balance = today_principal_outstanding - today_due_principal
-            line.interest = self.calculate_interest(remaining_balance)
-            line.save()
+            interest = self.calculate_interest(remaining_balance)
+            if line.interest != interest:
+                line.interest = interest
+                lines_to_update.append(line)
             # keep today data for following days
-            today_due_principal = self.amount_due_for_date(line.date)['principal']
+            today_due_principal = line_due_principal
+
+        RepaymentScheduleLine.stamp(lines_to_update)
+        RepaymentScheduleLine.objects.bulk_update(lines_to_update, ['interest', 'updated_at'])
+        if lines_to_update:
+            Loan.bump_version([self.pk])
 
     def _update_principal_and_interest_for_lines_for_equal_repayments(self):
         """
@@ -713,29 +991,30 @@ class Loan(models.Model):
         Then, calculate today data depending on yesterday principal outstanding
         Lastly, update future lines according to today data
         p.s This function do not update immediately (unlike update function for actual) when repayment is received. Need to call at tomorrow to update lines.
+
+        The whole schedule is computed in memory from the ledger, and the changed lines are saved
+        with a single bulk_update.
         """
+        today = d.today()
         # if yesterday repayment and schedule repayment matched then we do not need to update
-        yesterday = d.today() - timedelta(days=1)
+        yesterday = today - timedelta(days=1)
+        lines_to_update = []
         # make sure yesterday repayment and line exist
-        if (self.uploaded_at.date() + timedelta(days=1)) < d.today() <= self.contract_due_date:
-            past_line_principal = self.lines.filter(date__lt=d.today()).aggregate(paid=Sum('principal'))['paid'] or 0
-            past_repaid_principal = self.repayments.filter(date__lt=d.today()).aggregate(paid=Sum('principal'))['paid'] or 0
+        if (self.uploaded_at.date() + timedelta(days=1)) < today <= self.contract_due_date:
+            past_line_principal = sum(l.principal for l in self.ledger.lines_until(yesterday))
+            past_repaid_principal = self.ledger.paid_until(yesterday, 'principal')
             # if past repayments are paid do not update lines
             past_principal_offset = past_line_principal - past_repaid_principal
             if past_principal_offset == 0:
                 return
             else:  # if past repayments is more or less than normal amount, then update yesterday principal. Otherwise, it will cause error in repayment.breakdown
-                yesterday_repaid_principal = self.repayments.filter(
-                    date=yesterday
-                ).aggregate(
-                    paid=Sum('principal')
-                )['paid'] or 0
-                yesterday_line = self.lines.get(date=yesterday)
+                yesterday_repaid_principal = sum(r.principal for r in self.ledger.repayments if r.date == yesterday)
+                yesterday_line = self._line_on(yesterday)
                 yesterday_line.principal = yesterday_repaid_principal
-                yesterday_line.save()
+                lines_to_update.append(yesterday_line)
 
         # yesterday principal outstanding which may be used to calculate today interest
-        principal_repaid_until_yesterday = self.repayments.filter(date__lt=d.today()).aggregate(paid=Sum('principal'))['paid'] or 0
+        principal_repaid_until_yesterday = self.ledger.paid_until(yesterday, 'principal')
         yesterday_principal_outstanding = self.loan_amount - principal_repaid_until_yesterday
         if yesterday_principal_outstanding < 0:
             raise PrincipalOutstandingNegativeError(self)
@@ -743,13 +1022,14 @@ class Loan(models.Model):
         # some variables that will be useful in updating future lines
         today_principal_outstanding = self.principal_outstanding
         day_of_restart = 0
+        contract_day = self.uploaded_at.date()
 
         # there is no line on contract date and after due date
         # calculate interest for today depending on yesterday principal outstanding
-        if self.uploaded_at.date() < d.today() <= self.contract_due_date:
-            today_line = self.lines.get(date=d.today())
-            day_of_restart = (yesterday - self.uploaded_at.date()).days
-            number_of_periods_between_tdy_and_contract = (d.today() - self.uploaded_at.date()).days
+        if contract_day < today <= self.contract_due_date:
+            today_line = self._line_on(today)
+            day_of_restart = (yesterday - contract_day).days
+            number_of_periods_between_tdy_and_contract = (today - contract_day).days
             components = self._calculate_components_for_equal_repayments(yesterday_principal_outstanding,
                                                                          yesterday_principal_outstanding,
                                                                          self.loan_interest_rate,
@@ -759,13 +1039,13 @@ class Loan(models.Model):
                                                                          day_of_restart)
             today_line.principal = components['principal']
             today_line.interest = components['interest']
-            today_line.save()
+            lines_to_update.append(today_line)
             # keep today data for following days
             today_principal_outstanding = components['balance']
 
         # update future lines
-        for line in self.lines.filter(date__gt=d.today()).order_by('date'):
-            number_of_periods_between_line_and_contract = (line.date - self.uploaded_at.date()).days
+        for line in [l for l in self.ledger.lines if l.date > today]:
+            number_of_periods_between_line_and_contract = (line.date - contract_day).days
             components = self._calculate_components_for_equal_repayments(yesterday_principal_outstanding,
                                                                          today_principal_outstanding,
                                                                          self.loan_interest_rate,
@@ -775,20 +1055,29 @@ class Loan(models.Model):
                                                                          day_of_restart)
             line.principal = components['principal']
             line.interest = components['interest']
-            line.save()
+            lines_to_update.append(line)
             # keep today data for following days
             today_principal_outstanding = components['balance']
 
+        RepaymentScheduleLine.stamp(lines_to_update)
+        RepaymentScheduleLine.objects.bulk_update(lines_to_update, ['principal', 'interest', 'updated_at'])
+        if lines_to_update:
+            Loan.bump_version([self.pk])
+
     def update_attributes_for_lines(self):
         """
         update LoanRepaymentScheduleLine of Loan
         """
+        # work on fresh lines and repayments
+        self.invalidate_ledger()
         if self.loan_interest_type == ACTUAL_360 or self.loan_interest_type == ACTUAL_365:
             self._update_interest_for_today_and_future_lines_for_actual_360_or_365()
         elif self.loan_interest_type == EQUAL_REPAYMENTS:
             self._update_principal_and_interest_for_lines_for_equal_repayments()
         else:
             raise UnsupportedLoanInterestTypeError(self)
+        # lines were saved above, make sure the outstanding properties see the new values
+        self.invalidate_ledger()
 
     @property
     def interest_outstanding(self):
@@ -815,15 +1104,11 @@ class Loan(models.Model):
 
     @property
     def total_outstanding(self):
-        q = self.repayments.aggregate(principal_paid=Sum('principal'), fee_paid=Sum('fee'))
-
-        principal_paid = q['principal_paid'] or 0
-        po = self.loan_amount - principal_paid
+        po = self.ledger.principal_outstanding
         if po < 0:
             raise PrincipalOutstandingNegativeError(self)
 
-        fee_paid = q['fee_paid'] or 0
-        fo = self.loan_fee - fee_paid
+        fo = self.ledger.fee_outstanding
         if fo < 0:
             raise FeeOutstandingNegativeError(self)
 
@@ -878,12 +1163,12 @@ class Loan(models.Model):
         # if loan has not been disbursed yet, add lines of fees
         # even if due in the future
         if self.state in [LOAN_REQUEST_APPROVED, LOAN_REQUEST_SUBMITTED]:
-            lines = self.lines.filter(fee__gt=0)
-            repayments = self.repayments.filter(fee__gt=0)
+            lines = [l for l in self.ledger.lines if l.fee > 0]
+            repayments = [r for r in self.ledger.repayments if r.fee > 0]
         else:
             # for loans already disbursed, add all backlog of money due
-            lines = self.lines.filter(date__lte=date)
-            repayments = self.repayments.filter(date__lte=date)
+            lines = self.ledger.lines_until(date)
+            repayments = self.ledger.repayments_until(date)
 
         for line in lines:
             for c in self.get_breakdown_order():
@@ -916,7 +1201,7 @@ class Loan(models.Model):
             if getattr(self, component_name) > 0:
                 return False
         # all loan components have been fully repaid, close it!
-        self.repaid_on = self.repayments.aggregate(last_date=Max('date'))['last_date']
+        self.repaid_on = self.ledger.latest_repayment_date
         # change the loan.state using a transition
         self.mark_closed()
         self.save()
@@ -928,36 +1213,7 @@ class Loan(models.Model):
         1 day late is counted for each day where the outstanding amount is >0 at end of day,
         for all scheduled days before today.
         """
-
-        def reverse_daterange(start, end):
-            curr = end
-            while curr >= start:
-                yield curr
-                curr += timedelta(days=-1)
-
-        end_date = d.today() + timedelta(days=-1)
-
-        # FIXME: we should refactor this and current_delay_at as it's the same code
-        # and calculate both values in a single pass to save db queries
-
-        loan_lines = self.lines.filter(date__lte=end_date).values('date', 'principal')
-        repayments = self.repayments.all().values('date', 'principal')  # take them all as there are no repayments in the future
-        delay = 0
-        if len(loan_lines):
-            start_date = min([l['date'] for l in loan_lines])
-        else:
-            start_date = end_date
-
-        if len(repayments):
-            # min() raises an exception on an empty list
-            start_date = min(start_date, min([r['date'] for r in repayments]))
-
-        for day in reverse_daterange(start_date, end_date):
-            to_repaid = sum([l['principal'] for l in loan_lines if l['date'] <= day])
-            repaid = sum([r['principal'] for r in repayments if r['date'] <= day])
-            delay += ((to_repaid - repaid) > 0)
-
-        return delay
+        return count_days_late(self._delay_lines(), self._delay_repayments())
 
     @property
     def next_disbursement_date(self):
@@ -1097,6 +1353,31 @@ class RepaymentScheduleLine(models.Model):
     penalty = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
     subscription = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
     note = models.TextField(blank=True)
+    # the date/time this object was last saved, used for the delta sync of the app (?since=)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def save(self, *args, **kwargs):
+        super(RepaymentScheduleLine, self).save(*args, **kwargs)
+        Loan.bump_version([self.loan_id])
+        LoanBalance.refresh([self.loan_id])
+
+    def delete(self, *args, **kwargs):
+        loan_id = self.loan_id
+        # keep a trace of the deleted line for the delta sync of the app
+        SyncTombstone.record(RepaymentScheduleLine, [self.pk], self.loan.borrower.agent)
+        result = super(RepaymentScheduleLine, self).delete(*args, **kwargs)
+        Loan.bump_version([loan_id])
+        LoanBalance.refresh([loan_id])
+        return result
+
+    @staticmethod
+    def stamp(lines):
+        """
+        set updated_at on `lines` before a bulk_update(), which doesn't handle auto_now fields
+        """
+        now = timezone.now()
+        for line in lines:
+            line.updated_at = now
 
     def __str__(self):
         return str(self.loan) + ' - ' + str(self.date) + ': ' + 'principal:' + str(self.principal) + ' interest:' + str(
@@ -1135,6 +1416,12 @@ class Repayment(models.Model):
     An actual repayment, ie: money being paid back by the borrower, whether on time or not.
     """
 
+    class Meta:
+        indexes = [
+            # used by the reconciliation task to find pending repayments
+            models.Index(fields=['reconciliation_status', 'date'], name='repayment_recon_status_date'),
+        ]
+
     loan = models.ForeignKey(Loan, related_name='repayments', on_delete=models.CASCADE)
 
     # the date the money was actually repaid
@@ -1167,6 +1454,9 @@ class Repayment(models.Model):
     """
     uploaded_at = models.DateTimeField(auto_now_add=True, help_text='When the app uploaded this to the server')
 
+    """timestamp for when the repayment was last saved, used for the delta sync of the app (?since=)"""
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
     """keep track of the user who recorded this"""
     recorded_by = models.ForeignKey(User, default=1, on_delete=models.PROTECT)
 
@@ -1182,6 +1472,9 @@ class Repayment(models.Model):
         choices=RECONCILIATION_STATUS_CHOICES
     )
 
+    """key generated by the app for each repayment, so that uploading it again doesn't record it twice"""
+    idempotency_key = models.CharField(max_length=64, unique=True, blank=True, null=True)
+
     """set this value when superuser send money to lender"""
     superuser_to_lender_payment = models.ForeignKey('SuperUsertoLenderPayment', blank=True, null=True, on_delete=models.PROTECT)
     note = models.TextField(blank=True)
@@ -1210,11 +1503,13 @@ class Repayment(models.Model):
         return str(self.date) + ': ' + str(self.amount) + ' (pk=' + str(self.pk) + ')' + ' p: ' + str(
             self.principal) + ' f: ' + str(self.fee) + ' i: ' + str(self.interest)
 
-    def breakdown(self, force_recalc=False):
+    def breakdown(self, force_recalc=False, lines=None, repayments=None):
         """
         breakdown the repayment into its components (principal, fee, interest, penalty)
         and populate the various properties of the object. This does not save anything!
         force_recalc must be set to True to act on a Repayment that has already been saved.
+        `lines` and `repayments` can be given as lists of all the lines and repayments of the loan
+        to work from memory instead of querying the database (see recompute_breakdowns()).
         """
 
         amount_left = self.amount
@@ -1229,8 +1524,14 @@ class Repayment(models.Model):
                 setattr(self, c, 0)
 
         # get all scheduled repayments up to date of payment
-        past_loan_lines = self.loan.lines.filter(date__lte=self.date)
-        past_repayments = self.loan.repayments.filter(date__lte=self.date).exclude(id=self.id)
+        if lines is None:
+            past_loan_lines = self.loan.lines.filter(date__lte=self.date)
+        else:
+            past_loan_lines = [l for l in lines if l.date <= self.date]
+        if repayments is None:
+            past_repayments = self.loan.repayments.filter(date__lte=self.date).exclude(id=self.id)
+        else:
+            past_repayments = [r for r in repayments if r.date <= self.date and r.pk != self.pk]
         # consume the repayment on past schedule
         for component in self.loan.get_breakdown_order():
             component_total_to_pay = sum(getattr(l, component) for l in past_loan_lines)
@@ -1252,7 +1553,10 @@ class Repayment(models.Model):
         # priority in the future works differently than in the past lines:
         # we need to consume each line entirely before moving to the next one
         if amount_left > 0:
-            future_loan_lines = self.loan.lines.filter(date__gt=self.date).order_by('date')
+            if lines is None:
+                future_loan_lines = self.loan.lines.filter(date__gt=self.date).order_by('date')
+            else:
+                future_loan_lines = sorted([l for l in lines if l.date > self.date], key=lambda l: l.date)
             for line in future_loan_lines:
                 breakdown_order = self.loan.get_breakdown_order()
                 # FIXME: maybe principal is the only one that is need to be considered in future
@@ -1287,6 +1591,8 @@ class Repayment(models.Model):
         # for e.g. changing `reconciliation` for already repaid loan will trigger "loan already repaid" error
         if no_checks:
             super(Repayment, self).save()
+            self.loan.invalidate_ledger()
+            Loan.bump_version([self.loan_id])
             return
 
         if self.loan.repaid_on is not None:
@@ -1308,13 +1614,6 @@ class Repayment(models.Model):
                 params={'max_repayable': max_repayable}
             )
 
-        repayments_to_recalculate = []
-        posterior_repayments = self.loan.repayments.filter(date__gt=self.date)
-        if posterior_repayments.count() > 0:
-            # we already have repayment(s) recorded past the current one:
-            # we need to update the breakdown on all posterior repayments
-            repayments_to_recalculate = posterior_repayments.order_by('date')
-
         self.breakdown()
 
         # save the repayment, subsequent ones and update the loan in a transaction
@@ -1325,22 +1624,157 @@ class Repayment(models.Model):
         if update_posterior_repayments:
             with transaction.atomic():
                 # save this repayment before we recalc the later ones, so that their
-                # breakdown is correct (since breakdown will fetch data from db)
+                # breakdown is correct (since recompute_breakdowns will fetch data from db)
                 super(Repayment, self).save(*args, **kwargs)
-                for r in repayments_to_recalculate:
-                    r.breakdown(force_recalc=True)
-                    # prevent crazy recursion when saving by setting the flag
-                    r.save(update_posterior_repayments=False)
+                # if we already have repayment(s) recorded past the current one,
+                # we need to update the breakdown on all posterior repayments
+                recompute_breakdowns(self.loan, self.date)
+                # the repayments of the loan changed, reload them before checking if it's repaid
+                self.loan.invalidate_ledger()
+                Loan.bump_version([self.loan_id])
                 self.loan.close_if_fully_repaid(self)
+                LoanBalance.refresh([self.loan_id])
         else:
             # this is only called from *within the transaction*
             # we're in the process of updating repayment breakdown, only save
             # this current repayment, but don't touch any other one.
             super(Repayment, self).save(*args, **kwargs)
+            self.loan.invalidate_ledger()
+            Loan.bump_version([self.loan_id])
+            LoanBalance.refresh([self.loan_id])
 
             # update (princpal and) interest of loan lines
             # self.loan.update_attributes_for_lines()
 
+    def delete(self, *args, **kwargs):
+        loan_id = self.loan_id
+        with transaction.atomic():
+            # keep a trace of the deleted repayment for the delta sync of the app
+            SyncTombstone.record(Repayment, [self.pk], self.loan.borrower.agent)
+            result = super(Repayment, self).delete(*args, **kwargs)
+            self.loan.invalidate_ledger()
+            Loan.bump_version([loan_id])
+            LoanBalance.refresh([loan_id])
+        return result
+
+
+def recompute_breakdowns(loan, from_date):
+    """
+    Recalculate the breakdown of all repayments of `loan` made after `from_date`, eg: after
+    recording a back-dated repayment.
+    Lines and repayments are loaded once, the breakdowns are replayed in memory in date order
+    (each repayment seeing the updated breakdown of the previous ones, as if they were saved
+    one by one) and the changed repayments are written with a single bulk_update.
+    This must be called within a transaction. Returns the list of updated repayments.
+    """
+    lines = list(loan.lines.all())
+    repayments = list(loan.repayments.order_by('date', 'pk'))
+    components = loan.get_breakdown_order()
+    updated = []
+    now = timezone.now()
+    for r in repayments:
+        if r.date <= from_date:
+            continue
+        before = [getattr(r, c) for c in components]
+        r.breakdown(force_recalc=True, lines=lines, repayments=repayments)
+        if [getattr(r, c) for c in components] != before:
+            # bulk_update() doesn't set auto_now fields
+            r.updated_at = now
+            updated.append(r)
+    if updated:
+        Repayment.objects.bulk_update(updated, components + ['updated_at'])
+        Loan.bump_version([loan.pk])
+    loan.invalidate_ledger()
+    return updated
+
+
+def record_repayments(loan, repayments):
+    """
+    Save several new repayments of `loan` at once, eg: uploaded by the app after a day offline.
+    `repayments` are unsaved Repayment objects (loan, date, amount, recorded_by... set) with an
+    optional idempotency_key: a repayment whose key was already recorded is not saved again.
+    The repayments are checked in date order against the maximum repayable of the loan, inserted with
+    one bulk_create and broken down with a single recompute_breakdowns() from the earliest one,
+    instead of running Repayment.save() (and its replay of the posterior repayments) for each.
+    Return a list with, for each of `repayments` in the same order, a tuple (repayment, error) where
+    error is None if it was saved, 'duplicate' if its key was already recorded for this loan (repayment
+    is then the one recorded before), or a LoanAlreadyRepaidError/RepaymentTooBigError/IdempotencyKeyConflictError.
+    """
+    try:
+        return _record_repayments(loan, repayments)
+    except IntegrityError:
+        # the loan lock doesn't serialize the uploads of other loans: one of them recorded one of the keys
+        # meanwhile. Check the keys again, the repayment is now reported as duplicate or conflict.
+        for r in repayments:
+            r.pk = None
+        return _record_repayments(loan, repayments)
+
+
+def _record_repayments(loan, repayments):
+    """
+    record_repayments() in a transaction (a savepoint when nested), rolled back if a key is recorded concurrently
+    """
+    results = [None] * len(repayments)
+    with transaction.atomic():
+        # serialize the uploads for the same loan, so the idempotency keys check below is reliable
+        loan = Loan.objects.select_for_update().get(pk=loan.pk)
+        keys = [r.idempotency_key for r in repayments if r.idempotency_key]
+        recorded = {r.idempotency_key: r for r in Repayment.objects.filter(loan=loan, idempotency_key__in=keys)}
+        # the keys are unique across all the repayments, a key of another loan can't be reused
+        used_elsewhere = set(
+            Repayment.objects.filter(idempotency_key__in=keys).exclude(loan=loan).values_list('idempotency_key', flat=True)
+        )
+
+        if loan.repaid_on is None:
+            # same as Repayment.save(), with the aggregates computed once
+            lines = list(loan.lines.all())
+            existing = list(loan.repayments.all())
+            max_repayable = loan.loan_amount + loan.loan_fee + sum(
+                l.interest + l.penalty + l.subscription for l in lines
+            ) - sum(r.amount for r in existing)
+
+        to_create = []
+        for i in sorted(range(len(repayments)), key=lambda i: repayments[i].date):
+            r = repayments[i]
+            r.loan = loan
+            if r.idempotency_key in recorded:
+                results[i] = (recorded[r.idempotency_key], 'duplicate')
+            elif r.idempotency_key in used_elsewhere:
+                results[i] = (r, IdempotencyKeyConflictError(
+                    'This idempotency key was already used for a repayment of another loan'
+                ))
+            elif loan.repaid_on is not None:
+                results[i] = (r, LoanAlreadyRepaidError(
+                    'The loan is already fully repaid. You cannot add more repayments to it.'
+                ))
+            elif r.amount > max_repayable:
+                results[i] = (r, RepaymentTooBigError(
+                    'The amount repaid exceeds the maximum repayable for this loan',
+                    params={'max_repayable': max_repayable}
+                ))
+            else:
+                max_repayable -= r.amount
+                # broken down by recompute_breakdowns() below
+                for c in loan.get_breakdown_order():
+                    setattr(r, c, 0)
+                if r.idempotency_key:
+                    recorded[r.idempotency_key] = r
+                to_create.append(r)
+                results[i] = (r, None)
+
+        if to_create:
+            # bulk_create only sets the pks of the created objects on PostgreSQL, which
+            # the breakdowns below (and the callers) rely on
+            Repayment.objects.bulk_create(to_create)
+            updated = {u.pk: u for u in recompute_breakdowns(loan, min(r.date for r in to_create) - timedelta(days=1))}
+            for r in to_create:
+                for c in loan.get_breakdown_order():
+                    setattr(r, c, getattr(updated.get(r.pk, r), c))
+            Loan.bump_version([loan.pk])
+            loan.close_if_fully_repaid(max(to_create, key=lambda r: r.date))
+            LoanBalance.refresh([loan.pk])
+    return results
+
 
 class LoanRequestReview(models.Model):
     """
@@ -1401,6 +1835,7 @@ class BaseBorrowerSignature(models.Model):
         """
         # self.validate()
         super(BaseBorrowerSignature, self).save(*args, **kwargs)
+        Loan.bump_version([self.loan_id])
 
 
 class PhotoSignature(BaseBorrowerSignature):
@@ -1680,3 +2115,274 @@ class DefaultPrediction(models.Model):
     passed_credit = models.BooleanField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+
+class ScheduleUpdateRun(models.Model):
+    """
+    Record of the nightly update of the schedule lines of all active loans
+    (see tasks.update_attributes_for_loans_lines). There is one run per day: starting the
+    task again on the same day resumes the run, and only updates the loans not processed yet.
+    """
+    date = models.DateField(unique=True)
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    loans_total = models.PositiveIntegerField(default=0)
+    loans_processed = models.PositiveIntegerField(default=0)
+    failures = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return '{}: {}/{} loans, {} failures'.format(self.date, self.loans_processed, self.loans_total, self.failures)
+
+
+class SyncTombstone(models.Model):
+    """
+    Trace of a deleted Loan, RepaymentScheduleLine or Repayment, so that the app can remove
+    it from its local data when syncing with ?since= (see api_views.DeltaSyncMixin).
+    They are recorded by the delete() of those models, and by LoanPUTSerializer for the lines
+    it deletes in bulk. Queryset deletes (eg: the admin bulk delete action) leave no tombstone.
+    """
+    model = models.CharField(max_length=50)
+    object_id = models.IntegerField()
+    # the agent whose app has a copy of the object
+    agent = models.ForeignKey(Agent, blank=True, null=True, on_delete=models.CASCADE)
+    deleted_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    @classmethod
+    def record(cls, model, object_ids, agent):
+        """
+        create tombstones for the deleted objects of class `model` with pks `object_ids`
+        """
+        cls.objects.bulk_create(
+            [cls(model=model.__name__, object_id=object_id, agent=agent) for object_id in object_ids]
+        )
+
+    def __str__(self):
+        return '{} {} deleted at {}'.format(self.model, self.object_id, self.deleted_at)
+
+
+class LoanBalance(models.Model):
+    """
+    Materialized due/paid/outstanding figures of a Loan, so that lists and reports can filter and
+    sort loans by outstanding or days late with a plain query, instead of loading the lines and
+    repayments of every loan.
+    It is refreshed with LoanBalance.refresh() whenever the repayments or lines of the loan are saved or deleted
+    (including in bulk by record_repayments, ScheduleGenerator and the loan serializers), when the amount or
+    fee of the loan change, and every night by the schedule update (for current_delay).
+    Any other bulk write of lines or repayments must call it too. Backfill it with `manage.py rebuild_loan_balances`.
+    """
+    COMPONENTS = ('principal', 'fee', 'interest', 'subscription')
+
+    loan = models.OneToOneField(Loan, primary_key=True, related_name='balance', on_delete=models.CASCADE)
+
+    # sum of the schedule lines
+    principal_due = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
+    fee_due = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
+    interest_due = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
+    subscription_due = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
+
+    # sum of the repayments
+    principal_paid = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
+    fee_paid = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
+    interest_paid = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
+    subscription_paid = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
+
+    # same as Loan.total_outstanding (-1 when the subscription schedule is invalid)
+    total_outstanding = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0), db_index=True)
+    last_repayment_date = models.DateField(blank=True, null=True)
+    contract_due_date = models.DateField(blank=True, null=True)
+    # Loan.current_delay_at(computed_on), the days late of the current delay (not the cumulative Loan.days_late)
+    current_delay = models.IntegerField(default=0, db_index=True)
+    computed_on = models.DateField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def refresh(cls, loan_ids, date=None):
+        """
+        Recompute the balances of the loans with pks `loan_ids` from their lines and repayments,
+        with current_delay calculated at `date` (today by default).
+        This takes a fixed number of queries whatever the number of loans.
+        """
+        date = date or d.today()
+        loans = {pk: (amount, fee) for pk, amount, fee in Loan.objects.filter(
+            pk__in=loan_ids
+        ).values_list('pk', 'loan_amount', 'loan_fee')}
+        if not loans:
+            return
+
+        due = {
+            row['loan_id']: row for row in RepaymentScheduleLine.objects.filter(
+                loan_id__in=list(loans)
+            ).values('loan_id').annotate(
+                last_date=Max('date'), **{c: Sum(c) for c in cls.COMPONENTS}
+            )
+        }
+        paid = {
+            row['loan_id']: row for row in Repayment.objects.filter(
+                loan_id__in=list(loans)
+            ).values('loan_id').annotate(
+                last_date=Max('date'), **{c: Sum(c) for c in cls.COMPONENTS}
+            )
+        }
+        delays = Loan.get_delays_for_loans(list(loans), date)
+
+        balances = []
+        for loan_id, (loan_amount, loan_fee) in loans.items():
+            balance = cls(loan_id=loan_id, computed_on=date, updated_at=timezone.now())
+            loan_due = due.get(loan_id, {})
+            loan_paid = paid.get(loan_id, {})
+            for c in cls.COMPONENTS:
+                setattr(balance, c + '_due', loan_due.get(c) or 0)
+                setattr(balance, c + '_paid', loan_paid.get(c) or 0)
+            balance.contract_due_date = loan_due.get('last_date')
+            balance.last_repayment_date = loan_paid.get('last_date')
+            balance.current_delay = (delays.get(loan_id) or {}).get('current_delay', 0)
+            subscription_outstanding = balance.subscription_due - balance.subscription_paid
+            if subscription_outstanding < 0:
+                # same temp hack as Loan.total_outstanding
+                balance.total_outstanding = -1
+            else:
+                # interest and penalty outstanding are always 0 for now (see Loan)
+                balance.total_outstanding = (loan_amount - balance.principal_paid) + (loan_fee - balance.fee_paid) \
+                    + subscription_outstanding
+            balances.append(balance)
+
+        existing = set(cls.objects.filter(loan_id__in=list(loans)).values_list('loan_id', flat=True))
+        fields = [f.name for f in cls._meta.concrete_fields if f.name != 'loan']
+        created = [b for b in balances if b.loan_id not in existing]
+        with transaction.atomic():
+            cls.objects.bulk_update([b for b in balances if b.loan_id in existing], fields)
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(created)
+            except IntegrityError:
+                # a concurrent first refresh of the same loans created them meanwhile
+                cls.objects.bulk_update(created, fields)
+
+    def __str__(self):
+        return '{}: {} outstanding, {} days late'.format(self.loan_id, self.total_outstanding, self.current_delay)
+
+
+class PortfolioSnapshot(models.Model):
+    """
+    State of the portfolio of an agent at the end of a day, written every night by
+    tasks.portfolio_snapshot (see reports.build_portfolio_snapshot), so that trends and month-end
+    figures are read from this table instead of replaying all the lines and repayments.
+    Use PortfolioSnapshot.rollup() for the totals by MFIBranch or MFI.
+    """
+    # the fields summed by rollup()
+    TOTALS = (
+        'active_loans', 'principal_outstanding', 'fee_outstanding', 'subscription_outstanding', 'total_outstanding',
+        'par_1_30_loans', 'par_1_30_outstanding', 'par_31_60_loans', 'par_31_60_outstanding',
+        'par_61_90_loans', 'par_61_90_outstanding', 'par_over_90_loans', 'par_over_90_outstanding',
+        'planned', 'collected', 'disbursed',
+    )
+
+    class Meta:
+        unique_together = ('date', 'agent')
+
+    date = models.DateField()
+    agent = models.ForeignKey(Agent, related_name='portfolio_snapshots', on_delete=models.CASCADE)
+    # the branch of the agent's field officer on that day
+    mfi_branch = models.ForeignKey(MFIBranch, blank=True, null=True, related_name='portfolio_snapshots',
+                                   on_delete=models.PROTECT)
+
+    # disbursed loans, not repaid at the end of the day
+    active_loans = models.PositiveIntegerField(default=0)
+    principal_outstanding = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal(0))
+    fee_outstanding = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal(0))
+    subscription_outstanding = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal(0))
+    total_outstanding = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal(0))
+
+    # number of late loans and their total outstanding, by PAR category (see reports.PAR_BUCKETS)
+    par_1_30_loans = models.PositiveIntegerField(default=0)
+    par_1_30_outstanding = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal(0))
+    par_31_60_loans = models.PositiveIntegerField(default=0)
+    par_31_60_outstanding = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal(0))
+    par_61_90_loans = models.PositiveIntegerField(default=0)
+    par_61_90_outstanding = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal(0))
+    par_over_90_loans = models.PositiveIntegerField(default=0)
+    par_over_90_outstanding = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal(0))
+
+    # amounts of the day: scheduled lines, repayments received, disbursements sent
+    planned = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal(0))
+    collected = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal(0))
+    disbursed = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal(0))
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def rollup(cls, queryset, *fields):
+        """
+        Sum the snapshots of `queryset` grouped by `fields`, eg:
+            PortfolioSnapshot.rollup(PortfolioSnapshot.objects.filter(date__gte=start), 'date', 'mfi_branch__mfi')
+        returns one dict per (date, mfi) with the totals of all their agents.
+        """
+        return queryset.values(*fields).annotate(**{f: Sum(f) for f in cls.TOTALS}).order_by(*fields)
+
+    def __str__(self):
+        return '{} {}: {} active loans, {} outstanding'.format(
+            self.date, self.agent, self.active_loans, self.total_outstanding
+        )
+
+
+# states of a PDFRender
+PDF_RENDER_PENDING = 'pending'  # waiting for a renderer worker
+PDF_RENDER_RUNNING = 'running'
+PDF_RENDER_DONE = 'done'  # the file is ready
+PDF_RENDER_FAILED = 'failed'  # the next request for the same document starts a new render
+# a render still pending or running after this long was lost (eg: the worker died), and is started again
+PDF_RENDER_TIMEOUT = timedelta(minutes=20)
+
+PDF_RENDER_STATE_CHOICES = (
+    (PDF_RENDER_PENDING, 'pending'),
+    (PDF_RENDER_RUNNING, 'running'),
+    (PDF_RENDER_DONE, 'done'),
+    (PDF_RENDER_FAILED, 'failed'),
+)
+
+
+def pdf_render_path(instance, filename):
+    return 'pdf/{}/{}/{}'.format(instance.key[:2], instance.key, filename)
+
+
+class PDFRender(models.Model):
+    """
+    A PDF rendered in the background by tasks.render_pdf (see loans.pdf), stored under the hash
+    of its HTML, so that printing the same contract or sheet again is served from storage.
+    """
+    # sha256 of the template name, wkhtmltopdf options and rendered HTML, see pdf.pdf_key()
+    key = models.CharField(max_length=64, unique=True)
+    filename = models.CharField(max_length=100)
+    file = models.FileField(upload_to=pdf_render_path, blank=True)
+    state = models.CharField(max_length=10, choices=PDF_RENDER_STATE_CHOICES, default=PDF_RENDER_PENDING)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # when the current render was queued or started, see PDF_RENDER_TIMEOUT
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return '{} ({})'.format(self.filename, self.state)
+
+
+class ScheduleShift(models.Model):
+    """
+    Progress of a run of the shift_repayments command. The loans are shifted in chunks, in pk order,
+    and last_loan_id is saved with each chunk: running the command again with the same arguments
+    resumes after the last chunk done.
+    """
+    start_date = models.DateField()
+    end_date = models.DateField()
+    shift_days = models.IntegerField()
+    agent = models.ForeignKey(Agent, blank=True, null=True, on_delete=models.PROTECT)
+    mfi_branch = models.ForeignKey(MFIBranch, blank=True, null=True, on_delete=models.PROTECT)
+    last_loan_id = models.IntegerField(default=0)
+    loans_shifted = models.PositiveIntegerField(default=0)
+    lines_shifted = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return '{} to {} by {} days: {} loans, {} lines'.format(
+            self.start_date, self.end_date, self.shift_days, self.loans_shifted, self.lines_shifted
+        )
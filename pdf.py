@@ -0,0 +1,124 @@
+import hashlib
+import json
+
+from celery import chord, group
+from django.db.models import Q
+from django.shortcuts import redirect, render
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import PDF_RENDER_DONE, PDF_RENDER_FAILED, PDF_RENDER_PENDING, PDF_RENDER_RUNNING, PDF_RENDER_TIMEOUT, \
+    PDFRender
+from .tasks import PDF_QUEUE, merge_pdfs, render_pdf
+
+
+def pdf_key(template_name, html, cmd_options):
+    """
+    return the cache key of a PDF: the sha256 of everything wkhtmltopdf gets as input
+    """
+    digest = hashlib.sha256()
+    digest.update(template_name.encode())
+    digest.update(json.dumps(cmd_options, sort_keys=True).encode())
+    digest.update(html.encode())
+    return digest.hexdigest()
+
+
+def batch_key(part_keys):
+    """
+    return the cache key of the concatenation of the PDFs with keys `part_keys`
+    """
+    digest = hashlib.sha256()
+    digest.update('batch'.encode())
+    for key in part_keys:
+        digest.update(key.encode())
+    return digest.hexdigest()
+
+
+def _get_or_restart(key, filename):
+    """
+    return (pdf, start) for the PDFRender `key`, where `start` is True if the caller must start
+    rendering it: it is new, it failed before, or its render was lost (still pending or running after
+    PDF_RENDER_TIMEOUT). The conditional update makes sure only one request restarts it.
+    """
+    pdf, created = PDFRender.objects.get_or_create(key=key, defaults={'filename': filename})
+    now = timezone.now()
+    restartable = Q(state=PDF_RENDER_FAILED) | Q(
+        state__in=[PDF_RENDER_PENDING, PDF_RENDER_RUNNING], started_at__lt=now - PDF_RENDER_TIMEOUT
+    )
+    retry = not created and pdf.state != PDF_RENDER_DONE and PDFRender.objects.filter(
+        restartable, pk=pdf.pk
+    ).update(state=PDF_RENDER_PENDING, error='', started_at=now)
+    if retry:
+        pdf.state = PDF_RENDER_PENDING
+        pdf.started_at = now
+    return pdf, bool(created or retry)
+
+
+def prepare_pdf(request, template_name, context, filename, cmd_options=None):
+    """
+    Render the HTML of `template_name` with `context` (that's cheap) and get its PDFRender.
+    return (pdf, task) where `task` is the render_pdf signature to run if the PDF must be rendered,
+    None if it is already done or being rendered.
+    """
+    cmd_options = cmd_options or {}
+    html = render_to_string(template_name, context, request=request)
+    pdf, start = _get_or_restart(pdf_key(template_name, html, cmd_options), filename)
+    if start:
+        return pdf, render_pdf.si(pdf.pk, html, cmd_options).set(queue=PDF_QUEUE)
+    return pdf, None
+
+
+def _pdf_or_pending_response(request, pdf):
+    """
+    redirect to the stored file if the PDF is done, otherwise return a page polling pdf_status
+    """
+    if pdf.state == PDF_RENDER_DONE:
+        return redirect(pdf.file.url)
+    context = {
+        'filename': pdf.filename,
+        'status_url': reverse('loans:pdf-status', args=[pdf.key]),
+    }
+    return render(request, 'loans/pdf_pending.html', context, status=202)
+
+
+def pdf_response(request, template_name, context, filename, cmd_options=None):
+    """
+    Serve the PDF of `template_name` rendered with `context`.
+    The PDF conversion runs in the renderer workers (tasks.render_pdf). If the same HTML was already
+    converted, redirect to the stored file, otherwise start the conversion (once, even if the document
+    is requested several times) and return a page that polls pdf_status until the file is ready.
+    """
+    pdf, task = prepare_pdf(request, template_name, context, filename, cmd_options)
+    if task is not None:
+        task.apply_async()
+    return _pdf_or_pending_response(request, pdf)
+
+
+def batch_pdf_response(request, documents, filename):
+    """
+    Same as pdf_response for the concatenation of several documents, a list of
+    (template_name, context, filename, cmd_options).
+    Each document is a PDFRender of its own: the ones already rendered are reused, the others
+    are rendered in parallel by the renderer workers, then tasks.merge_pdfs concatenates them.
+    """
+    parts = []
+    tasks = []
+    for document in documents:
+        part, task = prepare_pdf(request, *document)
+        parts.append(part)
+        if task is not None:
+            tasks.append(task)
+
+    part_keys = [part.key for part in parts]
+    pdf, start = _get_or_restart(batch_key(part_keys), filename)
+    if start:
+        merge = merge_pdfs.si(pdf.pk, part_keys).set(queue=PDF_QUEUE)
+        if tasks:
+            chord(tasks)(merge)
+        else:
+            merge.apply_async()
+    elif tasks:
+        # a part failed before and is rendered again, the merge task waits for it
+        group(tasks).apply_async()
+    return _pdf_or_pending_response(request, pdf)
@@ -0,0 +1,269 @@
+from datetime import date as d
+
+from django.db import transaction
+from django.db.models import F, Max, Q, Sum
+
+from borrowers.models import Agent
+from .models import DISBURSEMENT_SENT, LOAN_DISBURSED, LOAN_REPAID, Disbursement, Loan, PortfolioSnapshot, Repayment, \
+    RepaymentScheduleLine
+
+# PAR (portfolio at risk) categories, with the maximum number of days late they include
+PAR_BUCKETS = (
+    ('PAR 1-30', 30),
+    ('PAR 31-60', 60),
+    ('PAR 61-90', 90),
+    ('PAR >90', None),
+)
+
+
+def par_category(days_late):
+    """
+    return the PAR category name for a loan `days_late` days late (days_late must be > 0)
+    """
+    for name, max_days in PAR_BUCKETS:
+        if max_days is None or days_late <= max_days:
+            return name
+
+
+class PortfolioAtRisk(object):
+    """
+    Compute days late and outstanding amounts for all open disbursed loans from a fixed
+    number of bulk queries, instead of calling Loan.current_delay_at() and
+    Loan.total_outstanding on each loan.
+    Usage:
+        par = PortfolioAtRisk(agent=agent, start_date=date(2019, 1, 1))
+        par.rows     # one dict per late loan, sorted by days late
+        par.buckets  # {'PAR 1-30': {'count': x, 'outstanding': y}, ...}
+    """
+
+    def __init__(self, agent=None, mfi_branch=None, start_date=None, end_date=None, date=None):
+        """
+        :param agent: only include loans of borrowers of this Agent
+        :param mfi_branch: only include loans of agents working for this MFIBranch
+        :param start_date: only include loans with contract_date >= start_date
+        :param end_date: only include loans with contract_date <= end_date
+        :param date: the day to calculate the delay at, today by default
+        """
+        self.date = date or d.today()
+        loans = Loan.objects.filter(repaid_on=None, state=LOAN_DISBURSED)
+        if agent is not None:
+            loans = loans.filter(borrower__agent=agent)
+        if mfi_branch is not None:
+            loans = loans.filter(borrower__agent__field_officer__mfi_branch=mfi_branch)
+        if start_date is not None:
+            loans = loans.filter(contract_date__gte=start_date)
+        if end_date is not None:
+            loans = loans.filter(contract_date__lte=end_date)
+        self.loans = loans
+        self._rows = None
+
+    def _repaid_by_loan(self):
+        return {
+            r['loan_id']: r for r in Repayment.objects.filter(
+                loan__in=self.loans
+            ).values('loan_id').annotate(
+                principal=Sum('principal'),
+                fee=Sum('fee'),
+                subscription=Sum('subscription'),
+                last_date=Max('date'),
+            )
+        }
+
+    def _subscription_due_by_loan(self):
+        return dict(
+            RepaymentScheduleLine.objects.filter(
+                loan__in=self.loans
+            ).values('loan_id').annotate(
+                subscription=Sum('subscription')
+            ).values_list('loan_id', 'subscription')
+        )
+
+    @staticmethod
+    def total_outstanding(loan_amount, loan_fee, repaid, subscription_due):
+        """
+        Same calculation as Loan.total_outstanding, from pre-aggregated values.
+        Interest and penalty outstanding are always 0 for now (see Loan).
+        """
+        principal_outstanding = loan_amount - (repaid.get('principal') or 0)
+        fee_outstanding = loan_fee - (repaid.get('fee') or 0)
+        subscription_outstanding = (subscription_due or 0) - (repaid.get('subscription') or 0)
+        if subscription_outstanding < 0:
+            # same temp hack as Loan.total_outstanding
+            return -1
+        return principal_outstanding + fee_outstanding + subscription_outstanding
+
+    @property
+    def rows(self):
+        """
+        return a list of dicts, one per late loan, sorted by number of days late:
+        {'obj': loan, 'total_days_late': x, 'par_category': 'PAR 1-30', 'total_outstanding': y,
+         'is_subscription': bool, 'latest_repayment_date': date}
+        """
+        if self._rows is None:
+            delays = Loan.get_delays_for_loans(self.loans, self.date)
+            repaid = self._repaid_by_loan()
+            subscription_due = self._subscription_due_by_loan()
+            rows = []
+            for loan in self.loans.select_related('borrower__agent'):
+                days_late = (delays.get(loan.pk) or {}).get('current_delay', 0)
+                if days_late <= 0:
+                    continue
+                loan_repaid = repaid.get(loan.pk, {})
+                rows.append({
+                    'obj': loan,
+                    'total_days_late': days_late,
+                    'par_category': par_category(days_late),
+                    'total_outstanding': self.total_outstanding(
+                        loan.loan_amount, loan.loan_fee, loan_repaid, subscription_due.get(loan.pk)
+                    ),
+                    'is_subscription': (subscription_due.get(loan.pk) or 0) != 0,
+                    'latest_repayment_date': loan_repaid.get('last_date'),
+                })
+            rows.sort(key=lambda x: x['total_days_late'])
+            self._rows = rows
+        return self._rows
+
+    def iter_values(self, fields, chunk_size=2000):
+        """
+        Streaming version of `rows` for the exports: yield one dict per late loan, in pk order,
+        with the loan `fields` (values() names, eg: 'borrower__name_en') instead of the Loan object.
+        Only the per-loan aggregates (a few numbers per loan) are kept in memory, the loans
+        themselves are read `chunk_size` at a time.
+        """
+        delays = Loan.get_delays_for_loans(self.loans, self.date)
+        repaid = self._repaid_by_loan()
+        subscription_due = self._subscription_due_by_loan()
+        loans = self.loans.order_by('pk').values('pk', 'loan_amount', 'loan_fee', *fields)
+        for loan in loans.iterator(chunk_size=chunk_size):
+            days_late = (delays.get(loan['pk']) or {}).get('current_delay', 0)
+            if days_late <= 0:
+                continue
+            loan_repaid = repaid.get(loan['pk'], {})
+            loan.update({
+                'total_days_late': days_late,
+                'par_category': par_category(days_late),
+                'total_outstanding': self.total_outstanding(
+                    loan['loan_amount'], loan['loan_fee'], loan_repaid, subscription_due.get(loan['pk'])
+                ),
+                'is_subscription': (subscription_due.get(loan['pk']) or 0) != 0,
+                'latest_repayment_date': loan_repaid.get('last_date'),
+            })
+            yield loan
+
+    @property
+    def buckets(self):
+        """
+        return {par_category: {'count': number of loans, 'outstanding': total outstanding}}
+        for every PAR category, including empty ones
+        """
+        buckets = {name: {'count': 0, 'outstanding': 0} for name, _ in PAR_BUCKETS}
+        for row in self.rows:
+            buckets[row['par_category']]['count'] += 1
+            buckets[row['par_category']]['outstanding'] += row['total_outstanding']
+        return buckets
+
+    @property
+    def total_outstanding_at_risk(self):
+        return sum(row['total_outstanding'] for row in self.rows)
+
+
+# PortfolioSnapshot field prefix of each PAR category
+PAR_BUCKET_FIELDS = {
+    'PAR 1-30': 'par_1_30',
+    'PAR 31-60': 'par_31_60',
+    'PAR 61-90': 'par_61_90',
+    'PAR >90': 'par_over_90',
+}
+
+
+def build_portfolio_snapshot(date):
+    """
+    Write the PortfolioSnapshot rows of all agents for the end of `date`, replacing the existing ones.
+    Everything is computed from a fixed number of aggregate queries (the delays from 2 bulk queries,
+    see Loan.get_delays_for_loans), so `date` can also be a past day to rebuild the history.
+    A negative subscription outstanding (invalid schedule, see Loan.total_outstanding) counts as 0.
+    Return the list of snapshots created.
+    """
+    loans = Loan.objects.filter(
+        state__in=(LOAN_DISBURSED, LOAN_REPAID), contract_date__lte=date
+    ).filter(Q(repaid_on=None) | Q(repaid_on__gt=date))
+
+    repaid = {
+        r['loan_id']: r for r in Repayment.objects.filter(
+            loan__in=loans, date__lte=date
+        ).values('loan_id').annotate(
+            principal=Sum('principal'),
+            fee=Sum('fee'),
+            subscription=Sum('subscription'),
+        )
+    }
+    subscription_due = dict(
+        RepaymentScheduleLine.objects.filter(
+            loan__in=loans
+        ).values('loan_id').annotate(
+            subscription=Sum('subscription')
+        ).values_list('loan_id', 'subscription')
+    )
+    delays = Loan.get_delays_for_loans(loans, date)
+
+    snapshots = {}
+
+    def snapshot(agent_id):
+        if agent_id not in snapshots:
+            snapshots[agent_id] = PortfolioSnapshot(date=date, agent_id=agent_id)
+        return snapshots[agent_id]
+
+    for loan_id, agent_id, loan_amount, loan_fee in loans.values_list(
+            'pk', 'borrower__agent', 'loan_amount', 'loan_fee'):
+        loan_repaid = repaid.get(loan_id, {})
+        principal = loan_amount - (loan_repaid.get('principal') or 0)
+        fee = loan_fee - (loan_repaid.get('fee') or 0)
+        subscription = max((subscription_due.get(loan_id) or 0) - (loan_repaid.get('subscription') or 0), 0)
+        total = principal + fee + subscription
+
+        s = snapshot(agent_id)
+        s.active_loans += 1
+        s.principal_outstanding += principal
+        s.fee_outstanding += fee
+        s.subscription_outstanding += subscription
+        s.total_outstanding += total
+        days_late = (delays.get(loan_id) or {}).get('current_delay', 0)
+        if days_late > 0:
+            prefix = PAR_BUCKET_FIELDS[par_category(days_late)]
+            setattr(s, prefix + '_loans', getattr(s, prefix + '_loans') + 1)
+            setattr(s, prefix + '_outstanding', getattr(s, prefix + '_outstanding') + total)
+
+    # the lines of the loans repaid before `date` aren't due any more, the loans repaid on `date` were due
+    planned = RepaymentScheduleLine.objects.filter(
+        date=date, loan__state__in=(LOAN_DISBURSED, LOAN_REPAID)
+    ).filter(
+        Q(loan__repaid_on=None) | Q(loan__repaid_on__gte=date)
+    ).values('loan__borrower__agent').annotate(
+        total=Sum(F('principal') + F('fee') + F('interest') + F('penalty') + F('subscription'))
+    ).values_list('loan__borrower__agent', 'total')
+    for agent_id, total in planned:
+        snapshot(agent_id).planned = total
+    collected = Repayment.objects.filter(
+        date=date
+    ).values('loan__borrower__agent').annotate(
+        total=Sum('amount')
+    ).values_list('loan__borrower__agent', 'total')
+    for agent_id, total in collected:
+        snapshot(agent_id).collected = total
+    disbursed = Disbursement.objects.filter(
+        state=DISBURSEMENT_SENT, timestamp__date=date
+    ).values('disbursed_to').annotate(
+        total=Sum('amount')
+    ).values_list('disbursed_to', 'total')
+    for agent_id, total in disbursed:
+        snapshot(agent_id).disbursed = total
+
+    branches = dict(
+        Agent.objects.filter(pk__in=list(snapshots)).values_list('pk', 'field_officer__mfi_branch')
+    )
+    for agent_id, s in snapshots.items():
+        s.mfi_branch_id = branches.get(agent_id)
+
+    with transaction.atomic():
+        PortfolioSnapshot.objects.filter(date=date).delete()
+        return PortfolioSnapshot.objects.bulk_create(snapshots.values())
@@ -0,0 +1,66 @@
+from collections import namedtuple
+from datetime import timedelta
+from decimal import Decimal
+from .models import EQUAL_REPAYMENTS, Loan, LoanBalance, RepaymentScheduleLine
+
+# a planned repayment, before it is saved as a RepaymentScheduleLine
+ScheduleLine = namedtuple('ScheduleLine', ['date', 'principal', 'fee', 'interest', 'penalty'])
+
+
+class ScheduleGenerator(object):
+    """
+    Build the repayment schedule of a loan from its product parameters:
+    - one line per day from the day after `start_date`, `normal_repayment_amount` of principal each,
+      and a last line with `bullet_repayment_amount`
+    - in EQUAL_REPAYMENTS, `number_of_repayments` lines without bullet, whose principal and interest
+      are set later by Loan.update_attributes_for_lines()
+    - the fee is due with the first repayment, or on `start_date` if `fee_on_disbursement`
+    Interest is left at 0, it is computed by Loan.update_attributes_for_lines().
+
+    The lines are built in memory by lines(), and saved in one query by save().
+    """
+
+    def __init__(self, loan, start_date, fee_on_disbursement=False):
+        self.loan = loan
+        self.start_date = start_date
+        self.fee_on_disbursement = fee_on_disbursement
+
+    def lines(self):
+        """
+        return the schedule as a list of ScheduleLine, ordered by date
+        """
+        loan = self.loan
+        zero = Decimal(0)
+        if loan.loan_interest_type == EQUAL_REPAYMENTS:
+            principals = [zero] * loan.number_of_repayments
+        else:
+            no_of_lines = Loan.get_number_of_repayments(
+                loan.loan_amount, loan.normal_repayment_amount, loan.bullet_repayment_amount
+            )
+            principals = [loan.normal_repayment_amount] * (no_of_lines - 1) + [loan.bullet_repayment_amount]
+
+        lines = []
+        if self.fee_on_disbursement:
+            lines.append(ScheduleLine(self.start_date, zero, loan.loan_fee, zero, zero))
+        for line_no, principal in enumerate(principals):
+            fee = loan.loan_fee if line_no == 0 and not self.fee_on_disbursement else zero
+            lines.append(ScheduleLine(self.start_date + timedelta(days=line_no + 1), principal, fee, zero, zero))
+        return lines
+
+    def initial(self):
+        """
+        return the schedule as a list of dicts, eg: for the initial data of a formset
+        """
+        return [line._asdict() for line in self.lines()]
+
+    def save(self):
+        """
+        create the RepaymentScheduleLine of the loan in one query, refresh its LoanBalance, and return them
+        """
+        lines = RepaymentScheduleLine.objects.bulk_create(
+            [RepaymentScheduleLine(loan=self.loan, **line._asdict()) for line in self.lines()]
+        )
+        self.loan.invalidate_ledger()
+        Loan.bump_version([self.loan.pk])
+        LoanBalance.refresh([self.loan.pk])
+        return lines
@@ -1,5 +1,11 @@
 import graphene
+from collections import defaultdict
+from graphene.relay import PageInfo
 from graphene.types.datetime import Date
+from graphql import GraphQLError
+from graphql_relay.connection.arrayconnection import connection_from_list_slice
+from promise import Promise
+from promise.dataloader import DataLoader
 
 from graphene_django.types import DjangoObjectType
 from .decorators import permission_required
@@ -7,8 +13,79 @@ from .decorators import permission_required
 from .models import (BaseBorrowerSignature, Loan, PhotoSignature,
                      Repayment, RepaymentScheduleLine, LoanRequestReview)
 
+from borrowers.models import Borrower
 from django.contrib.auth.models import User
 
+# maximum number of objects per page of all_loans, all_repayments and all_repaymentschedulelines
+MAX_PAGE_SIZE = 100
+# maximum cost of a query, see query_cost()
+MAX_QUERY_COST = 3000
+# estimated number of objects in a nested list (eg: lines of a loan), used to calculate the cost of a query
+NESTED_LIST_COST = 30
+NESTED_LIST_FIELDS = ('lines', 'repayments', 'signatures')
+
+
+class ModelLoader(DataLoader):
+    """
+    Load objects of `model` by primary key, in one query for all the keys requested in the same tick
+    """
+
+    def __init__(self, model):
+        super(ModelLoader, self).__init__()
+        self.model = model
+
+    def batch_load_fn(self, keys):
+        objects = self.model.objects.in_bulk(keys)
+        return Promise.resolve([objects.get(key) for key in keys])
+
+
+class RelatedListLoader(DataLoader):
+    """
+    Load the list of objects of `model` whose ForeignKey `field` points to each key,
+    eg: the lines of several loans, in one query
+    """
+
+    def __init__(self, model, field, ordering=()):
+        super(RelatedListLoader, self).__init__()
+        self.model = model
+        self.field = field
+        self.ordering = ordering
+
+    def batch_load_fn(self, keys):
+        attname = self.model._meta.get_field(self.field).attname
+        grouped = defaultdict(list)
+        objects = self.model.objects.filter(**{attname + '__in': keys}).order_by(*self.ordering)
+        for obj in objects:
+            grouped[getattr(obj, attname)].append(obj)
+        return Promise.resolve([grouped[key] for key in keys])
+
+
+class Loaders(object):
+    """
+    The DataLoaders of a request, so that the relations of all the objects in a response are fetched
+    with one query per relation. Use get_loaders(info) to get them.
+    """
+
+    def __init__(self):
+        self.lines = RelatedListLoader(RepaymentScheduleLine, 'loan', ('date', 'pk'))
+        self.repayments = RelatedListLoader(Repayment, 'loan', ('date', 'pk'))
+        self.signatures = RelatedListLoader(BaseBorrowerSignature, 'loan', ('pk',))
+        self.photo_signatures = ModelLoader(PhotoSignature)
+        self.loans = ModelLoader(Loan)
+        self.borrowers = ModelLoader(Borrower)
+
+
+def get_loaders(info):
+    if not hasattr(info.context, 'loan_loaders'):
+        info.context.loan_loaders = Loaders()
+    return info.context.loan_loaders
+
+
+def load_or_none(loader, key):
+    if key is None:
+        return None
+    return loader.load(key)
+
 
 class BaseBorrowerSignatureType(DjangoObjectType):
     api_result = graphene.String()
@@ -21,20 +98,21 @@ class BaseBorrowerSignatureType(DjangoObjectType):
         """
         Get the api_result from the child PhotoSignature model
         """
-        photosig = self.photosignature
-        if photosig:
-            return photosig.api_result
-        return None
+        return get_loaders(info).photo_signatures.load(self.pk).then(
+            lambda photosig: photosig.api_result if photosig else None
+        )
 
     def resolve_photo(self, info):
         """
         Get the photo url field from the child PhotoSignature model, to avoid nesting the PhotoSignature
         See https://stackoverflow.com/questions/49737118/django-multi-table-inheritance-and-graphene/49737563#49737563
         """
-        photosig = self.photosignature
-        if photosig:
-            return photosig.photo
-        return None
+        return get_loaders(info).photo_signatures.load(self.pk).then(
+            lambda photosig: photosig.photo if photosig else None
+        )
+
+    def resolve_loan(self, info):
+        return get_loaders(info).loans.load(self.loan_id)
 
 
 class PhotoSignatureType(DjangoObjectType):
@@ -46,21 +124,114 @@ class PhotoSignatureType(DjangoObjectType):
 
 
 class LoanType(DjangoObjectType):
-    contract_due_date = Date(source='contract_due_date')
+    contract_due_date = Date()
+    lines = graphene.List(lambda: RepaymentScheduleLineType)
+    repayments = graphene.List(lambda: RepaymentType)
+    signatures = graphene.List(BaseBorrowerSignatureType)
 
     class Meta:
         model = Loan
 
+    def resolve_contract_due_date(self, info):
+        return get_loaders(info).lines.load(self.pk).then(lambda lines: lines[-1].date if lines else None)
+
+    def resolve_lines(self, info):
+        return get_loaders(info).lines.load(self.pk)
+
+    def resolve_repayments(self, info):
+        return get_loaders(info).repayments.load(self.pk)
+
+    def resolve_signatures(self, info):
+        return get_loaders(info).signatures.load(self.pk)
+
+    def resolve_borrower(self, info):
+        return get_loaders(info).borrowers.load(self.borrower_id)
+
+    def resolve_guarantor(self, info):
+        return load_or_none(get_loaders(info).borrowers, self.guarantor_id)
+
 
 class RepaymentType(DjangoObjectType):
     class Meta:
         model = Repayment
 
+    def resolve_loan(self, info):
+        return get_loaders(info).loans.load(self.loan_id)
+
 
 class RepaymentScheduleLineType(DjangoObjectType):
     class Meta:
         model = RepaymentScheduleLine
 
+    def resolve_loan(self, info):
+        return get_loaders(info).loans.load(self.loan_id)
+
+
+class LoanConnection(graphene.relay.Connection):
+    class Meta:
+        node = LoanType
+
+
+class RepaymentConnection(graphene.relay.Connection):
+    class Meta:
+        node = RepaymentType
+
+
+class RepaymentScheduleLineConnection(graphene.relay.Connection):
+    class Meta:
+        node = RepaymentScheduleLineType
+
+
+def query_cost(info, page_size):
+    """
+    Estimate the cost of a connection query: one per node, plus NESTED_LIST_COST for each
+    nested list (lines, repayments, signatures) requested on each node.
+    """
+    nested_lists = 0
+    for field in info.field_asts:
+        for edges in _sub_fields(field, 'edges'):
+            for node in _sub_fields(edges, 'node'):
+                nested_lists += len([f for f in _sub_fields(node) if f.name.value in NESTED_LIST_FIELDS])
+    return page_size * (1 + nested_lists * NESTED_LIST_COST)
+
+
+def _sub_fields(field, name=None):
+    if field.selection_set is None:
+        return []
+    return [
+        f for f in field.selection_set.selections
+        if hasattr(f, 'name') and f.name is not None and (name is None or f.name.value == name)
+    ]
+
+
+def connection_from_queryset(connection_type, queryset, info, **kwargs):
+    """
+    Return one page of `queryset` as a `connection_type`, fetching only that page from the database.
+    Reject queries without `first` or `last`, with pages bigger than MAX_PAGE_SIZE,
+    or costing more than MAX_QUERY_COST.
+    """
+    # `first: 0` is a valid (empty) page
+    page_size = kwargs.get('first') if kwargs.get('first') is not None else kwargs.get('last')
+    if page_size is None:
+        raise GraphQLError('`first` or `last` is required')
+    if page_size > MAX_PAGE_SIZE:
+        raise GraphQLError('Cannot request more than {} objects per page'.format(MAX_PAGE_SIZE))
+    cost = query_cost(info, page_size)
+    if cost > MAX_QUERY_COST:
+        raise GraphQLError('Query is too expensive ({} > {}), request smaller pages'.format(cost, MAX_QUERY_COST))
+
+    list_length = queryset.count()
+    return connection_from_list_slice(
+        queryset,
+        kwargs,
+        slice_start=0,
+        list_length=list_length,
+        list_slice_length=list_length,
+        connection_type=connection_type,
+        edge_type=connection_type.Edge,
+        pageinfo_type=PageInfo,
+    )
+
 
 class approveLoan(graphene.Mutation):
 
@@ -109,18 +280,60 @@ class Query(object):
                           id=graphene.Int(),
                           )
 
-    # query all loans (no filtering at all so far)
-    all_loans = graphene.List(LoanType)
-
-    # list all repayments/schedule lines
-    all_repayments = graphene.List(RepaymentType)
-    all_repaymentschedulelines = graphene.List(RepaymentScheduleLineType)
-
-    def resolve_all_loans(self, info, **kwargs):
-        return Loan.objects.all()
-
-    def resolve_all_repayments(self, info, **kwargs):
-        return Repayment.objects.select_related('loan').all()
+    # query all loans, one page at a time
+    all_loans = graphene.relay.ConnectionField(
+        LoanConnection,
+        state=graphene.String(),
+        agent=graphene.Int(),
+        start_date=Date(description='contract date on or after'),
+        end_date=Date(description='contract date on or before'),
+    )
+
+    # list all repayments/schedule lines, one page at a time
+    all_repayments = graphene.relay.ConnectionField(
+        RepaymentConnection,
+        agent=graphene.Int(),
+        start_date=Date(),
+        end_date=Date(),
+    )
+    all_repaymentschedulelines = graphene.relay.ConnectionField(
+        RepaymentScheduleLineConnection,
+        agent=graphene.Int(),
+        start_date=Date(),
+        end_date=Date(),
+    )
+
+    def resolve_all_loans(self, info, state=None, agent=None, start_date=None, end_date=None, **kwargs):
+        loans = Loan.objects.order_by('-pk')
+        if state is not None:
+            loans = loans.filter(state=state)
+        if agent is not None:
+            loans = loans.filter(borrower__agent=agent)
+        if start_date is not None:
+            loans = loans.filter(contract_date__gte=start_date)
+        if end_date is not None:
+            loans = loans.filter(contract_date__lte=end_date)
+        return connection_from_queryset(LoanConnection, loans, info, **kwargs)
+
+    def resolve_all_repayments(self, info, agent=None, start_date=None, end_date=None, **kwargs):
+        repayments = Repayment.objects.order_by('-date', '-pk')
+        if agent is not None:
+            repayments = repayments.filter(loan__borrower__agent=agent)
+        if start_date is not None:
+            repayments = repayments.filter(date__gte=start_date)
+        if end_date is not None:
+            repayments = repayments.filter(date__lte=end_date)
+        return connection_from_queryset(RepaymentConnection, repayments, info, **kwargs)
+
+    def resolve_all_repaymentschedulelines(self, info, agent=None, start_date=None, end_date=None, **kwargs):
+        lines = RepaymentScheduleLine.objects.order_by('-date', '-pk')
+        if agent is not None:
+            lines = lines.filter(loan__borrower__agent=agent)
+        if start_date is not None:
+            lines = lines.filter(date__gte=start_date)
+        if end_date is not None:
+            lines = lines.filter(date__lte=end_date)
+        return connection_from_queryset(RepaymentScheduleLineConnection, lines, info, **kwargs)
 
     def resolve_loan(self, info, **kwargs):
         id = kwargs.get('id')
@@ -5,9 +5,10 @@ from drf_extra_fields.fields import Base64ImageField
 from rest_framework import serializers
 from rest_framework.fields import DateField, DateTimeField, DecimalField
 from loans.models import Disbursement, Loan, LoanAlreadyRepaidError, LoanPurpose, LOAN_REQUEST_DRAFT, \
-    LOAN_REQUEST_SUBMITTED, Notification, Reconciliation, PhotoSignature, RepaymentScheduleLine, Repayment, RepaymentTooBigError, \
+    LOAN_REQUEST_SUBMITTED, Notification, Reconciliation, PhotoSignature, RepaymentScheduleLine, Repayment, RepaymentTooBigError, IdempotencyKeyConflictError, \
     ReasonForDelayedRepayment, WaveTransferDisbursement, BankTransferDisbursement, WaveTransferAndCashOutDisbursement, \
-    DISB_METHOD_WAVE_TRANSFER, DISB_METHOD_BANK_TRANSFER, DISB_METHOD_WAVE_N_CASH_OUT, DISBURSEMENT_SENT, LoanRequestReview, SuperUsertoLenderPayment
+    DISB_METHOD_WAVE_TRANSFER, DISB_METHOD_BANK_TRANSFER, DISB_METHOD_WAVE_N_CASH_OUT, DISBURSEMENT_SENT, LoanRequestReview, SuperUsertoLenderPayment, \
+    SyncTombstone, LoanBalance
 # import phonenumbers as pn
 from payments.models import Transfer
 from loans.custom_serializers import BorrowerSerializerVersion2, GuarantorSerializerVersion2
@@ -42,6 +43,27 @@ class ReasonForDelayedRepaymentSerializer(serializers.ModelSerializer):
         fields = ('id', 'reason_en', 'reason_mm')
 
 
+def repayment_error_detail(e):
+    """
+    return the error sent to the app for a RepaymentTooBigError, LoanAlreadyRepaidError or IdempotencyKeyConflictError
+    """
+    if isinstance(e, RepaymentTooBigError):
+        return {
+            'message': e.message,
+            'error': 'repayment_too_big',
+            'max_repayable': e.params['max_repayable'],
+        }
+    if isinstance(e, IdempotencyKeyConflictError):
+        return {
+            'message': e.message,
+            'error': 'idempotency_key_conflict',
+        }
+    return {
+        'message': e.message,
+        'error': 'loan_already_repaid',
+    }
+
+
 class RepaymentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Repayment
@@ -59,19 +81,10 @@ class RepaymentSerializer(serializers.ModelSerializer):
             # force the agent to be the logged in user
             validated_data['recorded_by'] = self.context['request'].user
             r = Repayment.objects.create(**validated_data)
-        except RepaymentTooBigError as e:
+        except (RepaymentTooBigError, LoanAlreadyRepaidError) as e:
             # convert this into an error that DRF will send to the client
             # instead of just dying with an error 500
-            raise serializers.ValidationError({
-                'message': e.message,
-                'error': 'repayment_too_big',
-                'max_repayable': e.params['max_repayable'],
-            })
-        except LoanAlreadyRepaidError as e:
-            raise serializers.ValidationError({
-                'message': e.message,
-                'error': 'loan_already_repaid',
-            })
+            raise serializers.ValidationError(repayment_error_detail(e))
         return r
 
     def to_representation(self, instance):
@@ -91,6 +104,20 @@ class RepaymentSerializer(serializers.ModelSerializer):
         return ret
 
 
+class BulkRepaymentSerializer(serializers.ModelSerializer):
+    """
+    One repayment of a bulk upload (see RepaymentViewSet.bulk_upload)
+    """
+    # duplicates are not an error, they are reported as such by loans.models.record_repayments()
+    idempotency_key = serializers.CharField(max_length=64)
+    # the loans are fetched all at once by the view
+    loan = serializers.IntegerField()
+
+    class Meta:
+        model = Repayment
+        fields = ('idempotency_key', 'date', 'amount', 'recorded_at', 'loan', 'reason_for_delay', 'note')
+
+
 class NewRepaymentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Repayment
@@ -132,7 +159,9 @@ class LoanSerializer(serializers.ModelSerializer):
     class Meta:
         model = Loan
         fields = '__all__'
-        read_only_fields = ('repaid_on', 'repayments',)
+        # version is bumped by the server only, it makes the ETag of the loan
+        # lines_updated_on is set by the nightly schedule update, which skips the loans updated today
+        read_only_fields = ('repaid_on', 'repayments', 'version', 'lines_updated_on',)
 
     def create(self, validated_data):
         """
@@ -147,8 +176,10 @@ class LoanSerializer(serializers.ModelSerializer):
                 validated_data['state'] = LOAN_REQUEST_SUBMITTED
             loan = Loan.objects.create(**validated_data)
             # TODO: transition DRAFT loans to SUBMITTED?
-            for line in lines:
-                RepaymentScheduleLine.objects.create(loan=loan, **line)
+            RepaymentScheduleLine.objects.bulk_create(
+                [RepaymentScheduleLine(loan=loan, **line) for line in lines]
+            )
+            LoanBalance.refresh([loan.pk])
         return loan
 
     def validate(self, data):
@@ -196,25 +227,49 @@ class LoanPUTSerializer(LoanSerializer):
         # make sure we don't leave the DB half updated
         with transaction.atomic():
             loan = super(LoanPUTSerializer, self).update(instance, validated_data)
-            new_lines = [l for l in request_lines if l.get('id', None) is None]
-            updated_lines = [l for l in request_lines if l.get('id', None) is not None]
-            updated_ids = [l.get('id', None) for l in updated_lines]
+            # diff the request against the current lines, and apply it with one query per operation
+            current_lines = {l.pk: l for l in instance.lines.all()}
+            unknown_ids = [l['id'] for l in request_lines if l.get('id') is not None and l['id'] not in current_lines]
+            if unknown_ids:
+                raise serializers.ValidationError(
+                    'Lines {} do not belong to this loan'.format(', '.join(str(pk) for pk in unknown_ids))
+                )
+            new_lines = [
+                RepaymentScheduleLine(loan=instance, **l) for l in request_lines if l.get('id', None) is None
+            ]
+            updated_lines = []
+            updated_fields = set()
+            for l in request_lines:
+                if l.get('id', None) is None:
+                    continue
+                line = current_lines[l['id']]
+                changed = [k for k in l.keys() if k != 'id' and getattr(line, k) != l[k]]
+                for k in changed:
+                    setattr(line, k, l[k])
+                if changed:
+                    updated_lines.append(line)
+                    updated_fields.update(changed)
+            updated_ids = set(l['id'] for l in request_lines if l.get('id', None) is not None)
 
             # delete old lines that are not in the request
-            for l in instance.lines.all():
-                if l.id not in updated_ids:
-                    l.delete()
+            deleted_ids = [pk for pk in current_lines if pk not in updated_ids]
+            if deleted_ids:
+                RepaymentScheduleLine.objects.filter(pk__in=deleted_ids).delete()
+            # keep a trace of the deleted lines for the delta sync of the app
+            SyncTombstone.record(RepaymentScheduleLine, deleted_ids, instance.borrower.agent)
 
             # update old lines that are in the request
-            for l in updated_lines:
-                line = RepaymentScheduleLine.objects.get(pk=l.get('id'))
-                for k in l.keys():
-                    setattr(line, k, l.get(k))
-                line.save()
+            if updated_lines:
+                RepaymentScheduleLine.stamp(updated_lines)
+                RepaymentScheduleLine.objects.bulk_update(updated_lines, sorted(updated_fields) + ['updated_at'])
 
             # save new lines
-            for l in new_lines:
-                RepaymentScheduleLine.objects.create(loan=instance, **l)
+            RepaymentScheduleLine.objects.bulk_create(new_lines)
+
+            if deleted_ids or updated_lines or new_lines:
+                Loan.bump_version([instance.pk])
+                instance.invalidate_ledger()
+            LoanBalance.refresh([instance.pk])
 
         return loan
 
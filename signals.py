@@ -4,11 +4,14 @@ from datetime import date
 import boto3
 import logging
 from django.contrib.auth.models import User
-from django.db.models import Sum
+from django.db import transaction
+from django.db.models import Q, Sum
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
-from loans.models import Repayment, SuperUsertoLenderPayment, NOT_RECONCILED, AUTO_RECONCILED, DefaultPrediction, Loan
+from django_fsm import TransitionNotAllowed
+from loans.models import Repayment, SuperUsertoLenderPayment, NOT_RECONCILED, AUTO_RECONCILED, \
+    NEED_MANUAL_RECONCILIATION, DefaultPrediction, Loan
 from loans.models import Reconciliation as Recon
 from api_backend.settings import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY
 
@@ -28,25 +31,66 @@ def validate_signature(sender, instance=None, created=None, update_fields=None,
         instance.save()
 
 
+@receiver(post_save, sender='borrowers.Borrower')
+def bump_borrower_loans_version(sender, instance=None, **kwargs):
+    """
+    the borrower and guarantor are nested in the full detail of a loan, so a change to them
+    must change the version (and ETag) of the loan
+    """
+    if kwargs['raw']:
+        return
+    Loan.bump_version(Loan.objects.filter(Q(borrower=instance) | Q(guarantor=instance)).values('pk'))
+
+
 def reconcile_with_intermediary(repayments, su2lenderpayments, reconciled_by=None, method=AUTO_RECONCILED):
     """
     connect `Repayment`s and `SuperUsertoLenderPayment`s via intermediary object
     intermediary object can contain additional info about reconciliation
+    The source states of all the objects are checked first (same rules as their set_reconciled transition),
+    then they are updated with one query per model, in a transaction holding a lock on their rows,
+    so that two concurrent reconciliations can't both reconcile the same object.
     :param repayments: Queryset of Repayment
     :param su2lenderpayments: Queryset of SuperUsertoLenderPayment
     :param reconciled_by: User object
     :param method: AUTO_RECONCILED (or) MANUAL_RECONCILED
     :return: Reconciliation object
     """
+    repayment_pks = [obj.pk for obj in repayments]
+    su2lenderpayment_pks = [obj.pk for obj in su2lenderpayments]
     if reconciled_by is None:
-        bot_user = User.objects.get(username='reconciliation_bot')
-        intermediary = Recon.objects.create(reconciled_by=bot_user)
-    else:
+        reconciled_by = User.objects.get(username='reconciliation_bot')
+    with transaction.atomic():
+        # the states are read with the rows locked (in pk order, to avoid deadlocks) until they are updated
+        repayment_states = dict(Repayment.objects.select_for_update().filter(
+            pk__in=repayment_pks
+        ).order_by('pk').values_list('pk', 'reconciliation_status'))
+        su2lenderpayment_states = dict(SuperUsertoLenderPayment.objects.select_for_update().filter(
+            pk__in=su2lenderpayment_pks
+        ).order_by('pk').values_list('pk', 'reconciliation_status'))
+        for state in repayment_states.values():
+            if state not in (NOT_RECONCILED, NEED_MANUAL_RECONCILIATION):
+                raise TransitionNotAllowed("Can't switch from state '{}' using method 'set_reconciled'".format(state))
+        for state in su2lenderpayment_states.values():
+            if state != NOT_RECONCILED:
+                raise TransitionNotAllowed("Can't switch from state '{}' using method 'set_reconciled'".format(state))
+
         intermediary = Recon.objects.create(reconciled_by=reconciled_by)
-    for obj in repayments:
-        obj.set_reconciled(intermediary, method)
-    for obj in su2lenderpayments:
-        obj.set_reconciled(intermediary, method)
+        Repayment.objects.filter(pk__in=repayment_states).update(
+            reconciliation=intermediary, reconciliation_status=method, updated_at=timezone.now()
+        )
+        SuperUsertoLenderPayment.objects.filter(pk__in=su2lenderpayment_states).update(
+            reconciliation=intermediary, reconciliation_status=method
+        )
+        Loan.bump_version(Repayment.objects.filter(reconciliation=intermediary).values('loan_id'))
+
+    logger = logging.getLogger('root')
+    logger.info('reconciliation', extra={
+        'reconciliation': intermediary.pk,
+        'method': method,
+        'reconciled_by': reconciled_by.pk,
+        'repayments': sorted(repayment_states),
+        'su2lpayments': sorted(su2lenderpayment_states),
+    })
     return intermediary
 
 
@@ -1,14 +1,24 @@
 from __future__ import absolute_import, unicode_literals
 # from celery import shared_task
+from celery import chord
 from api_backend.celery_app import celery_app
 from sms_gateway.models import WaveMoneyReceiveSMS
-from loans.models import Repayment, NOT_RECONCILED, AUTO_RECONCILED, NEED_MANUAL_RECONCILIATION, Loan
+from loans.models import Repayment, NOT_RECONCILED, AUTO_RECONCILED, NEED_MANUAL_RECONCILIATION, Loan, \
+    LOAN_DISBURSED, ScheduleUpdateRun, LoanBalance, PDFRender, PDF_RENDER_PENDING, PDF_RENDER_RUNNING, PDF_RENDER_DONE, \
+    PDF_RENDER_FAILED
 from loans.models import Reconciliation as Recon  # to avoid confusion with reconciliation function
-from datetime import datetime
-from django.db.models import Sum
+from loans.reports import build_portfolio_snapshot
+from datetime import date, datetime, timedelta
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import F, Sum
 from django.utils import timezone
+from io import BytesIO
 import logging
 import pytz
+import tempfile
+from PyPDF2 import PdfFileMerger
+from wkhtmltopdf.utils import convert_to_pdf, make_absolute_paths
 from django.contrib.auth.models import User
 
 
@@ -41,35 +51,52 @@ def reconciliation(args):
       are set to AUTO_RECONCILED
     """
     try:
-        # remove sms from future
-        receive_sms = WaveMoneyReceiveSMS.objects.filter(reconciliation_status=NOT_RECONCILED, sent_at__lte=timezone.now())
-        local_date = timezone.localtime(timezone.now(), pytz.timezone('Asia/Rangoon')).date()
+        local_tz = pytz.timezone('Asia/Rangoon')
+        local_date = timezone.localtime(timezone.now(), local_tz).date()
+        # datetime are stored in UTC but we need to compare in local time
+        local_midnight = local_tz.localize(datetime.combine(local_date, datetime.min.time()))
+
         # set reconciliation_status = NEED_MANUAL_RECONCILIATION for
         # receive sms(NOT_RECONCILED) from past (local time zone)
-        for wm_receive in receive_sms:
-            # datetime are stored in UTC but we need to compare in local time
-            wm_receive_local_date = timezone.localtime(wm_receive.sent_at, pytz.timezone('Asia/Rangoon')).date()
-            if wm_receive_local_date < local_date:
-                wm_receive.set_need_manual_reconciliation()
-        receive_sms = receive_sms.exclude(reconciliation_status=NEED_MANUAL_RECONCILIATION)
+        WaveMoneyReceiveSMS.objects.filter(
+            reconciliation_status=NOT_RECONCILED, sent_at__lt=local_midnight
+        ).update(reconciliation_status=NEED_MANUAL_RECONCILIATION)
 
         # set reconciliation_status = NEED_MANUAL_RECONCILIATION for repayment(NOT_RECONCILED)
         # that do not reconcile until local midnight
-        for repay in Repayment.objects.filter(reconciliation_status=NOT_RECONCILED):
-            if repay.date < local_date:
-                repay.set_need_manual_reconciliation()
+        stale_repayments = Repayment.objects.filter(reconciliation_status=NOT_RECONCILED, date__lt=local_date)
+        Loan.bump_version(stale_repayments.values('loan_id'))
+        stale_repayments.update(reconciliation_status=NEED_MANUAL_RECONCILIATION, updated_at=timezone.now())
 
         # reconciliation
+        # total of the pending repayments by (agent wave money number, date), in one query
+        pending_totals = {
+            (row['loan__borrower__agent__wave_money_number'], row['date']): row['total']
+            for row in Repayment.objects.filter(
+                reconciliation_status=NOT_RECONCILED, date__lte=local_date  # remove repayments from future
+            ).values('loan__borrower__agent__wave_money_number', 'date').annotate(total=Sum('amount'))
+        }
+        # remove sms from future
+        receive_sms = WaveMoneyReceiveSMS.objects.filter(
+            reconciliation_status=NOT_RECONCILED, sent_at__lte=timezone.now()
+        ).order_by('sent_at')
         # bot user to set for intermediary model
         bot_user = User.objects.get(username='reconciliation_bot')
-        for wm_receive in receive_sms:
-            repayment_set = repayments_by_sender(wm_receive.sender)
-            if wm_receive.amount == repayment_set.aggregate(Sum('amount'))['amount__sum']:
-                # intermediary model
-                intermediary = Recon.objects.create(reconciled_by=bot_user)
-                wm_receive.set_auto_reconciled(intermediary)
-                for repay in repayment_set:
-                    repay.set_auto_reconciled(intermediary)
+        with transaction.atomic():
+            for wm_receive in receive_sms:
+                key = (wm_receive.sender, timezone.localtime(wm_receive.sent_at, local_tz).date())
+                if key in pending_totals and wm_receive.amount == pending_totals[key]:
+                    # the repayments can only be reconciled with one sms
+                    del pending_totals[key]
+                    # intermediary model
+                    intermediary = Recon.objects.create(reconciled_by=bot_user)
+                    wm_receive.set_auto_reconciled(intermediary)
+                    repayments_by_sender(wm_receive.sender).filter(date=key[1]).update(
+                        reconciliation=intermediary,
+                        reconciliation_status=AUTO_RECONCILED,
+                        updated_at=timezone.now()
+                    )
+                    Loan.bump_version(Repayment.objects.filter(reconciliation=intermediary).values('loan_id'))
     except Exception as e:
         logger = logging.getLogger('root')
         logger.error('reconciliation error', exc_info=True, extra={
@@ -77,14 +104,183 @@ def reconciliation(args):
         })
 
 
+# number of loans updated by each update_attributes_for_loans_lines_chunk task
+SCHEDULE_UPDATE_CHUNK_SIZE = 500
+
+
 @celery_app.task(bind=True)
-def update_attributes_for_loans_lines(args):
+def update_attributes_for_loans_lines(args, chunk_size=SCHEDULE_UPDATE_CHUNK_SIZE):
     """
     Just after midnight, call this function.
     adjust attributes for loan's RepaymentsScheduleLine
+    The active disbursed loans are split in chunks of `chunk_size` loans, updated in parallel
+    by update_attributes_for_loans_lines_chunk tasks, and the progress is kept in a ScheduleUpdateRun.
+    If the run is interrupted (eg: a worker died), calling this again the same day only
+    updates the loans which were not updated yet.
+    """
+    today = date.today()
+    run, created = ScheduleUpdateRun.objects.get_or_create(date=today)
+    loan_ids = list(
+        Loan.objects.filter(
+            state=LOAN_DISBURSED, repaid_on=None
+        ).exclude(
+            lines_updated_on=today
+        ).order_by('pk').values_list('pk', flat=True)
+    )
+    if created:
+        run.loans_total = len(loan_ids)
+    run.finished_at = None
+    run.save()
+
+    chunks = [loan_ids[i:i + chunk_size] for i in range(0, len(loan_ids), chunk_size)]
+    if not chunks:
+        finish_schedule_update_run(run.pk)
+        return
+    chord(
+        update_attributes_for_loans_lines_chunk.si(run.pk, chunk) for chunk in chunks
+    )(finish_schedule_update_run.si(run.pk))
+
+
+@celery_app.task(bind=True)
+def update_attributes_for_loans_lines_chunk(args, run_pk, loan_ids):
+    """
+    Update the schedule lines of the loans in `loan_ids` within one transaction,
+    and add the number of loans processed and failed to the ScheduleUpdateRun.
+    A loan that fails is rolled back alone and logged, the rest of the chunk is saved.
+    """
+    run = ScheduleUpdateRun.objects.get(pk=run_pk)
+    processed = failures = 0
+    with transaction.atomic():
+        loans = Loan.objects.filter(
+            pk__in=loan_ids, state=LOAN_DISBURSED, repaid_on=None
+        ).exclude(
+            lines_updated_on=run.date
+        )
+        # no prefetch: update_attributes_for_lines() reloads the lines and repayments of each loan anyway
+        for ln in loans:
+            try:
+                with transaction.atomic():
+                    ln.update_attributes_for_lines()
+                    Loan.objects.filter(pk=ln.pk).update(lines_updated_on=run.date, version=F('version') + 1)
+                processed += 1
+            except Exception as e:
+                failures += 1
+                logger = logging.getLogger('root')
+                logger.error('schedule lines update error', exc_info=True, extra={
+                    'error': e,
+                    'loan': ln.pk,
+                })
+        # interest and days late change every day
+        LoanBalance.refresh(loan_ids)
+        ScheduleUpdateRun.objects.filter(pk=run_pk).update(
+            loans_processed=F('loans_processed') + processed,
+            failures=F('failures') + failures,
+        )
+
+
+@celery_app.task(bind=True)
+def finish_schedule_update_run(args, run_pk):
+    """
+    called when all the chunks of the run are done
+    """
+    ScheduleUpdateRun.objects.filter(pk=run_pk).update(finished_at=timezone.now())
+
+
+@celery_app.task(bind=True)
+def refresh_loan_balances_chunk(args, loan_ids):
+    """
+    Refresh the LoanBalance of the loans in `loan_ids`, see the rebuild_loan_balances command
+    """
+    LoanBalance.refresh(loan_ids)
+
+
+@celery_app.task(bind=True)
+def portfolio_snapshot(args, day=None):
+    """
+    Just after midnight, call this function.
+    Write the PortfolioSnapshot rows of yesterday, or of `day` (YYYY-MM-DD) to rebuild a past day.
+    """
+    if day is None:
+        day = date.today() - timedelta(days=1)
+    else:
+        day = datetime.strptime(day, '%Y-%m-%d').date()
+    try:
+        build_portfolio_snapshot(day)
+    except Exception as e:
+        logger = logging.getLogger('root')
+        logger.error('portfolio snapshot error', exc_info=True, extra={
+            'error': e,
+            'date': day,
+        })
+
+
+# celery queue of the PDF renderer workers. Run a dedicated worker with a small concurrency on it
+# to bound the number of wkhtmltopdf processes, eg: celery worker -Q pdf --concurrency=2
+PDF_QUEUE = 'pdf'
+
+
+@celery_app.task(bind=True)
+def render_pdf(args, pdf_pk, html, cmd_options):
     """
-    pass
-    # FIXME: this requires interest calculation to be fixed to work
-    # for ln in Loan.objects.all():
-    #    if ln.repaid_on is not None:
-    #        ln.update_attributes_for_lines()
+    Convert `html` to a PDF with wkhtmltopdf and store it in the PDFRender (see loans.pdf)
+    """
+    # started_at is reset, so a render that waited long in the queue is not restarted while it runs
+    PDFRender.objects.filter(pk=pdf_pk).update(state=PDF_RENDER_RUNNING, started_at=timezone.now())
+    pdf = PDFRender.objects.get(pk=pdf_pk)
+    try:
+        with tempfile.NamedTemporaryFile(suffix='.html') as html_file:
+            html_file.write(make_absolute_paths(html).encode())
+            html_file.flush()
+            content = convert_to_pdf(html_file.name, cmd_options=cmd_options)
+        pdf.file.save(pdf.filename, ContentFile(content), save=False)
+        pdf.state = PDF_RENDER_DONE
+        pdf.finished_at = timezone.now()
+        pdf.save()
+    except Exception as e:
+        PDFRender.objects.filter(pk=pdf_pk).update(state=PDF_RENDER_FAILED, error=str(e), finished_at=timezone.now())
+        logger = logging.getLogger('root')
+        logger.error('pdf render error', exc_info=True, extra={
+            'error': e,
+            'pdf': pdf.filename,
+        })
+
+
+# how long merge_pdfs waits for parts rendered by other requests, in seconds
+MERGE_PDFS_RETRY_DELAY = 5
+MERGE_PDFS_MAX_RETRIES = 120
+
+
+@celery_app.task(bind=True, max_retries=MERGE_PDFS_MAX_RETRIES)
+def merge_pdfs(args, pdf_pk, part_keys):
+    """
+    Concatenate the PDFRenders with keys `part_keys`, in that order, into the PDFRender `pdf_pk`
+    (see pdf.batch_pdf_response). Waits for the parts that are still being rendered.
+    """
+    pdf = PDFRender.objects.get(pk=pdf_pk)
+    parts = PDFRender.objects.in_bulk(part_keys, field_name='key')
+    states = set(part.state for part in parts.values())
+    if states & {PDF_RENDER_PENDING, PDF_RENDER_RUNNING} and args.request.retries < args.max_retries:
+        raise args.retry(countdown=MERGE_PDFS_RETRY_DELAY)
+
+    PDFRender.objects.filter(pk=pdf_pk).update(state=PDF_RENDER_RUNNING, started_at=timezone.now())
+    try:
+        failed = [parts[key].filename for key in part_keys if parts[key].state != PDF_RENDER_DONE]
+        if failed:
+            raise ValueError('documents not rendered: {}'.format(', '.join(failed)))
+        merger = PdfFileMerger()
+        for key in part_keys:
+            with parts[key].file.open('rb') as part_file:
+                merger.append(BytesIO(part_file.read()))
+        content = BytesIO()
+        merger.write(content)
+        pdf.file.save(pdf.filename, ContentFile(content.getvalue()), save=False)
+        pdf.state = PDF_RENDER_DONE
+        pdf.finished_at = timezone.now()
+        pdf.save()
+    except Exception as e:
+        PDFRender.objects.filter(pk=pdf_pk).update(state=PDF_RENDER_FAILED, error=str(e), finished_at=timezone.now())
+        logger = logging.getLogger('root')
+        logger.error('pdf merge error', exc_info=True, extra={
+            'error': e,
+            'pdf': pdf.filename,
+        })
@@ -1,9 +1,10 @@
-from datetime import date, timedelta
+from datetime import date
 import random
 import factory
 from borrowers.models import Agent, Borrower, Market, EducationLevel, BusinessType
-from loans.models import Loan, Repayment, RepaymentScheduleLine, Disbursement, ACTUAL_360, ACTUAL_365, EQUAL_REPAYMENTS, \
-    DISB_METHOD_WAVE_TRANSFER, DISB_METHOD_BANK_TRANSFER, DISB_METHOD_WAVE_N_CASH_OUT
+from loans.models import Loan, Repayment, RepaymentScheduleLine, Disbursement, DISB_METHOD_WAVE_TRANSFER, \
+    DISB_METHOD_BANK_TRANSFER, DISB_METHOD_WAVE_N_CASH_OUT
+from loans.schedules import ScheduleGenerator
 from zw_utils.models import Currency
 from django.contrib.auth.models import User
 import math
@@ -93,51 +94,15 @@ class LoanFactory(factory.django.DjangoModelFactory):
     bullet_repayment_amount = 1000
 
     @factory.post_generation
-    def loans_lines(self, auto_create_lines=True, fee_on_disbursement=False, **kwargs):
-        if auto_create_lines:
-            # FIXME: no error handling for now, this is only used for testing!
-            no_of_lines = int((self.loan_amount - self.bullet_repayment_amount) / self.normal_repayment_amount)
-            # in EQUAL_REPAYMENTS, normal_repayment_amount = principal + interest
-            if self.loan_interest_type == EQUAL_REPAYMENTS:
-                no_of_lines = self.number_of_repayments
-
-            for line_number in range(1, no_of_lines + 1):
-                if line_number == 1:
-                    fee = self.loan_fee * (not fee_on_disbursement)
-                else:
-                    fee = 0
-
-                if self.loan_interest_type == ACTUAL_360 or self.loan_interest_type == ACTUAL_365:
-                    # principal and interest will be take care by update_attributes_for_lines function below
-                    self.lines.add(RepaymentScheduleLineFactory.create(
-                        loan=self,
-                        date=self.uploaded_at + timedelta(days=line_number),
-                        principal=self.normal_repayment_amount,
-                        fee=fee,
-                    ))
-                elif self.loan_interest_type == EQUAL_REPAYMENTS:
-                    # principal and interest will be take care by update_attributes_for_lines function below
-                    self.lines.add(RepaymentScheduleLineFactory.create(
-                        loan=self,
-                        date=self.uploaded_at + timedelta(days=line_number),
-                        fee=fee,
-                    ))
-
-            if fee_on_disbursement:
-                # add a line on the request upload day
-                self.lines.add(RepaymentScheduleLineFactory.create(
-                    loan=self,
-                    date=self.uploaded_at,
-                    fee=self.loan_fee
-                ))
-
-            # for now, do not consider bullet in EQUAL_REPAYMENTS
-            if self.loan_interest_type != EQUAL_REPAYMENTS:
-                self.lines.add(RepaymentScheduleLineFactory.create(
-                    loan=self,
-                    date=self.uploaded_at + timedelta(days=no_of_lines + 1),
-                    principal=self.bullet_repayment_amount
-                ))
+    def loans_lines(self, create, extracted, fee_on_disbursement=False, **kwargs):
+        """
+        create the schedule lines of the loan, unless called with LoanFactory(loans_lines=False)
+        the fee is collected on the upload day with LoanFactory(loans_lines__fee_on_disbursement=True)
+        """
+        if not create or extracted is False:
+            return
+        # in EQUAL_REPAYMENTS, principal and interest will be take care by update_attributes_for_lines
+        ScheduleGenerator(self, self.uploaded_at, fee_on_disbursement=fee_on_disbursement).save()
             # set (principal and) interest for loan lines
             #self.update_attributes_for_lines()
 
@@ -1,29 +1,43 @@
 import base64
+import csv
 from datetime import date, datetime, timedelta
 import factory
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.urls import reverse
 from freezegun import freeze_time
+from io import StringIO
 import json
 from PIL import Image
 import tempfile
-from django.test import TestCase
+from django.db import IntegrityError, connection
+from django.db.models import Sum
+from django.db.models.signals import post_save
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 from freezegun import freeze_time
 from borrowers.models import Borrower
-from loans.signals import reconciliation_by_superuser
+from loans.signals import reconcile_with_intermediary, reconciliation_by_superuser
 from payments.models import Transfer, WavePaysbuyPayment
 from .models import Currency, Loan, LoanState, RepaymentScheduleLine, Repayment, RepaymentTooBigError, \
     ReasonForDelayedRepayment, NOT_RECONCILED, AUTO_RECONCILED, MANUAL_RECONCILED, NEED_MANUAL_RECONCILIATION, \
     LOAN_DISBURSED, LOAN_REQUEST_SUBMITTED, Disbursement, DISB_METHOD_WAVE_TRANSFER, DISB_METHOD_BANK_TRANSFER, \
     DISB_METHOD_WAVE_N_CASH_OUT, DISBURSEMENT_SENT, LOAN_REQUEST_APPROVED, FeeNotPaidError, DISBURSEMENT_REQUESTED, LOAN_REQUEST_SIGNED, LoanRequestReview, LOAN_REQUEST_REJECTED, SuperUsertoLenderPayment, \
-    Reconciliation
+    Reconciliation, ScheduleUpdateRun, SyncTombstone, recompute_breakdowns, LoanBalance, PortfolioSnapshot, \
+    PDFRender, PDF_RENDER_DONE, PDF_RENDER_PENDING, ScheduleShift, LOAN_REPAID, PhotoSignature, record_repayments, \
+    IdempotencyKeyConflictError, PDF_RENDER_RUNNING, PDF_RENDER_TIMEOUT
 from .models import Reconciliation as Recon, ACTUAL_360, ACTUAL_365, EQUAL_REPAYMENTS, MONTHLY, YEARLY
-from .serializers import RepaymentSerializer
+from .reports import PortfolioAtRisk, build_portfolio_snapshot, par_category
+from .schedules import ScheduleGenerator
+from .serializers import LoanSerializer, RepaymentSerializer
+from .views import agents_today_rows, get_collection_sheet_context, loan_sheet_rows
 from .test_factories import BorrowerFactory, CurrencyFactory, LoanFactory, RepaymentFactory, AgentFactory, UserFactory, DisbursementFactory
 from sms_gateway.models import SMSMessage, WaveMoneyReceiveSMS
-from .tasks import repayments_by_sender, reconciliation
+from .tasks import repayments_by_sender, reconciliation, update_attributes_for_loans_lines_chunk
 from django.utils import timezone
 import pytz
 from django.contrib.auth.models import Permission, User
@@ -31,7 +45,7 @@ import phonenumbers as pn
 from django.core.exceptions import ValidationError
 from payments.test_factories import TransferFactory, SuperUsertoLenderPaymentFactory
 from string import Template
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 import requests
 from django_fsm import TransitionNotAllowed
 from faker import Faker
@@ -52,6 +66,41 @@ class LoanContractingTests(TestCase):
         self.assertEqual(l.fee_outstanding, 1250)
         self.assertEqual(l.principal_outstanding, 40000)
 
+    def test_outstanding_properties_share_one_ledger(self):
+        """
+        Reading all outstanding properties of a loan only loads its lines and repayments once,
+        and saving a repayment invalidates the snapshot.
+        """
+        with freeze_time(date(2016, 10, 27)):
+            loan = LoanFactory(
+                loan_amount=10000,
+                normal_repayment_amount=1000,
+                bullet_repayment_amount=1000,
+                loan_fee=200
+            )
+        loan = Loan.objects.get(pk=loan.pk)
+        with self.assertNumQueries(2):
+            self.assertEqual(loan.principal_outstanding, 10000)
+            self.assertEqual(loan.fee_outstanding, 200)
+            self.assertEqual(loan.subscription_outstanding, 0)
+            self.assertEqual(loan.total_outstanding, 10200)
+            self.assertFalse(loan.is_subscription)
+            self.assertEqual(loan.sum_of_subscription, 0)
+            self.assertEqual(loan.contract_due_date, date(2016, 11, 6))
+            self.assertIsNone(loan.latest_repayment_date)
+
+        Repayment(loan=loan, date=date(2016, 10, 28), amount=1200).save()
+        self.assertEqual(loan.principal_outstanding, 9000)
+        self.assertEqual(loan.fee_outstanding, 0)
+        self.assertEqual(loan.total_outstanding, 9000)
+        self.assertEqual(loan.latest_repayment_date, date(2016, 10, 28))
+
+        # the prefetched repayments are reloaded too
+        loan = Loan.objects.prefetch_related('lines', 'repayments').get(pk=loan.pk)
+        self.assertEqual(loan.principal_outstanding, 9000)
+        Repayment(loan=loan, date=date(2016, 10, 29), amount=1000).save()
+        self.assertEqual(loan.principal_outstanding, 8000)
+
     def test_repayment_breakdown_with_amount_due(self):
         """
         Verify that outstanding amounts and repayment breakdown are ok. Twice.
@@ -244,6 +293,32 @@ class LoanContractingTests(TestCase):
         self.assertEqual(loan.principal_outstanding, 10000 - 3 * 2000 - 800)
         self.assertEqual(loan.fee_outstanding, 0)
 
+    def test_recompute_breakdowns(self):
+        """
+        recompute_breakdowns() only writes the posterior repayments whose breakdown changed,
+        with a constant number of queries
+        """
+        with freeze_time(date(2016, 10, 27)):
+            loan = LoanFactory(
+                loan_amount=10000,
+                normal_repayment_amount=2000,
+                bullet_repayment_amount=2000,
+                loan_fee=1200
+            )
+        for day in range(29, 32):
+            Repayment(loan=loan, date=date(2016, 10, day), amount=2000).save()
+        # bypass save() so the posterior repayments are not updated
+        Repayment.objects.create(
+            loan=loan, date=date(2016, 10, 28), amount=2000,
+            fee=1200, principal=800, interest=0, penalty=0, subscription=0
+        )
+        with self.assertNumQueries(4):
+            updated = recompute_breakdowns(loan, date(2016, 10, 28))
+        self.assertEqual([r.date for r in updated], [date(2016, 10, 29)])
+        self.assertEqual(updated[0].fee, 0)
+        self.assertEqual(updated[0].principal, 2000)
+        self.assertEqual(recompute_breakdowns(loan, date(2016, 10, 28)), [])
+
     def test_close_loan_with_non_ordered_repayment(self):
         """
         Verify the `repaid_on` date is set correctly even if the loan is closed
@@ -532,6 +607,57 @@ class LoanContractingTests(TestCase):
             self.assertEqual(loan.current_delay_at(date.today() - timedelta(days=1)), 5)
             self.assertEqual(loan.current_delay_at(date.today()), 5)
 
+    def test_get_delays_for_loans(self):
+        """
+        the bulk delay calculation must give the same results as the per loan properties
+        """
+        with freeze_time(date(2016, 10, 27)):
+            late_loan = LoanFactory(
+                loan_amount=9000,
+                normal_repayment_amount=3000,
+                bullet_repayment_amount=3000,
+                loan_fee=200
+            )
+            loan = LoanFactory(
+                loan_amount=10000,
+                normal_repayment_amount=1000,
+                bullet_repayment_amount=1000,
+                loan_fee=200
+            )
+        Repayment(loan=loan, date=date(2016, 10, 28), amount=2200).save()
+        with freeze_time('2016-10-31'):
+            with self.assertNumQueries(2):
+                delays = Loan.get_delays_for_loans(Loan.objects.all())
+            self.assertEqual(delays[late_loan.pk], {'days_late': 3, 'current_delay': 3})
+            self.assertEqual(delays[loan.pk], {'days_late': 1, 'current_delay': 1})
+            for l in (late_loan, loan):
+                self.assertEqual(delays[l.pk], l.delays)
+
+    def test_update_attributes_for_lines_in_bulk(self):
+        """
+        the whole schedule is recalculated from one load of lines and repayments and saved with one query
+        (plus one to increment the loan version)
+        """
+        with freeze_time('2017-3-1'):
+            ln = LoanFactory(
+                loan_amount=30000,
+                normal_repayment_amount=10000,
+                bullet_repayment_amount=10000,
+                loan_interest_rate=2.5,
+                loan_interest_type=ACTUAL_360,
+                loan_fee=0
+            )
+        with freeze_time('2017-3-2'):
+            with self.assertNumQueries(4):
+                ln.update_attributes_for_lines()
+            lines = ln.lines.all()
+            self.assertEqual(lines.get(date=date(2017, 3, 2)).interest, ln.calculate_interest(30000))
+            self.assertEqual(lines.get(date=date(2017, 3, 3)).interest, ln.calculate_interest(20000))
+            self.assertEqual(lines.get(date=date(2017, 3, 4)).interest, ln.calculate_interest(10000))
+            # nothing changed, nothing to save
+            with self.assertNumQueries(2):
+                ln.update_attributes_for_lines()
+
     def test_next_disbursement_date_with_no_repayment(self):
         with freeze_time(date(2016, 10, 31)):
             loan = LoanFactory(
@@ -2201,6 +2327,188 @@ class LoanAPITests(APITestCase):
         response = self.client.put('/api/v1/repayments/', RepaymentSerializer(r).data)
         self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
 
+    def test_bulk_repayment_upload(self):
+        initial_date = date(2016, 10, 27)
+        with freeze_time(initial_date):
+            loan = LoanFactory(
+                loan_amount=10000,
+                normal_repayment_amount=1000,
+                bullet_repayment_amount=1000,
+                loan_fee=200
+            )
+            other_loan = LoanFactory()
+        payload = [
+            {'idempotency_key': 'k2', 'loan': loan.pk, 'date': '2016-10-29', 'amount': '1000'},
+            {'idempotency_key': 'k1', 'loan': loan.pk, 'date': '2016-10-28', 'amount': '1200'},
+            {'idempotency_key': 'k3', 'loan': other_loan.pk, 'date': '2016-10-28', 'amount': '1000'},
+            {'idempotency_key': 'k4', 'loan': loan.pk, 'date': '2016-10-28'},
+            {'idempotency_key': 'k5', 'loan': loan.pk, 'date': '2016-10-30', 'amount': '100000'},
+        ]
+        self.client.force_authenticate(user=loan.borrower.agent.user)
+        response = self.client.post('/api/v1/repayments/bulk/', payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([r['status'] for r in response.data], ['created', 'created', 'error', 'error', 'error'])
+        self.assertEqual(response.data[2]['errors'], {'loan': ['Loan not found.']})
+        self.assertEqual(response.data[4]['errors']['error'], 'repayment_too_big')
+
+        # broken down in date order, as if they were saved one by one
+        first = Repayment.objects.get(idempotency_key='k1')
+        self.assertEqual((first.fee, first.principal), (200, 1000))
+        second = Repayment.objects.get(idempotency_key='k2')
+        self.assertEqual((second.fee, second.principal), (0, 1000))
+        self.assertEqual(second.recorded_by, loan.borrower.agent.user)
+        self.assertEqual(response.data[0]['repayment']['id'], second.pk)
+
+        # uploading again doesn't record anything twice
+        response = self.client.post('/api/v1/repayments/bulk/', payload[:2], format='json')
+        self.assertEqual([r['status'] for r in response.data], ['duplicate', 'duplicate'])
+        self.assertEqual(response.data[1]['repayment']['id'], first.pk)
+        self.assertEqual(Repayment.objects.count(), 2)
+
+        # a key of another loan is an error, the other loan's repayment is not sent back
+        [(repayment, error)] = record_repayments(
+            other_loan, [Repayment(loan=other_loan, date=date(2016, 10, 28), amount=100, idempotency_key='k1')]
+        )
+        self.assertIsInstance(error, IdempotencyKeyConflictError)
+        self.assertIsNone(repayment.pk)
+        self.assertEqual(Repayment.objects.count(), 2)
+
+        # a key recorded concurrently for another loan, after the keys were checked: the keys are checked again
+        from . import models
+        save_repayments = models._record_repayments
+
+        def concurrent_upload(loan_uploaded, repayments):
+            if not Repayment.objects.filter(idempotency_key='k6').exists():
+                Repayment.objects.bulk_create(
+                    [Repayment(loan=loan, date=date(2016, 10, 30), amount=100, idempotency_key='k6')]
+                )
+                raise IntegrityError('duplicate key value violates unique constraint')
+            return save_repayments(loan_uploaded, repayments)
+
+        with patch('loans.models._record_repayments', side_effect=concurrent_upload):
+            [(repayment, error)] = record_repayments(
+                other_loan, [Repayment(loan=other_loan, date=date(2016, 10, 28), amount=100, idempotency_key='k6')]
+            )
+        self.assertIsInstance(error, IdempotencyKeyConflictError)
+        self.assertEqual(Repayment.objects.filter(idempotency_key='k6').get().loan, loan)
+
+    def test_loan_list_pagination_and_summary(self):
+        with freeze_time(date(2016, 10, 31)):
+            loan = LoanFactory(loan_amount=10000, normal_repayment_amount=1000, bullet_repayment_amount=1000)
+            LoanFactory(borrower__agent=loan.borrower.agent, loan_amount=5000, normal_repayment_amount=1000,
+                        bullet_repayment_amount=1000)
+        self.client.force_authenticate(user=loan.borrower.agent.user)
+
+        # without opt-in, the full list is returned, as before
+        response = self.client.get('/api/v1/loans/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 2)
+        self.assertIn('lines', response.data[0])
+
+        response = self.client.get('/api/v1/loans/', {'page_size': 1})
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 1)
+
+        response = self.client.get('/api/v1/loans/', {'view': 'summary'})
+        self.assertEqual(len(response.data), 2)
+        self.assertNotIn('lines', response.data[0])
+        self.assertIn('days_late', response.data[0])
+
+    def test_loan_delta_sync(self):
+        with freeze_time('2016-10-31 10:00:00'):
+            loan = LoanFactory(loan_amount=10000, normal_repayment_amount=1000, bullet_repayment_amount=1000)
+            other_loan = LoanFactory(borrower__agent=loan.borrower.agent, loan_amount=5000,
+                                     normal_repayment_amount=1000, bullet_repayment_amount=1000)
+        self.client.force_authenticate(user=loan.borrower.agent.user)
+        with freeze_time('2016-11-01 10:00:00'):
+            response = self.client.get('/api/v1/loans/', {'since': '2016-10-30T10:00:00+00:00'})
+            self.assertEqual(len(response.data['results']), 2)
+            token = response.data['token']
+
+        with freeze_time('2016-11-02 10:00:00'):
+            # nothing changed
+            response = self.client.get('/api/v1/loans/', {'since': token})
+            self.assertEqual(response.data['results'], [])
+            # a new repayment sends its loan again
+            Repayment(loan=other_loan, date=date(2016, 11, 1), amount=1000).save()
+            response = self.client.get('/api/v1/loans/', {'since': token})
+            self.assertEqual([l['id'] for l in response.data['results']], [other_loan.pk])
+            SyncTombstone.record(Repayment, [1234], loan.borrower.agent)
+            response = self.client.get('/api/v1/repayments/', {'since': token})
+            self.assertEqual(len(response.data['results']), 1)
+            self.assertEqual(response.data['deleted'], [1234])
+
+        with freeze_time('2016-11-03 10:00:00'):
+            token = self.client.get('/api/v1/loans/', {'since': token}).data['token']
+        # a loan saved before the token was issued, in a transaction committed after it, is still sent
+        with freeze_time('2016-11-03 09:55:00'):
+            loan.save()
+        with freeze_time('2016-11-03 10:05:00'):
+            response = self.client.get('/api/v1/loans/', {'since': token})
+            self.assertEqual([l['id'] for l in response.data['results']], [loan.pk])
+            # deleting a repayment leaves a tombstone
+            repayment = other_loan.repayments.get()
+            repayment_pk = repayment.pk
+            repayment.delete()
+            response = self.client.get('/api/v1/repayments/', {'since': token})
+            self.assertIn(repayment_pk, response.data['deleted'])
+
+        response = self.client.get('/api/v1/loans/', {'since': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_full_loan_etag(self):
+        with freeze_time(date(2016, 10, 31)):
+            loan = LoanFactory(loan_amount=10000, normal_repayment_amount=1000, bullet_repayment_amount=1000)
+        self.client.force_authenticate(user=loan.borrower.agent.user)
+        url = '/api/v1/loans/{pk}/full/'.format(pk=loan.pk)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # invalid pks are not found
+        self.assertEqual(self.client.get('/api/v1/loans/abc/').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/api/v1/loans/abc/full/').status_code, status.HTTP_404_NOT_FOUND)
+        # the version can't be set by the client
+        self.assertTrue(LoanSerializer().fields['version'].read_only)
+        self.assertTrue(LoanSerializer().fields['lines_updated_on'].read_only)
+
+        # If-None-Match can list several ETags
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"{}-0-full", {}'.format(loan.pk, etag))
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag[:-2] + '"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        repayment = Repayment(loan=loan, date=date(2016, 11, 1), amount=1000)
+        repayment.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # deleting a repayment or editing the borrower changes the ETag too
+        etag = response['ETag']
+        repayment.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+        loan.borrower.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_summary_etag_changes_every_day(self):
+        with freeze_time(date(2016, 10, 31)):
+            loan = LoanFactory(loan_amount=10000, normal_repayment_amount=1000, bullet_repayment_amount=1000)
+            self.client.force_authenticate(user=loan.borrower.agent.user)
+            url = '/api/v1/loans/{pk}/'.format(pk=loan.pk)
+            etag = self.client.get(url, {'view': 'summary'})['ETag']
+            response = self.client.get(url, {'view': 'summary'}, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        with freeze_time(date(2016, 11, 1)):
+            response = self.client.get(url, {'view': 'summary'}, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
     def test_submit_loan_request(self):
         """
         Upload a loan request through the API and check that everything went well.
@@ -2328,6 +2636,23 @@ class LoanAPITests(APITestCase):
             self.assertEqual(RepaymentScheduleLine.objects.filter(date='2017-02-11')[0].fee, fee2)
             loan = Loan.objects.first()
             self.assertEqual(loan.state, 'submitted')
+
+            # lines missing from the request are deleted, and the others are left alone
+            loan_from_server = response.data
+            loan_from_server.pop('loan_contract_photo', [])
+            removed = loan_from_server['lines'].pop()
+            response = self.client.put('/api/v1/loans/{pk}/'.format(pk=loan.pk), loan_from_server, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(RepaymentScheduleLine.objects.count(), 4)
+            self.assertFalse(RepaymentScheduleLine.objects.filter(pk=removed['id']).exists())
+            self.assertEqual(RepaymentScheduleLine.objects.filter(date='2017-02-07')[0].fee, fee1)
+
+            # lines of another loan cannot be updated through this loan
+            other_loan = LoanFactory()
+            loan_from_server['lines'][0]['id'] = other_loan.lines.first().pk
+            response = self.client.put('/api/v1/loans/{pk}/'.format(pk=loan.pk), loan_from_server, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(RepaymentScheduleLine.objects.filter(loan=loan).count(), 4)
         # try a PATCH request on the loan status
         response = self.client.patch('/api/v1/loans/{pk}/'.format(pk=loan.pk), {"state": "disbursed", "lines": []}, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -2468,6 +2793,64 @@ class LoanAPITests(APITestCase):
         self.assertEqual(loan.state, LOAN_REQUEST_REJECTED)
         self.assertEqual(LoanRequestReview.objects.latest('id').reviewer, user)
 
+    def test_all_loans_connection_using_Graphql(self):
+        """
+        allLoans is paginated, filtered, batches the lines of the loans, and rejects unbounded queries
+        """
+        loan = LoanFactory(state=LOAN_REQUEST_SIGNED)
+        agent = loan.borrower.agent
+        loan2 = LoanFactory(borrower__agent=agent, state=LOAN_REQUEST_SIGNED)
+        LoanFactory(state=LOAN_REQUEST_SIGNED)
+        token, created = Token.objects.get_or_create(user=agent.user)
+
+        query = {"query": "{allLoans (first: 1, agent: %d) "
+                          "{pageInfo {hasNextPage endCursor} edges {node {id lines {date}}}}}" % agent.pk}
+        response = self.client.post('/graphql/', query, HTTP_AUTHORIZATION='Token {}'.format(token))
+        all_loans = json.loads(response._container[0].decode())['data']['allLoans']
+        self.assertEqual(len(all_loans['edges']), 1)
+        self.assertTrue(all_loans['pageInfo']['hasNextPage'])
+        # newest loans first
+        self.assertEqual(int(all_loans['edges'][0]['node']['id']), loan2.pk)
+        self.assertEqual(len(all_loans['edges'][0]['node']['lines']), loan2.lines.count())
+
+        query = {"query": "{allLoans (first: 1, agent: %d, after: \"%s\") {edges {node {id}}}}" % (
+            agent.pk, all_loans['pageInfo']['endCursor'])}
+        response = self.client.post('/graphql/', query, HTTP_AUTHORIZATION='Token {}'.format(token))
+        edges = json.loads(response._container[0].decode())['data']['allLoans']['edges']
+        self.assertEqual([int(e['node']['id']) for e in edges], [loan.pk])
+
+        # no page size, or a page too expensive
+        for query in ("{allLoans {edges {node {id}}}}",
+                      "{allLoans (first: 100) {edges {node {lines {date} repayments {date}}}}}"):
+            response = self.client.post('/graphql/', {"query": query}, HTTP_AUTHORIZATION='Token {}'.format(token))
+            self.assertIn('errors', json.loads(response._container[0].decode()))
+
+        response = self.client.post('/graphql/', {"query": "{allLoans (first: 0) {edges {node {id}}}}"},
+                                    HTTP_AUTHORIZATION='Token {}'.format(token))
+        result = json.loads(response._container[0].decode())
+        self.assertNotIn('errors', result)
+        self.assertEqual(result['data']['allLoans']['edges'], [])
+
+    def test_all_loans_connection_query_count(self):
+        """
+        the lines and repayments of a page of loans are loaded in a constant number of queries
+        """
+        loan = LoanFactory(state=LOAN_DISBURSED)
+        agent = loan.borrower.agent
+        for i in range(4):
+            RepaymentFactory(loan=LoanFactory(borrower__agent=agent, state=LOAN_DISBURSED))
+        token, created = Token.objects.get_or_create(user=agent.user)
+
+        def run(page_size):
+            query = {"query": "{allLoans (first: %d, agent: %d) "
+                              "{edges {node {id lines {date} repayments {date}}}}}" % (page_size, agent.pk)}
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post('/graphql/', query, HTTP_AUTHORIZATION='Token {}'.format(token))
+            self.assertEqual(len(json.loads(response._container[0].decode())['data']['allLoans']['edges']), page_size)
+            return len(queries)
+
+        self.assertEqual(run(5), run(1))
+
 
 class DisbursementTests(TestCase):
     """
@@ -3852,6 +4235,38 @@ class Reconciliation2Tests(TestCase):
             self.assertEqual(s1.last_reconciled, datetime(2017, 3, 16, 14, 0, 0, tzinfo=timezone.utc))
             self.assertEqual(s2.last_reconciled, datetime(2017, 3, 17, 14, 0, 0, tzinfo=timezone.utc))
 
+    def test_reconcile_with_intermediary_checks_states(self):
+        """
+        nothing is reconciled if one of the objects can't be reconciled
+        """
+        with freeze_time('2017-3-14 14:00:00'):
+            s1 = AgentFactory()
+            repayments = RepaymentFactory.create_batch(size=2, date=date.today(), amount=1000,
+                                                       loan__borrower__agent=s1)
+            user = UserFactory()
+            recon = reconcile_with_intermediary(
+                Repayment.objects.filter(pk=repayments[0].pk), [], reconciled_by=user, method=MANUAL_RECONCILED
+            )
+            self.assertEqual(Repayment.objects.get(pk=repayments[0].pk).reconciliation, recon)
+            self.assertEqual(Repayment.objects.get(pk=repayments[0].pk).reconciliation_status, MANUAL_RECONCILED)
+
+            recon_count = Recon.objects.count()
+            with self.assertRaises(TransitionNotAllowed):
+                reconcile_with_intermediary(Repayment.objects.all(), [], reconciled_by=user)
+            self.assertEqual(Recon.objects.count(), recon_count)
+            self.assertEqual(Repayment.objects.get(pk=repayments[1].pk).reconciliation_status, NOT_RECONCILED)
+            self.assertEqual(Repayment.objects.get(pk=repayments[1].pk).reconciliation, None)
+            self.assertEqual(Repayment.objects.filter(reconciliation=recon).count(), 1)
+
+            # the states are checked on locked rows, a concurrent reconciliation waits for this one
+            with CaptureQueriesContext(connection) as queries:
+                reconcile_with_intermediary(
+                    Repayment.objects.filter(pk=repayments[1].pk), [], reconciled_by=user, method=MANUAL_RECONCILED
+                )
+            self.assertTrue(any(
+                'reconciliation_status' in q['sql'] and q['sql'].endswith('FOR UPDATE') for q in queries
+            ))
+
     def test_3(self):
         """
         not reconcile first and then reconcile
@@ -4350,6 +4765,634 @@ class ReconciliationAPITests(APITestCase):
         self.assertRaises(TransitionNotAllowed, self.client.post, url, data, format='json')
 
 
+class PortfolioAtRiskTests(TestCase):
+    """
+    Test the bulk PAR calculation used by the late loans report
+    """
+
+    def test_par_rows_and_buckets(self):
+        with freeze_time(date(2016, 10, 27)):
+            late_loan = LoanFactory(
+                loan_amount=9000,
+                normal_repayment_amount=3000,
+                bullet_repayment_amount=3000,
+                state=LOAN_DISBURSED,
+                loan_fee=200
+            )
+            on_time_loan = LoanFactory(
+                loan_amount=10000,
+                normal_repayment_amount=1000,
+                bullet_repayment_amount=1000,
+                state=LOAN_DISBURSED,
+                loan_fee=200
+            )
+        Repayment(loan=on_time_loan, date=date(2016, 10, 28), amount=2200).save()
+        with freeze_time('2016-10-29'):
+            par = PortfolioAtRisk()
+            rows = par.rows
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(rows[0]['obj'], late_loan)
+            self.assertEqual(rows[0]['total_days_late'], late_loan.current_delay)
+            self.assertEqual(rows[0]['total_outstanding'], late_loan.total_outstanding)
+            self.assertEqual(rows[0]['par_category'], 'PAR 1-30')
+            self.assertEqual(par.buckets['PAR 1-30'], {'count': 1, 'outstanding': 9200})
+            self.assertEqual(par.buckets['PAR >90'], {'count': 0, 'outstanding': 0})
+
+            # filters
+            self.assertEqual(PortfolioAtRisk(agent=on_time_loan.borrower.agent).rows, [])
+            self.assertEqual(len(PortfolioAtRisk(agent=late_loan.borrower.agent).rows), 1)
+
+    def test_portfolio_snapshot(self):
+        with freeze_time(date(2016, 10, 27)):
+            late_loan = LoanFactory(
+                loan_amount=9000,
+                normal_repayment_amount=3000,
+                bullet_repayment_amount=3000,
+                state=LOAN_DISBURSED,
+                loan_fee=200
+            )
+            on_time_loan = LoanFactory(
+                loan_amount=10000,
+                normal_repayment_amount=1000,
+                bullet_repayment_amount=1000,
+                state=LOAN_DISBURSED,
+                loan_fee=200
+            )
+        Repayment(loan=on_time_loan, date=date(2016, 10, 28), amount=2200).save()
+        with freeze_time('2016-10-29'):
+            snapshots = build_portfolio_snapshot(date(2016, 10, 28))
+            self.assertEqual(len(snapshots), 2)
+            on_time = PortfolioSnapshot.objects.get(date=date(2016, 10, 28), agent=on_time_loan.borrower.agent)
+            self.assertEqual(on_time.collected, 2200)
+            self.assertEqual(on_time.total_outstanding, 8000)
+
+            # building the same day again replaces the rows
+            build_portfolio_snapshot(date(2016, 10, 29))
+            build_portfolio_snapshot(date(2016, 10, 29))
+            late = PortfolioSnapshot.objects.get(date=date(2016, 10, 29), agent=late_loan.borrower.agent)
+            self.assertEqual(late.active_loans, 1)
+            self.assertEqual(late.total_outstanding, late_loan.total_outstanding)
+            self.assertEqual(late.par_1_30_loans, 1)
+            self.assertEqual(late.par_1_30_outstanding, 9200)
+            self.assertEqual(late.par_31_60_loans, 0)
+
+            totals = PortfolioSnapshot.rollup(PortfolioSnapshot.objects.all(), 'date')
+            self.assertEqual([(t['date'], t['active_loans']) for t in totals],
+                             [(date(2016, 10, 28), 2), (date(2016, 10, 29), 2)])
+            self.assertEqual(totals[1]['total_outstanding'], 9200 + 8000)
+
+    def test_portfolio_snapshot_planned_of_repaid_loans(self):
+        with freeze_time(date(2016, 10, 27)):
+            loan = LoanFactory(
+                loan_amount=2000,
+                normal_repayment_amount=1000,
+                bullet_repayment_amount=1000,
+                state=LOAN_DISBURSED,
+                loan_fee=200
+            )
+        agent = loan.borrower.agent
+        # repaid early, the line of 10/29 is not planned any more
+        Repayment(loan=loan, date=date(2016, 10, 28), amount=2200).save()
+        self.assertEqual(Loan.objects.get(pk=loan.pk).repaid_on, date(2016, 10, 28))
+        with freeze_time('2016-10-30'):
+            build_portfolio_snapshot(date(2016, 10, 28))
+            build_portfolio_snapshot(date(2016, 10, 29))
+        self.assertEqual(PortfolioSnapshot.objects.get(date=date(2016, 10, 28), agent=agent).planned, 1200)
+        self.assertFalse(PortfolioSnapshot.objects.filter(date=date(2016, 10, 29), agent=agent).exists())
+
+    def test_par_category(self):
+        self.assertEqual(par_category(1), 'PAR 1-30')
+        self.assertEqual(par_category(30), 'PAR 1-30')
+        self.assertEqual(par_category(31), 'PAR 31-60')
+        self.assertEqual(par_category(90), 'PAR 61-90')
+        self.assertEqual(par_category(91), 'PAR >90')
+
+
+class ExportTests(TestCase):
+    """
+    Test the CSV exports of the reports
+    """
+
+    def setUp(self):
+        self.client.force_login(UserFactory())
+
+    def export_rows(self, name, params=None):
+        response = self.client.get(reverse('loans:' + name), params or {})
+        self.assertEqual(response.status_code, 200)
+        return list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+
+    def test_late_loans_export(self):
+        with freeze_time(date(2016, 10, 27)):
+            LoanFactory(
+                loan_amount=9000,
+                normal_repayment_amount=3000,
+                bullet_repayment_amount=3000,
+                state=LOAN_DISBURSED,
+                loan_fee=200
+            )
+        with freeze_time('2016-10-29'):
+            rows = self.export_rows('export-late-loans')
+        self.assertEqual(rows[0][0], 'contract_number')
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][rows[0].index('total_outstanding')], '9200.00')
+        self.assertEqual(rows[1][rows[0].index('par_category')], 'PAR 1-30')
+
+    def test_outstanding_loans_export(self):
+        with freeze_time(date(2016, 10, 27)):
+            loan = LoanFactory(
+                loan_amount=9000,
+                normal_repayment_amount=3000,
+                bullet_repayment_amount=3000,
+                state=LOAN_DISBURSED,
+                loan_fee=200
+            )
+        Repayment(loan=loan, date=date(2016, 10, 28), amount=2200).save()
+        rows = self.export_rows('export-outstanding-loans')
+        self.assertEqual(rows[0], ['contract_number', 'borrower__agent__name', 'borrower__name_en',
+                                   'borrower__name_mm', 'contract_date', 'loan_amount', 'loan_fee',
+                                   'actual_principal', 'actual_fee', 'outstanding'])
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][0], loan.contract_number)
+        self.assertEqual(rows[1][rows[0].index('actual_fee')], '200.00')
+        self.assertEqual(rows[1][rows[0].index('outstanding')], '7000.00')
+
+    def test_repayments_export(self):
+        self.assertEqual(len(self.export_rows('export-repayments')), 1)
+
+        with freeze_time(date(2016, 10, 27)):
+            loan = LoanFactory(
+                loan_amount=9000,
+                normal_repayment_amount=3000,
+                bullet_repayment_amount=3000,
+                state=LOAN_DISBURSED,
+                loan_fee=200
+            )
+        repayment = Repayment(loan=loan, date=date(2016, 10, 28), amount=2200)
+        repayment.save()
+        rows = self.export_rows('export-repayments')
+        self.assertEqual(rows[0][:6], ['pk', 'date', 'loan__contract_number', 'loan__borrower__agent__name',
+                                       'loan__borrower__name_en', 'amount'])
+        self.assertEqual(rows[1][:3], [str(repayment.pk), '2016-10-28', loan.contract_number])
+        self.assertEqual(rows[1][rows[0].index('principal')], '2000.00')
+        self.assertEqual(rows[1][rows[0].index('reconciliation_status')], NOT_RECONCILED)
+
+        # same filters as the late loans report
+        self.assertEqual(len(self.export_rows('export-repayments', {'start_date': '10/29/2016'})), 1)
+        self.assertEqual(len(self.export_rows('export-repayments', {'agent': loan.borrower.agent.pk})), 2)
+
+    def test_reconciliation_export(self):
+        with freeze_time(date(2016, 10, 27)):
+            loan = LoanFactory(
+                loan_amount=9000,
+                normal_repayment_amount=3000,
+                bullet_repayment_amount=3000,
+                state=LOAN_DISBURSED,
+                loan_fee=200
+            )
+        repayment = Repayment(loan=loan, date=date(2016, 10, 28), amount=2200)
+        repayment.save()
+        Repayment(loan=loan, date=date(2016, 11, 10), amount=1000).save()
+        rows = self.export_rows('export-reconciliation', {'date': '2016-10-27', 'agent': loan.borrower.agent.pk})
+        self.assertEqual(rows[0][-4:], ['reconciliation__reconciled_at', 'reconciliation__reconciled_by__username',
+                                        'superuser_to_lender_payment',
+                                        'superuser_to_lender_payment__transfer__timestamp'])
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][:3], [str(repayment.pk), '2016-10-28', loan.contract_number])
+        self.assertEqual(rows[1][rows[0].index('amount')], '2200.00')
+        self.assertEqual(rows[1][rows[0].index('reconciliation_status')], NOT_RECONCILED)
+
+
+class CustomerRetentionReportTests(TestCase):
+    """
+    Test the customer retention report
+    """
+
+    def test_customer_retention_report(self):
+        with freeze_time(date(2016, 10, 27)):
+            loan = LoanFactory(state=LOAN_DISBURSED)
+            subscription = LoanFactory(state=LOAN_REPAID, borrower=loan.borrower, contract_date=date(2016, 11, 2))
+            subscription.lines.filter(pk=subscription.lines.first().pk).update(subscription=500)
+            LoanFactory(state=LOAN_REQUEST_SUBMITTED, borrower=loan.borrower)
+            other = LoanFactory(state=LOAN_DISBURSED)
+        self.client.force_login(UserFactory())
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse('loans:customer_retention_report'), {'agent': loan.borrower.agent.pk}
+            )
+        rows = {b.pk: b for b in response.context['all_subscriber']}
+        self.assertEqual(set(rows), {loan.borrower.pk})
+        self.assertEqual(rows[loan.borrower.pk].number_of_loans, 2)
+        self.assertEqual(rows[loan.borrower.pk].non_subs, 1)
+        self.assertEqual(rows[loan.borrower.pk].subs, 1)
+        self.assertEqual(rows[loan.borrower.pk].last_loan, date(2016, 11, 2))
+
+        # the number of queries doesn't grow with the number of borrowers
+        response = self.client.get(reverse('loans:customer_retention_report'))
+        self.assertEqual(len(response.context['all_subscriber']), Borrower.objects.count())
+        with CaptureQueriesContext(connection) as all_queries:
+            self.client.get(reverse('loans:customer_retention_report'))
+        self.assertEqual(len(queries), len(all_queries))
+        self.assertNotIn(other.borrower.pk, rows)
+
+    def test_customer_retention_report_invalid_filters(self):
+        LoanFactory(state=LOAN_DISBURSED)
+        self.client.force_login(UserFactory())
+        for params in ({'agent': 'abc'}, {'branch': '1.5'}, {'agent': 0}):
+            response = self.client.get(reverse('loans:customer_retention_report'), params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.context['all_subscriber']), Borrower.objects.count())
+
+
+class LoanBalanceTests(TestCase):
+    """
+    Test the materialized LoanBalance table
+    """
+
+    def test_balance_refreshed_on_repayment(self):
+        with freeze_time(date(2016, 10, 27)):
+            loan = LoanFactory(
+                loan_amount=9000,
+                normal_repayment_amount=3000,
+                bullet_repayment_amount=3000,
+                state=LOAN_DISBURSED,
+                loan_fee=200
+            )
+        with freeze_time('2016-10-29'):
+            Repayment(loan=loan, date=date(2016, 10, 28), amount=2200).save()
+            balance = LoanBalance.objects.get(loan=loan)
+            loan = Loan.objects.get(pk=loan.pk)
+            self.assertEqual(balance.total_outstanding, loan.total_outstanding)
+            self.assertEqual(balance.principal_paid, 2000)
+            self.assertEqual(balance.fee_paid, 200)
+            self.assertEqual(balance.principal_due, 9000)
+            self.assertEqual(balance.current_delay, loan.current_delay)
+            self.assertEqual(balance.last_repayment_date, date(2016, 10, 28))
+            self.assertEqual(balance.contract_due_date, loan.contract_due_date)
+
+        # days late move with time, the refresh updates the existing row
+        with freeze_time('2016-11-10'):
+            LoanBalance.refresh([loan.pk])
+            self.assertEqual(LoanBalance.objects.get(loan=loan).current_delay, loan.current_delay)
+            self.assertEqual(LoanBalance.objects.count(), 1)
+            self.assertEqual(
+                list(Loan.objects.filter(balance__total_outstanding__gt=0).order_by('-balance__current_delay')), [loan]
+            )
+
+    def test_balance_refreshed_on_line_and_amount_change(self):
+        with freeze_time(date(2016, 10, 27)):
+            loan = LoanFactory(
+                loan_amount=9000,
+                normal_repayment_amount=3000,
+                bullet_repayment_amount=3000,
+                state=LOAN_DISBURSED,
+                loan_fee=200
+            )
+            line = loan.repaymentscheduleline_set.order_by('-date').first()
+            line.principal += 500
+            line.save()
+            self.assertEqual(LoanBalance.objects.get(loan=loan).principal_due, 9500)
+            line.delete()
+            self.assertEqual(LoanBalance.objects.get(loan=loan).principal_due, 9500 - line.principal)
+
+            loan = Loan.objects.get(pk=loan.pk)
+            loan.loan_fee = 300
+            loan.save()
+            self.assertEqual(LoanBalance.objects.get(loan=loan).total_outstanding, loan.total_outstanding)
+
+    def test_refresh_of_missing_balance(self):
+        with freeze_time(date(2016, 10, 27)):
+            loan = LoanFactory(state=LOAN_DISBURSED)
+            LoanBalance.objects.filter(loan=loan).delete()
+            LoanBalance.refresh([loan.pk])
+            LoanBalance.refresh([loan.pk])
+            self.assertEqual(LoanBalance.objects.filter(loan=loan).count(), 1)
+
+
+class PDFRenderTests(TestCase):
+    """
+    Test the cached background rendering of the PDFs
+    """
+
+    def test_contract_pdf_rendered_once(self):
+        loan = LoanFactory()
+        self.client.force_login(UserFactory())
+        url = reverse('loans:pdf-contract', args=[loan.pk])
+        with patch('loans.pdf.render_pdf') as render_pdf:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 202)
+            # requesting the same contract again doesn't start another render
+            self.client.get(url)
+            self.assertEqual(render_pdf.si.call_count, 1)
+        pdf = PDFRender.objects.get()
+        self.assertEqual(pdf.filename, 'loan_contract_{}.pdf'.format(loan.pk))
+
+        status = self.client.get(reverse('loans:pdf-status', args=[pdf.key])).json()
+        self.assertEqual(status, {'state': PDF_RENDER_PENDING})
+
+        # as saved by tasks.render_pdf
+        pdf.file.name = 'pdf/{}/{}'.format(pdf.key, pdf.filename)
+        pdf.state = PDF_RENDER_DONE
+        pdf.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, pdf.file.url)
+
+    def test_print_batch_reuses_rendered_documents(self):
+        loan = LoanFactory()
+        loan2 = LoanFactory()
+        self.client.force_login(UserFactory())
+        url = reverse('loans:print-batch') + '?loans={},{}'.format(loan.pk, loan2.pk)
+        with patch('loans.pdf.render_pdf') as render_pdf, patch('loans.pdf.chord') as chord:
+            # the first contract was already printed alone
+            self.client.get(reverse('loans:pdf-contract', args=[loan.pk]))
+            PDFRender.objects.update(state=PDF_RENDER_DONE)
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 202)
+            # only the second contract is rendered, then merged
+            self.assertEqual(render_pdf.si.call_count, 2)
+            part2 = PDFRender.objects.get(filename='loan_contract_{}.pdf'.format(loan2.pk))
+            self.assertEqual(render_pdf.si.call_args[0][0], part2.pk)
+            self.assertEqual(chord.call_count, 1)
+
+            # printing the same batch again doesn't start anything
+            self.client.get(url)
+            self.assertEqual(render_pdf.si.call_count, 2)
+            self.assertEqual(chord.call_count, 1)
+        self.assertEqual(PDFRender.objects.count(), 3)
+
+    def test_print_batch_invalid_ids(self):
+        self.client.force_login(UserFactory())
+        for query in ('?loans=1,a', '?disbursement=5.pdf', '?branch=../2&date=2016-10-30&days=7'):
+            response = self.client.get(reverse('loans:print-batch') + query)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(PDFRender.objects.count(), 0)
+
+    def test_lost_render_is_restarted(self):
+        loan = LoanFactory()
+        self.client.force_login(UserFactory())
+        url = reverse('loans:pdf-contract', args=[loan.pk])
+        with patch('loans.pdf.render_pdf') as render_pdf:
+            self.client.get(url)
+            # the worker died while rendering
+            PDFRender.objects.update(state=PDF_RENDER_RUNNING)
+            self.client.get(url)
+            self.assertEqual(render_pdf.si.call_count, 1)
+
+            with freeze_time(timezone.now() + PDF_RENDER_TIMEOUT + timedelta(minutes=1)):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 202)
+                self.assertEqual(render_pdf.si.call_count, 2)
+                self.assertEqual(PDFRender.objects.get().state, PDF_RENDER_PENDING)
+                # only restarted once
+                self.client.get(url)
+                self.assertEqual(render_pdf.si.call_count, 2)
+
+
+class CollectionSheetTests(TestCase):
+    """
+    Test the collection sheet context builder
+    """
+
+    def test_collection_sheet_context(self):
+        with freeze_time(date(2016, 10, 27)):
+            loan = LoanFactory(
+                loan_amount=9000,
+                normal_repayment_amount=3000,
+                bullet_repayment_amount=3000,
+                state=LOAN_DISBURSED,
+                loan_fee=200
+            )
+        Repayment(loan=loan, date=date(2016, 10, 28), amount=1000).save()
+        first_line = loan.lines.order_by('date').first()
+        first_day = date(2016, 10, 27)
+        context = get_collection_sheet_context(first_day, None, 7, False)
+        self.assertEqual(len(context['date_range']), 7)
+        self.assertEqual(len(context['collection_list']), 1)
+        row = context['collection_list'][0]
+        self.assertEqual(row['borrower'], loan.borrower)
+        idx = (first_line.date - first_day).days
+        self.assertEqual(row['repayments'][idx][0], first_line.principal + first_line.fee)
+        self.assertEqual(row['repayments'][1][1], 1000)
+        self.assertEqual(context['daily_totals'][1][1], 1000)
+
+        # the number of queries doesn't grow with the number of days
+        with CaptureQueriesContext(connection) as one_week:
+            get_collection_sheet_context(first_day, None, 7, False)
+        with CaptureQueriesContext(connection) as four_weeks:
+            get_collection_sheet_context(first_day, None, 28, False)
+        self.assertEqual(len(one_week), len(four_weeks))
+
+    def test_collection_sheet_queries_dont_depend_on_borrowers(self):
+        first_day = date(2016, 10, 27)
+        with freeze_time(first_day):
+            loan = LoanFactory(state=LOAN_DISBURSED)
+        with CaptureQueriesContext(connection) as one_borrower:
+            context = get_collection_sheet_context(first_day, None, 7, False)
+        self.assertEqual(context['collection_list'][0]['contract_number'], loan.contract_number)
+
+        with freeze_time(first_day):
+            for i in range(4):
+                LoanFactory(state=LOAN_DISBURSED)
+        with CaptureQueriesContext(connection) as five_borrowers:
+            context = get_collection_sheet_context(first_day, None, 7, False)
+        self.assertEqual(len(context['collection_list']), 5)
+        self.assertEqual(len(one_borrower), len(five_borrowers))
+
+    def test_collection_sheet_current_loan_without_lines(self):
+        first_day = date(2016, 10, 27)
+        with freeze_time(date(2016, 10, 1)):
+            # nothing due nor repaid on this loan during the week
+            current = LoanFactory(loan_amount=1000, state=LOAN_DISBURSED)
+        with freeze_time(date(2016, 10, 28)):
+            # contracted during the week, it isn't the current loan yet
+            LoanFactory(borrower=current.borrower, state=LOAN_DISBURSED)
+        context = get_collection_sheet_context(first_day, None, 7, False)
+        [row] = context['collection_list']
+        self.assertEqual(row['borrower'], current.borrower)
+        self.assertEqual(row['contract_number'], current.contract_number)
+
+
+class LoanSheetTests(TestCase):
+    """
+    Test the rows of the request and disburse sheets
+    """
+
+    def test_loan_sheet_rows(self):
+        with freeze_time(date(2016, 10, 27)):
+            signed = LoanFactory(state=LOAN_REQUEST_SIGNED)
+            unsigned = LoanFactory(state=LOAN_REQUEST_SUBMITTED)
+        # skip the face comparison done when a signature is saved
+        with factory.django.mute_signals(post_save):
+            PhotoSignature.objects.create(loan=signed, timestamp=timezone.now() - timedelta(days=1))
+            latest = PhotoSignature.objects.create(loan=signed, timestamp=timezone.now())
+
+        with CaptureQueriesContext(connection) as queries:
+            rows = loan_sheet_rows(Loan.objects.order_by('pk'))
+            for row in rows:
+                row['agent'].name
+        self.assertEqual(len(queries), 2)
+        self.assertEqual([row['loan'] for row in rows], [signed, unsigned])
+        self.assertEqual(rows[0]['signature'], latest)
+        self.assertIsNone(rows[1]['signature'])
+        self.assertEqual(rows[1]['agent'], unsigned.borrower.agent)
+
+
+class BackendTodayTests(TestCase):
+    """
+    Test the rows of the backend today views
+    """
+
+    def setUp(self):
+        cache.clear()
+
+    def test_agents_today_rows(self):
+        with freeze_time(date(2016, 10, 27)):
+            loans = [LoanFactory(state=LOAN_DISBURSED) for i in range(3)]
+        agents = [ln.borrower.agent for ln in loans]
+        for agent in agents:
+            agent.user = UserFactory()
+            agent.save()
+
+        def today(request, **kwargs):
+            ln = Loan.objects.get(borrower__agent__user=request.user)
+            return MagicMock(data={'today': [{'borrower': ln.borrower_id, 'loan': ln.pk, 'amount': 1000}]})
+
+        request = RequestFactory().get('/')
+        with patch('loans.views.TodayView') as today_view:
+            today_view.return_value.get.side_effect = today
+            data = agents_today_rows(request, agents)
+            self.assertEqual(today_view.return_value.get.call_count, 3)
+            self.assertEqual([rows[0]['loan'] for rows in data], loans)
+            self.assertEqual([rows[0]['borrower'] for rows in data], [ln.borrower for ln in loans])
+
+            # the rows are cached until the loans of the agent change
+            with CaptureQueriesContext(connection) as queries:
+                agents_today_rows(request, agents)
+            self.assertEqual(today_view.return_value.get.call_count, 3)
+            # the versions of the loans, and the borrowers and loans in bulk
+            self.assertEqual(len(queries), 3)
+            loans[0].save()
+            data = agents_today_rows(request, agents)
+            self.assertEqual(today_view.return_value.get.call_count, 4)
+            self.assertEqual(data[0][0]['loan'], loans[0])
+
+
+class ScheduleGeneratorTests(TestCase):
+    """
+    Test the repayment schedule built for a loan product
+    """
+
+    def test_schedule_with_bullet(self):
+        with freeze_time('2017-3-1'):
+            ln = LoanFactory(
+                loan_amount=10000,
+                normal_repayment_amount=3000,
+                bullet_repayment_amount=4000,
+                loan_fee=500,
+                loans_lines=False,
+            )
+        lines = ScheduleGenerator(ln, date(2017, 3, 1)).lines()
+        self.assertEqual([l.date for l in lines], [date(2017, 3, 2), date(2017, 3, 3), date(2017, 3, 4)])
+        self.assertEqual([l.principal for l in lines], [3000, 3000, 4000])
+        self.assertEqual([l.fee for l in lines], [500, 0, 0])
+
+        # the fee can be due on disbursement day instead
+        lines = ScheduleGenerator(ln, date(2017, 3, 1), fee_on_disbursement=True).lines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual((lines[0].date, lines[0].principal, lines[0].fee), (date(2017, 3, 1), 0, 500))
+        self.assertEqual(sum(l.fee for l in lines[1:]), 0)
+
+    def test_equal_repayments_schedule(self):
+        with freeze_time('2017-3-1'):
+            ln = LoanFactory(loan_interest_type=EQUAL_REPAYMENTS, number_of_repayments=6, loans_lines=False)
+        lines = ScheduleGenerator(ln, date(2017, 3, 1)).lines()
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(sum(l.principal for l in lines), 0)
+
+    def test_save_creates_lines_in_one_query(self):
+        with freeze_time('2017-3-1'):
+            ln = LoanFactory(loans_lines=False)
+        self.assertEqual(ln.lines.count(), 0)
+        with CaptureQueriesContext(connection) as queries:
+            ScheduleGenerator(ln, date(2017, 3, 1)).save()
+        inserts = [q for q in queries if q['sql'].startswith('INSERT INTO "loans_repaymentscheduleline"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(ln.lines.count(), 10)
+        self.assertEqual(LoanBalance.objects.get(loan=ln).total_outstanding, ln.loan_amount + ln.loan_fee)
+        self.assertEqual(ln.lines.aggregate(total=Sum('principal'))['total'], ln.loan_amount)
+
+
+class ScheduleUpdateTaskTests(TestCase):
+    """
+    Test the nightly update of schedule lines
+    """
+
+    def test_update_chunk_is_resumable(self):
+        with freeze_time('2017-3-1'):
+            ln = LoanFactory(
+                loan_amount=30000,
+                normal_repayment_amount=10000,
+                bullet_repayment_amount=10000,
+                loan_interest_rate=2.5,
+                state=LOAN_DISBURSED,
+                loan_fee=0
+            )
+        with freeze_time('2017-3-2'):
+            run = ScheduleUpdateRun.objects.create(date=date.today(), loans_total=1)
+            update_attributes_for_loans_lines_chunk(run.pk, [ln.pk])
+            run.refresh_from_db()
+            ln.refresh_from_db()
+            self.assertEqual(run.loans_processed, 1)
+            self.assertEqual(run.failures, 0)
+            self.assertEqual(ln.lines_updated_on, date(2017, 3, 2))
+            self.assertEqual(ln.lines.get(date=date(2017, 3, 3)).interest, ln.calculate_interest(20000))
+
+            # the loan was already updated today, running the chunk again does nothing
+            update_attributes_for_loans_lines_chunk(run.pk, [ln.pk])
+            run.refresh_from_db()
+            self.assertEqual(run.loans_processed, 1)
+
+
+class ShiftRepaymentsCommandTests(TestCase):
+    """
+    Test the shift_repayments management command
+    """
+
+    def test_shift_repayments(self):
+        with freeze_time(date(2016, 10, 27)):
+            loan = LoanFactory()
+            loan2 = LoanFactory()
+            other_agent_loan = LoanFactory()
+        agent = loan.borrower.agent
+        loan2.borrower.agent = agent
+        loan2.borrower.save()
+        dates = {ln.pk: sorted(ln.lines.values_list('date', flat=True)) for ln in (loan, loan2, other_agent_loan)}
+
+        out = StringIO()
+        call_command('shift_repayments', '2016-10-30', '2016-10-31', '2', '--agent', str(agent.pk), '--dry-run',
+                     stdout=out)
+        self.assertIn('Would move {} line(s) of 2 loan(s).'.format(
+            loan.lines.filter(date__gte=date(2016, 10, 30)).count() * 2), out.getvalue())
+        self.assertEqual(sorted(loan.lines.values_list('date', flat=True)), dates[loan.pk])
+
+        # an interrupted run, which already shifted the first loan
+        args = dict(start_date=date(2016, 10, 30), end_date=date(2016, 10, 31), shift_days=2, agent=agent)
+        ScheduleShift.objects.create(last_loan_id=loan.pk, **args)
+        call_command('shift_repayments', '2016-10-30', '2016-10-31', '2', '--agent', str(agent.pk), stdout=StringIO())
+        self.assertEqual(sorted(loan.lines.values_list('date', flat=True)), dates[loan.pk])
+        self.assertEqual(sorted(other_agent_loan.lines.values_list('date', flat=True)), dates[other_agent_loan.pk])
+        self.assertEqual(
+            sorted(loan2.lines.values_list('date', flat=True)),
+            [day if day < date(2016, 10, 30) else day + timedelta(days=2) for day in dates[loan2.pk]]
+        )
+        self.assertIsNotNone(ScheduleShift.objects.get(**args).finished_at)
+
+        # the same shift can't be done twice by mistake
+        with self.assertRaises(CommandError):
+            call_command('shift_repayments', '2016-10-30', '2016-10-31', '2', '--agent', str(agent.pk))
+
+
 class RepaymentFactoryTest(TestCase):
     """
     Test Repayment Factory with freezegun
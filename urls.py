@@ -9,6 +9,8 @@ urlpatterns = [
     url(r'^collection-report2/', views.collection_report2, name='collection-report2'),
     url(r'^print-contract/(?P<pk>\d+)/$', views.PrintLoanContractView.as_view(), name='print-contract'),
     url(r'^print-contract/(?P<pk>\d+)/pdf/$', views.PrintLoanContractPDFView.as_view(), name='pdf-contract'),
+    url(r'^print-batch/$', views.print_batch, name='print-batch'),
+    url(r'^pdf/(?P<key>[0-9a-f]{64})/status/$', views.pdf_status, name='pdf-status'),
     url(r'^contract/(?P<pk>\d+)/renew/$', views.create_renewal_contract, name='renew-contract'),
     url(r'^request-sheet/', views.request_sheet, name='request-sheet'),
     url(r'^disburse-sheet/', views.disburse_sheet, name='disburse-sheet'),
@@ -21,5 +23,9 @@ urlpatterns = [
     url(r'^reconciliation-high-level/', views.ReconciliationHighLevelView.as_view(), name='reconciliation-high-level'),
     url(r'^disbursement-report/$', views.disbursement_report, name='disbursement_report'),
     url(r'^customer-retention-report/$', views.customer_retention_report, name='customer_retention_report'),
+    url(r'^export/outstanding-loans/$', views.export_outstanding_loans, name='export-outstanding-loans'),
+    url(r'^export/late-loans/$', views.export_late_loans, name='export-late-loans'),
+    url(r'^export/repayments/$', views.export_repayments, name='export-repayments'),
+    url(r'^export/reconciliation/$', views.export_reconciliation, name='export-reconciliation'),
 
 ]
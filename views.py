@@ -1,4 +1,6 @@
+import csv
 import datetime
+import itertools
 import logging
 from datetime import date as d
 from datetime import timedelta
@@ -6,23 +8,24 @@ from decimal import *
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import F, Q, Sum
-from django.db.models.functions import Coalesce
+from django.core.paginator import Paginator
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce, TruncDate
 from django.forms import ModelForm
-from django.http import JsonResponse
-from django.shortcuts import render
+from django.http import JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render
 from django.utils import translation
 from django.utils.translation import gettext_lazy as _
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.request import Request
-from wkhtmltopdf.views import PDFTemplateView
 
 from borrowers.api_views import TodayView
 from borrowers.models import Agent, Borrower
 from loans.models import Disbursement, Loan, PhotoSignature
-from org.models import MFI
+from org.models import MFI, MFIBranch
 from payments.models import (TRANSFER_METHOD_PAY_WITH_WAVE,
                              TRANSFER_METHOD_WAVE_TO_WAVE, Transfer)
 from sms_gateway.models import WaveMoneyReceiveSMS
@@ -30,8 +33,19 @@ from sms_gateway.models import WaveMoneyReceiveSMS
 from .models import (LOAN_DISBURSED, LOAN_REPAID, LOAN_REQUEST_APPROVED,
                      LOAN_REQUEST_DRAFT, LOAN_REQUEST_REJECTED,
                      LOAN_REQUEST_SIGNED, LOAN_REQUEST_SUBMITTED, Loan,
-                     Repayment, RepaymentScheduleLine,
-                     SuperUsertoLenderPayment)
+                     PDF_RENDER_DONE, PDFRender, Repayment,
+                     RepaymentScheduleLine, SuperUsertoLenderPayment,
+                     record_repayments)
+from .pdf import batch_pdf_response, pdf_response
+from .reports import PortfolioAtRisk
+from .schedules import ScheduleGenerator
+
+# number of rows fetched from the database at a time by the CSV exports
+EXPORT_CHUNK_SIZE = 2000
+# number of borrowers per page of the customer retention report
+RETENTION_REPORT_PAGE_SIZE = 500
+# how long the TodayView rows of an agent are cached by the backend today views, in seconds
+TODAY_CACHE_TIMEOUT = 24 * 60 * 60
 
 
 @login_required
@@ -64,9 +78,46 @@ def clean_collection_report_arguments(request):
         return first_day, agent_pk, num_days, show_paid
 
 
+def _transferred_amount(repayments):
+    """
+    Sum of the repayments already transferred to the lender, used in the collection sheet cells
+    """
+    try:
+        transferd = sum([repayment.amount for repayment in repayments if repayment.reconciliation_id])
+        # For old data when reconciliation process was not there
+        if transferd == 0:
+            # It's working only if payment using pay-with-wave money for collection sheet
+            transferd = sum(
+                [
+                    repayment.amount
+                    for repayment in repayments
+                    if repayment.superuser_to_lender_payment.transfer.transfer_successful
+                ]
+            )
+    except Exception as e:
+        transferd = 0
+    return transferd
+
+
+def current_loans_at(borrowers, day):
+    """
+    return {borrower pk: loan} with the loan of each of `borrowers` running on `day`, in one query:
+    the latest disbursed one contracted on or before `day` and not repaid before it (as
+    Borrower.get_current_loan_at), borrowers without any are left out
+    """
+    loans = Loan.objects.filter(
+        borrower__in=borrowers, state__in=[LOAN_DISBURSED, LOAN_REPAID], contract_date__lte=day
+    ).filter(Q(repaid_on=None) | Q(repaid_on__gte=day)).order_by("contract_date", "pk")
+    # the latest loan of each borrower comes last
+    return {ln.borrower_id: ln for ln in loans}
+
+
 def get_collection_sheet_context(first_day, agent_pk, num_days, show_paid):
     """
     this function expect sanitized arguments, or it may break badly :(
+    All lines, repayments, sms and transfers of the period are loaded once and pivoted
+    in dicts keyed by (borrower_id, date) or date, so the number of queries doesn't depend
+    on the number of borrowers or days.
     """
     try:
         agent = Agent.objects.get(pk=agent_pk)
@@ -83,7 +134,7 @@ def get_collection_sheet_context(first_day, agent_pk, num_days, show_paid):
         .filter(
             Q(loan__repaid_on__isnull=True) | Q(loan__repaid_on__isnull=False) & Q(date__lte=F("loan__repaid_on"))
         )
-        .order_by("date")
+        .select_related("loan__borrower")
         .order_by("loan__borrower__name_en")
     )
 
@@ -91,7 +142,7 @@ def get_collection_sheet_context(first_day, agent_pk, num_days, show_paid):
     # so we can show unexpected repayments
     repayments_received = (
         Repayment.objects.filter(date__gte=first_day, date__lte=last_day)
-        .order_by("date")
+        .select_related("loan__borrower")
         .order_by("loan__borrower__name_en")
     )
 
@@ -105,12 +156,23 @@ def get_collection_sheet_context(first_day, agent_pk, num_days, show_paid):
     # TODO: add missed payments
 
     borrower_set = set()
+    lines_by_cell = {}
     for line in line_queryset:
         borrower_set.add(line.loan.borrower)
+        lines_by_cell.setdefault((line.loan.borrower.pk, line.date), []).append(line)
     for r in repayments_received:
         borrower_set.add(r.loan.borrower)
     borrower_list = sorted(list(borrower_set), key=lambda x: x.name_en.lower())
 
+    # all repayments of those borrowers (whatever the agent of the loan) over the period
+    repayments_by_cell = {}
+    for r in Repayment.objects.filter(
+        date__gte=first_day, date__lte=last_day, loan__borrower__in=[b.pk for b in borrower_list]
+    ).select_related("loan", "superuser_to_lender_payment__transfer"):
+        repayments_by_cell.setdefault((r.loan.borrower_id, r.date), []).append(r)
+    # the current loan of each borrower, even if it has nothing due or repaid over the period
+    current_loans = current_loans_at([b.pk for b in borrower_list], first_day)
+
     date_range = [first_day + timedelta(days=x) for x in range(num_days)]
 
     collection_list = []
@@ -123,49 +185,21 @@ def get_collection_sheet_context(first_day, agent_pk, num_days, show_paid):
     for borrower in borrower_list:
         repayments = []
         for idx, day in enumerate(date_range):
-            # repayment = sum(line.principal + line.fee + line.interest + line.penalty for line in [l for l in line_queryset if l.loan.borrower == borrower and l.date == day])
-            repaid = (
-                Repayment.objects.filter(loan__borrower=borrower, date=day).aggregate(
-                    Sum("amount")
-                )["amount__sum"] or 0
-            )
+            day_repayments = repayments_by_cell.get((borrower.pk, day), [])
+            repaid = sum(r.amount for r in day_repayments) or 0
 
             repayment = subscription = principal = fee = interest = penalty = 0
-            for line in line_queryset:
-                if line.loan.borrower == borrower and line.date == day:
-                    repayment += (
-                        line.principal + line.fee + line.interest + line.penalty
-                    )
-                    subscription += line.subscription
-                    principal += line.principal
-                    fee += line.fee
-                    interest += line.interest
-                    penalty += line.penalty
-
-            try:
-                transferd = sum(
-                    [
-                        repayment.amount
-                        for repayment in Repayment.objects.filter(
-                            loan__borrower=borrower, date=day
-                        )
-                        if repayment.reconciliation_id
-                    ]
+            for line in lines_by_cell.get((borrower.pk, day), []):
+                repayment += (
+                    line.principal + line.fee + line.interest + line.penalty
                 )
-                # For old data when reconciliation process was not there
-                if transferd == 0:
-                    # It's working only if payment using pay-with-wave money for collection sheet
-                    transferd = sum(
-                        [
-                            repayment.amount
-                            for repayment in Repayment.objects.filter(
-                                loan__borrower=borrower, date=day
-                            )
-                            if repayment.superuser_to_lender_payment.transfer.transfer_successful
-                        ]
-                    )
-            except Exception as e:
-                transferd = 0
+                subscription += line.subscription
+                principal += line.principal
+                fee += line.fee
+                interest += line.interest
+                penalty += line.penalty
+
+            transferd = _transferred_amount(day_repayments)
 
             repayments.append(
                 (
@@ -185,32 +219,33 @@ def get_collection_sheet_context(first_day, agent_pk, num_days, show_paid):
             daily_totals[idx][2] += transferd
             daily_totals[idx][3] += subscription
 
-        try:
-            contract_number = borrower.get_current_loan_at(first_day).contract_number
-        except AttributeError:
-            contract_number = None
+        current_loan = current_loans.get(borrower.pk)
         row = {
             "borrower": borrower,
-            "contract_number": contract_number,
+            "contract_number": current_loan.contract_number if current_loan is not None else None,
             "repayments": repayments,
         }
         collection_list.append(row)
 
+    # all wave money sms received over the period, grouped by (local) day
+    sms_by_day = {}
+    sms_queryset = (
+        WaveMoneyReceiveSMS.objects.filter(sent_at__date__gte=first_day, sent_at__date__lt=last_day)
+        .annotate(sent_date=TruncDate("sent_at"))
+        .order_by("sent_at")
+    )
+    for sms in sms_queryset:
+        sms_by_day.setdefault(sms.sent_date, []).append(sms)
+
     # total money sent by agent via wave money
     wave_totals = [0] * num_days
     for idx, day in enumerate(date_range):
         if agent is not None:
-            wave = (
-                WaveMoneyReceiveSMS.objects.filter(
-                    sender=agent.wave_money_number, sent_at__date=day
-                ).aggregate(Sum("amount"))["amount__sum"] or 0
-            )
+            wave = sum(
+                sms.amount for sms in sms_by_day.get(day, []) if sms.sender == agent.wave_money_number
+            ) or 0
         else:
-            wave = (
-                WaveMoneyReceiveSMS.objects.filter(sent_at__date=day).aggregate(
-                    Sum("amount")
-                )["amount__sum"] or 0
-            )
+            wave = sum(sms.amount for sms in sms_by_day.get(day, [])) or 0
         wave_totals[idx] = wave
 
     # build a list of dates in burmese as the translation doesn't seem to work
@@ -235,34 +270,36 @@ def get_collection_sheet_context(first_day, agent_pk, num_days, show_paid):
         burmese_dates.append(bd)
 
     # superuser to lender transactions
-    su_wave_numbers = Agent.objects.exclude(wave_money_number="").values_list(
-        "wave_money_number", flat=True
+    su_wave_numbers = set(
+        Agent.objects.exclude(wave_money_number="").values_list("wave_money_number", flat=True)
+    )
+    su2lender_queryset = (
+        SuperUsertoLenderPayment.objects.filter(
+            transfer__timestamp__date__gte=first_day,
+            transfer__timestamp__date__lt=last_day,
+            transfer__transfer_successful=True,
+        )
+        .exclude(transfer__method=TRANSFER_METHOD_WAVE_TO_WAVE)
+        .annotate(transfer_date=TruncDate("transfer__timestamp"))
+        .select_related("transfer", "super_user")
+        .order_by("transfer__timestamp")
     )
+    if agent_pk is not None:
+        su2lender_queryset = su2lender_queryset.filter(super_user=agent)
+    pay_with_wave_by_day = {}
+    for su2lender in su2lender_queryset:
+        pay_with_wave_by_day.setdefault(su2lender.transfer_date, []).append(su2lender)
+
     transactions = []
     total_transactions = 0
     for day in date_range:
         # select known transactions
-        via_wave_to_wave = WaveMoneyReceiveSMS.objects.filter(
-            sent_at__date=day, sender__in=su_wave_numbers
-        ).order_by("sent_at")
-        via_pay_with_wave = (
-            SuperUsertoLenderPayment.objects.filter(
-                transfer__timestamp__date=day, transfer__transfer_successful=True
-            )
-            .exclude(transfer__method=TRANSFER_METHOD_WAVE_TO_WAVE)
-            .order_by("transfer__timestamp")
-        )
+        via_wave_to_wave = [sms for sms in sms_by_day.get(day, []) if sms.sender in su_wave_numbers]
+        via_pay_with_wave = pay_with_wave_by_day.get(day, [])
         if agent_pk is not None:
-            via_wave_to_wave = via_wave_to_wave.filter(sender=agent.wave_money_number)
-            via_pay_with_wave = via_pay_with_wave.filter(super_user=agent)
-        total_wave_to_wave = (
-            via_wave_to_wave.aggregate(Sum("amount"))["amount__sum"] or 0
-        )
-        total_pay_with_wave = (
-            via_pay_with_wave.aggregate(Sum("transfer__amount"))[
-                "transfer__amount__sum"
-            ] or 0
-        )
+            via_wave_to_wave = [sms for sms in via_wave_to_wave if sms.sender == agent.wave_money_number]
+        total_wave_to_wave = sum(sms.amount for sms in via_wave_to_wave) or 0
+        total_pay_with_wave = sum(su2lender.transfer.amount for su2lender in via_pay_with_wave) or 0
         total = total_wave_to_wave + total_pay_with_wave
         total_transactions += total
         data_per_day = {
@@ -281,14 +318,8 @@ def get_collection_sheet_context(first_day, agent_pk, num_days, show_paid):
     total_unknown_transactions = 0
     for day in date_range:
         # select known transactions
-        via_wave_to_wave = (
-            WaveMoneyReceiveSMS.objects.filter(sent_at__date=day)
-            .exclude(sender__in=su_wave_numbers)
-            .order_by("sent_at")
-        )
-        total_wave_to_wave = (
-            via_wave_to_wave.aggregate(Sum("amount"))["amount__sum"] or 0
-        )
+        via_wave_to_wave = [sms for sms in sms_by_day.get(day, []) if sms.sender not in su_wave_numbers]
+        total_wave_to_wave = sum(sms.amount for sms in via_wave_to_wave) or 0
         total = total_wave_to_wave
         total_unknown_transactions += total
         data_per_day = {
@@ -351,8 +382,10 @@ class CollectionSheetView(LoginRequiredMixin, View):
         return output
 
 
-class CollectionSheetPDFView(LoginRequiredMixin, PDFTemplateView):
-    filename = "collection_sheet.pdf"
+class CollectionSheetPDFView(LoginRequiredMixin, View):
+    """
+    The collection sheet as a PDF, rendered in the background (see loans.pdf)
+    """
     template_name = "loans/collection_report.html"
     cmd_options = {
         "javascript-delay": 500,
@@ -363,17 +396,11 @@ class CollectionSheetPDFView(LoginRequiredMixin, PDFTemplateView):
         first_day, agent_pk, num_days, show_paid = clean_collection_report_arguments(
             request
         )
-        self.filename = (
+        filename = (
             "collection_sheet_" + str(agent_pk) + "_" + str(first_day) + ".pdf"
         )
-        context = self.get_context_data(**kwargs)
-        # merge the 2 dictionaries in a single one. requires python 3.5
-        # see https://treyhunner.com/2016/02/how-to-merge-dictionaries-in-python/
-        context = {
-            **context,
-            **get_collection_sheet_context(first_day, agent_pk, num_days, show_paid),
-        }
-        return self.render_to_response(context)
+        context = get_collection_sheet_context(first_day, agent_pk, num_days, show_paid)
+        return pdf_response(request, self.template_name, context, filename, self.cmd_options)
 
 
 # TODO: add csrf handling here, this is not super safe
@@ -382,6 +409,7 @@ def register_payment(request):
     """
     Super simple form used to record a repayment when clicking the "pay" link in the
     repayment sheet (request comes as AJAX)
+    An optional idempotency_key avoids recording the payment twice if the request is sent again.
     """
     if request.method == "POST":
         try:
@@ -391,7 +419,10 @@ def register_payment(request):
             day = [int(x) for x in request.POST.get("date").split("-")]
             r.date = d(day[0], day[1], day[2])
             r.recorded_by = request.user
-            r.save()
+            r.idempotency_key = request.POST.get("idempotency_key") or None
+            [(r, error)] = record_repayments(r.loan, [r])
+            if error is not None and error != "duplicate":
+                raise error
         except Exception as e:
             logger = logging.getLogger("root")
             logger.error(
@@ -505,6 +536,27 @@ class DisbursementForm(ModelForm):
         }
 
 
+def loan_sheet_rows(loans):
+    """
+    return the rows of the request and disburse sheets for the `loans` queryset:
+    the agent, borrower and latest PhotoSignature of each loan, in a fixed number of queries
+    """
+    latest_signature = PhotoSignature.objects.filter(loan=OuterRef("pk")).order_by("-timestamp").values("pk")[:1]
+    loans = list(loans.select_related("borrower__agent").annotate(latest_signature_id=Subquery(latest_signature)))
+    signatures = PhotoSignature.objects.in_bulk(
+        [ln.latest_signature_id for ln in loans if ln.latest_signature_id is not None]
+    )
+    return [
+        {
+            "agent": ln.borrower.agent,
+            "borrower": ln.borrower,
+            "loan": ln,
+            "signature": signatures.get(ln.latest_signature_id),
+        }
+        for ln in loans
+    ]
+
+
 @login_required
 def request_sheet(request):
     if request.method == "GET":
@@ -539,22 +591,7 @@ def request_sheet(request):
         )
 
         # extracting necessary data from each loan
-        collection_list = []
-        for loan_request in loan_request_queryset:
-
-            signatures = PhotoSignature.objects.filter(loan=loan_request)
-            if signatures.exists():
-                signature = signatures.latest("timestamp")
-            else:
-                signature = None
-
-            row = {
-                "agent": loan_request.borrower.agent,
-                "borrower": loan_request.borrower,
-                "loan": loan_request,
-                "signature": signature,
-            }
-            collection_list.append(row)
+        collection_list = loan_sheet_rows(loan_request_queryset)
 
         context = {
             "collection_list": collection_list,
@@ -595,21 +632,9 @@ def disburse_sheet(request):
 
         # extracting necessary data from each loan
         collection_dict = {}
-        for loan_request in loan_request_queryset:
-            try:
-                signature = PhotoSignature.objects.get(loan=loan_request)
-            except PhotoSignature.DoesNotExist:
-                signature = None
-
-            row = {
-                "agent": loan_request.borrower.agent,
-                "borrower": loan_request.borrower,
-                "loan": loan_request,
-                "signature": signature,
-            }
-
+        for row in loan_sheet_rows(loan_request_queryset.select_related("disbursement")):
             # group by agent
-            agent = loan_request.borrower.agent.name
+            agent = row["agent"].name
             if agent not in collection_dict:
                 collection_dict[agent] = [row]
             else:
@@ -623,17 +648,21 @@ def disburse_sheet(request):
         return render(request, "loans/disburse_sheet.html", context)
 
 
+def outstanding_loans_queryset():
+    """the loans of the outstanding loans report (and its export), annotated with their outstanding"""
+    return (
+        Loan.objects.filter(state="disbursed")
+        .annotate(actual_principal=Coalesce(Sum("repayments__principal"), 0))
+        .annotate(actual_fee=Coalesce(Sum("repayments__fee"), 0))
+        .annotate(outstanding=F("loan_amount") + F("loan_fee") - F("actual_principal") - F("actual_fee"))
+        .order_by(F("outstanding").desc())
+    )
+
+
 @login_required
 def outstanding_loans(request):
     if request.method == "GET":
-        qs = (
-            Loan.objects.filter(state="disbursed")
-            .annotate(actual_principal=Coalesce(Sum("repayments__principal"), 0))
-            .annotate(actual_fee=Coalesce(Sum("repayments__fee"), 0))
-            .annotate(outstanding=F("loan_amount") + F("loan_fee") - F("actual_principal") - F("actual_fee"))
-            .order_by(F("outstanding").desc())
-            .select_related("borrower")
-        )
+        qs = outstanding_loans_queryset().select_related("borrower")
         # select_related is to make rendering faster
         total_outstanding = qs.aggregate(tot=Sum("outstanding"))["tot"]
 
@@ -649,48 +678,138 @@ def outstanding_loans(request):
         return render(request, "loans/outstanding_loans.html", context)
 
 
+def clean_late_loans_arguments(request):
+    """
+    return the PortfolioAtRisk filters of the late loans report (and its export) from the GET parameters,
+    eg: url/?start_date=01/31/2019&end_date=02/28/2019&agent=2&branch=1
+    """
+    from datetime import datetime
+    start_date = request.GET.get("start_date")
+    end_date = request.GET.get("end_date")
+    s_date = e_date = None
+    if start_date:
+        s_date = datetime.strptime(start_date, '%m/%d/%Y').date()
+        if end_date:
+            e_date = datetime.strptime(end_date, '%m/%d/%Y').date()
+
+    # optional filters, eg: url/?agent=2&branch=1
+    try:
+        agent = Agent.objects.get(pk=request.GET.get("agent"))
+    except (Agent.DoesNotExist, ValueError):
+        agent = None
+    try:
+        mfi_branch = MFIBranch.objects.get(pk=request.GET.get("branch"))
+    except (MFIBranch.DoesNotExist, ValueError):
+        mfi_branch = None
+    return dict(agent=agent, mfi_branch=mfi_branch, start_date=s_date, end_date=e_date)
+
+
 @login_required
 def late_loans(request):
     if request.method == "GET":
-        from datetime import datetime
-        start_date = request.GET.get("start_date")
-        end_date = request.GET.get("end_date")
-        if start_date and end_date:
-            s_date = datetime.strptime(start_date, '%m/%d/%Y').strftime('%Y-%m-%d')
-            e_date = datetime.strptime(end_date, '%m/%d/%Y').strftime('%Y-%m-%d')
-            loans = Loan.objects.filter(repaid_on=None, contract_date__gte=s_date, contract_date__lte=e_date).filter(state="disbursed")
-        elif start_date and (end_date is None):
-            s_date = datetime.strptime(start_date, '%m/%d/%Y').strftime('%Y-%m-%d')
-            loans = Loan.objects.filter(repaid_on=None, contract_date__gte=s_date).filter(state="disbursed")
-        else:
-            loans = Loan.objects.filter(repaid_on=None).filter(state="disbursed")
-        late_loans = [
-            {"obj": l, "total_days_late": l.current_delay_at(d.today())} for l in loans
-        ]
-        late_loans = [l for l in late_loans if l["total_days_late"] > 0]
-        late_loans.sort(key=lambda x: x["total_days_late"])
-
-        total_outstanding = 0
-        for l in late_loans:
-            if l["total_days_late"] <= 30:
-                l["par_category"] = "PAR 1-30"
-            elif l["total_days_late"] <= 60:
-                l["par_category"] = "PAR 31-60"
-            elif l["total_days_late"] <= 90:
-                l["par_category"] = "PAR 61-90"
-            else:
-                l["par_category"] = "PAR >90"
-
-            total_outstanding += l["obj"].total_outstanding
+        par = PortfolioAtRisk(**clean_late_loans_arguments(request))
 
         context = {
-            "late_loans": late_loans,
+            "late_loans": par.rows,
+            "par_buckets": par.buckets,
             "current_date": d.today(),
-            "total_outstanding": total_outstanding,
+            "total_outstanding": par.total_outstanding_at_risk,
         }
         return render(request, "loans/late_loans.html", context)
 
 
+class Echo(object):
+    """
+    A file-like object that returns what is written to it instead of storing it,
+    to feed csv.writer rows to a StreamingHttpResponse one at a time.
+    See https://docs.djangoproject.com/en/2.2/howto/outputting-csv/#streaming-large-csv-files
+    """
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(filename, header, rows):
+    """
+    return a StreamingHttpResponse writing `header` then each of the `rows` (iterable of tuples) as CSV,
+    without holding them in memory
+    """
+    writer = csv.writer(Echo())
+    response = StreamingHttpResponse(
+        (writer.writerow(row) for row in itertools.chain([header], rows)),
+        content_type="text/csv",
+    )
+    response["Content-Disposition"] = 'attachment; filename="{}"'.format(filename)
+    return response
+
+
+@login_required
+def export_outstanding_loans(request):
+    """CSV export of the outstanding loans report"""
+    fields = ("contract_number", "borrower__agent__name", "borrower__name_en", "borrower__name_mm",
+              "contract_date", "loan_amount", "loan_fee", "actual_principal", "actual_fee", "outstanding")
+    rows = outstanding_loans_queryset().values_list(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    return stream_csv("outstanding-loans-{}.csv".format(d.today()), fields, rows)
+
+
+@login_required
+def export_late_loans(request):
+    """CSV export of the late loans report, with the same filters"""
+    fields = ("contract_number", "borrower__agent__name", "borrower__name_en", "borrower__name_mm",
+              "uploaded_at", "loan_amount", "comments")
+    columns = fields + ("is_subscription", "total_outstanding", "total_days_late", "latest_repayment_date",
+                        "par_category")
+    par = PortfolioAtRisk(**clean_late_loans_arguments(request))
+    rows = (
+        tuple(row[c] for c in columns)
+        for row in par.iter_values(fields, chunk_size=EXPORT_CHUNK_SIZE)
+    )
+    return stream_csv("late-loans-{}.csv".format(d.today()), columns, rows)
+
+
+@login_required
+def export_repayments(request):
+    """
+    CSV export of the repayments, eg: url/?start_date=01/31/2019&end_date=02/28/2019&agent=2&branch=1
+    (same filters as the late loans report, the dates apply to the repayment date)
+    """
+    filters = clean_late_loans_arguments(request)
+    repayments = Repayment.objects.order_by("date", "pk")
+    if filters["agent"] is not None:
+        repayments = repayments.filter(loan__borrower__agent=filters["agent"])
+    if filters["mfi_branch"] is not None:
+        repayments = repayments.filter(loan__borrower__agent__field_officer__mfi_branch=filters["mfi_branch"])
+    if filters["start_date"] is not None:
+        repayments = repayments.filter(date__gte=filters["start_date"])
+    if filters["end_date"] is not None:
+        repayments = repayments.filter(date__lte=filters["end_date"])
+    fields = ("pk", "date", "loan__contract_number", "loan__borrower__agent__name", "loan__borrower__name_en",
+              "amount", "principal", "fee", "interest", "penalty", "subscription", "reconciliation_status",
+              "recorded_at", "recorded_by__username")
+    rows = repayments.values_list(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    return stream_csv("repayments-{}.csv".format(d.today()), fields, rows)
+
+
+@login_required
+def export_reconciliation(request):
+    """
+    CSV export of the repayments of the reconciliation report, with their reconciliation,
+    same parameters as the report (date, agent, days)
+    """
+    first_day, agent_pk, num_days, show_paid = clean_collection_report_arguments(request)
+    repayments = Repayment.objects.filter(
+        date__gte=first_day, date__lt=first_day + timedelta(days=num_days)
+    ).order_by("date", "pk")
+    if agent_pk:
+        repayments = repayments.filter(loan__borrower__agent__pk=agent_pk)
+    fields = ("pk", "date", "loan__contract_number", "loan__borrower__agent__name", "loan__borrower__name_en",
+              "amount", "reconciliation_status", "reconciliation", "reconciliation__reconciled_at",
+              "reconciliation__reconciled_by__username", "superuser_to_lender_payment",
+              "superuser_to_lender_payment__transfer__timestamp")
+    rows = repayments.values_list(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    return stream_csv("reconciliation-{}.csv".format(first_day), fields, rows)
+
+
 @login_required
 def signed_loan_requests_for_disbursement_sheet(request):
     if request.method == "GET":
@@ -775,10 +894,11 @@ def collection_report2(request):
 
 
 def get_contract_lines(pk):
-    loan = Loan.objects.get(pk=pk)
-    lines = loan.lines.all().order_by("date")
+    loan = Loan.objects.select_related("borrower").get(pk=pk)
+    # a list, indexing a queryset runs one query per index
+    lines = list(loan.lines.all().order_by("date"))
 
-    mid_list = int(lines.count() / 2) + 1
+    mid_list = int(len(lines) / 2) + 1
     display_lines = []
     for line in range(mid_list):
         left_part = (
@@ -815,19 +935,84 @@ class PrintLoanContractView(LoginRequiredMixin, View):
         return render(request, "loans/print_contract.html", get_contract_lines(pk))
 
 
-class PrintLoanContractPDFView(LoginRequiredMixin, PDFTemplateView):
-    filename = "loan_contract.pdf"
+class PrintLoanContractPDFView(LoginRequiredMixin, View):
+    """
+    The contract as a PDF, rendered in the background (see loans.pdf)
+    """
     template_name = "loans/print_contract.html"
     cmd_options = {
         "javascript-delay": 500,
     }
 
-    def get_context_data(self, **kwargs):
-        self.filename = "loan_contract_" + str(kwargs["pk"]) + ".pdf"
-        context = super(PrintLoanContractPDFView, self).get_context_data(**kwargs)
-        # merge the 2 dictionaries in a single one. requires python 3.5
-        # see https://treyhunner.com/2016/02/how-to-merge-dictionaries-in-python/
-        return {**context, **get_contract_lines(kwargs["pk"])}
+    def get(self, request, pk):
+        filename = "loan_contract_" + str(pk) + ".pdf"
+        return pdf_response(request, self.template_name, get_contract_lines(pk), filename, self.cmd_options)
+
+
+@login_required
+def print_batch(request):
+    """
+    One PDF with many documents, eg:
+    - url/?loans=12,13,14 the contracts of these loans
+    - url/?disbursement=5 the contracts of the loans of a disbursement
+    - url/?branch=2&date=2016-10-30&days=7 the collection sheets of all the agents of a branch
+      (date, days and show_paid as for the collection sheet)
+    The documents already printed are reused, see pdf.batch_pdf_response
+    """
+    documents = []
+    if request.GET.get("branch"):
+        try:
+            branch_pk = int(request.GET.get("branch"))
+        except ValueError:
+            return JsonResponse({"detail": "branch must be an id, eg: ?branch=2"}, status=400)
+        first_day, agent_pk, num_days, show_paid = clean_collection_report_arguments(request)
+        agents = Agent.objects.filter(field_officer__mfi_branch__pk=branch_pk).order_by("pk")
+        for agent in agents:
+            documents.append((
+                CollectionSheetPDFView.template_name,
+                get_collection_sheet_context(first_day, agent.pk, num_days, show_paid),
+                "collection_sheet_" + str(agent.pk) + "_" + str(first_day) + ".pdf",
+                CollectionSheetPDFView.cmd_options,
+            ))
+        filename = "collection_sheets_branch_" + str(branch_pk) + "_" + str(first_day) + ".pdf"
+    else:
+        if request.GET.get("disbursement"):
+            try:
+                disbursement_pk = int(request.GET.get("disbursement"))
+            except ValueError:
+                return JsonResponse({"detail": "disbursement must be an id, eg: ?disbursement=5"}, status=400)
+            loans = Loan.objects.filter(disbursement__pk=disbursement_pk)
+            filename = "loan_contracts_disbursement_" + str(disbursement_pk) + ".pdf"
+        else:
+            try:
+                loan_ids = [int(pk) for pk in request.GET.get("loans", "").split(",")]
+            except ValueError:
+                return JsonResponse({"detail": "loans must be a list of ids, eg: ?loans=1,2,3"}, status=400)
+            loans = Loan.objects.filter(pk__in=loan_ids)
+            filename = "loan_contracts.pdf"
+        for pk in loans.order_by("pk").values_list("pk", flat=True):
+            documents.append((
+                PrintLoanContractPDFView.template_name,
+                get_contract_lines(pk),
+                "loan_contract_" + str(pk) + ".pdf",
+                PrintLoanContractPDFView.cmd_options,
+            ))
+
+    if not documents:
+        return JsonResponse({"detail": "nothing to print"}, status=404)
+    return batch_pdf_response(request, documents, filename)
+
+
+@login_required
+def pdf_status(request, key):
+    """
+    polled by the page returned while a PDF is rendered: {"state": ..., "url": <the file, once done>}
+    """
+    pdf = get_object_or_404(PDFRender, key=key)
+    data = {"state": pdf.state}
+    if pdf.state == PDF_RENDER_DONE:
+        data["url"] = pdf.file.url
+    return JsonResponse(data)
 
 
 @csrf_exempt
@@ -855,30 +1040,8 @@ def create_renewal_contract(request, pk):
             loan.calculate_loan_fee()
             loan.save()
 
-            no_of_lines = Loan.get_number_of_repayments(
-                loan.loan_amount,
-                loan.normal_repayment_amount,
-                loan.bullet_repayment_amount,
-            )
-
-            for line_no in range(no_of_lines):
-                line = RepaymentScheduleLine()
-                line.loan = loan
-                line.date = start_date + timedelta(days=line_no + 1)
-                line.principal = (
-                    loan.bullet_repayment_amount
-                    if line_no == no_of_lines - 1
-                    else loan.normal_repayment_amount
-                )
-                line.fee = 0
-                line.save()
-            # for now, we collec the fee on disbursement day
-            fee_line = RepaymentScheduleLine()
-            fee_line.loan = loan
-            fee_line.date = start_date
-            fee_line.principal = 0
-            fee_line.fee = loan.loan_fee
-            fee_line.save()
+            # for now, we collect the fee on disbursement day
+            ScheduleGenerator(loan, start_date, fee_on_disbursement=True).save()
 
         except KeyError as e:
             # return JsonResponse({'error': 'Could not parse arguments'})
@@ -891,35 +1054,76 @@ def create_renewal_contract(request, pk):
         return JsonResponse({"error": "invalid request"})
 
 
-@login_required
-def backend_today_view(request):
-    if request.method == "GET":
-        # if no agent is selected, select all agent
-        try:
-            # select just one agent (eg: url/?agent=2)
-            agent_pk = request.GET.get("agent")
-            agent_list = [Agent.objects.get(pk=agent_pk)]
-        except Agent.DoesNotExist:
-            agent_list = list(Agent.objects.all())
+def get_agent_list(request):
+    """
+    the agents of the backend today views: one agent (eg: url/?agent=2), or all of them if none is selected
+    """
+    agents = Agent.objects.select_related("user")
+    try:
+        return [agents.get(pk=request.GET.get("agent"))]
+    except Agent.DoesNotExist:
+        return list(agents.all())
+
 
-        # collect data per agent
-        data = []
-        for agent in agent_list:
+def agents_today_rows(request, agents, use_cache=True):
+    """
+    return the TodayView rows of each of `agents` (a list of lists, in the same order), with the borrower and
+    loan ids replaced by the objects, loaded in bulk for all the agents.
+    The rows of an agent are cached for the day, under a key made of the number, versions and last pk of its loans.
+    Loan.version is bumped whenever a loan, its lines, repayments or signatures change, so the key changes with them.
+    Pass use_cache=False to recompute the rows of all the agents.
+    """
+    today = d.today()
+    fingerprints = {
+        row["borrower__agent"]: (row["loans"], row["versions"], row["last_loan"])
+        for row in Loan.objects.filter(borrower__agent__in=agents).values("borrower__agent").annotate(
+            loans=Count("pk"), versions=Sum("version"), last_loan=Max("pk")
+        )
+    }
+    keys = {
+        agent.pk: "backend_today:{}:{}:{}:{}:{}".format(agent.pk, today, *fingerprints.get(agent.pk, (0, 0, 0)))
+        for agent in agents
+    }
+    cached = cache.get_many(list(keys.values())) if use_cache else {}
+
+    data = []
+    computed = {}
+    for agent in agents:
+        key = keys[agent.pk]
+        if key in cached:
+            today_data = cached[key]
+        elif agent.user is None:
             # some agent have None user! Strange!
             today_data = []
-            if agent.user is not None:
-                # convert to Rest request
-                rest_req = Request(request)
-                rest_req.user = agent.user
-                response = TodayView().get(
-                    rest_req, backend_today_request="backend_today_request"
-                )
-                today_data = response.data["today"]
-                # replace borrower id with borrower and loan id with loan
-                for row in today_data:
-                    row["borrower"] = Borrower.objects.get(pk=row["borrower"])
-                    row["loan"] = Loan.objects.get(pk=row["loan"])
-            data.append(today_data)
+        else:
+            # convert to Rest request
+            rest_req = Request(request)
+            rest_req.user = agent.user
+            response = TodayView().get(
+                rest_req, backend_today_request="backend_today_request"
+            )
+            today_data = [dict(row) for row in response.data["today"]]
+            computed[key] = today_data
+        data.append(today_data)
+    if computed:
+        cache.set_many(computed, TODAY_CACHE_TIMEOUT)
+
+    # replace borrower id with borrower and loan id with loan
+    rows = [row for today_data in data for row in today_data]
+    borrowers = Borrower.objects.in_bulk(set(row["borrower"] for row in rows))
+    loans = Loan.objects.in_bulk(set(row["loan"] for row in rows))
+    return [
+        [dict(row, borrower=borrowers[row["borrower"]], loan=loans[row["loan"]]) for row in today_data]
+        for today_data in data
+    ]
+
+
+@login_required
+def backend_today_view(request):
+    if request.method == "GET":
+        agent_list = get_agent_list(request)
+        # url/?refresh=1 ignores the cached rows
+        data = agents_today_rows(request, agent_list, use_cache=not request.GET.get("refresh"))
 
         context = {
             "agent_list": agent_list,
@@ -933,33 +1137,10 @@ def backend_today_view(request):
 @login_required
 def backend_new_loan_reportview(request):
     if request.method == "GET":
-        # if no agent is selected, select all agent
-        try:
-            # select just one agent (eg: url/?agent=2)
-            agent_pk = request.GET.get("agent")
-            agent_list = [Agent.objects.get(pk=agent_pk)]
-            # agent_list = [Agent.objects.get(pk=40)]
-        except Agent.DoesNotExist:
-            agent_list = list(Agent.objects.all())
-
-        # collect data per agent
-        data = []
-        for agent in agent_list:
-            # some agent have None user! Strange!
-            today_data = []
-            if agent.user is not None:
-                # convert to Rest request
-                rest_req = Request(request)
-                rest_req.user = agent.user
-                response = TodayView().get(
-                    rest_req, backend_today_request="backend_today_request"
-                )
-                today_data = response.data["today"]
-                # replace borrower id with borrower and loan id with loan
-                for row in today_data:
-                    row["borrower"] = Borrower.objects.get(pk=row["borrower"])
-                    row["loan"] = Loan.objects.get(pk=row["loan"])
-            data.append(today_data)
+        agent_list = get_agent_list(request)
+        # url/?refresh=1 ignores the cached rows
+        data = agents_today_rows(request, agent_list, use_cache=not request.GET.get("refresh"))
+
         context = {
             "agent_list": agent_list,
             "today_list": data,
@@ -980,29 +1161,39 @@ def disbursement_report(request):
 
 @login_required
 def customer_retention_report(request):
-    borrower_list = Borrower.objects.all()
-    data = []
-    for borrower in borrower_list:
-        objects = Loan.objects.filter(
-            Q(state=LOAN_DISBURSED) | Q(state=LOAN_REPAID), borrower=borrower
-        ).order_by("-id")
-        loans = 0
-        subs = 0
-        for obj in objects:
-            if obj.is_subscription:
-                subs = subs + 1
-            else:
-                loans = loans + 1
-        loan = {
-            "borrower": borrower,
-            "number_of_loans": objects.count() if objects else 0,
-            "loans": loans,
-            "subs": subs,
-            "last_loan": objects[0].contract_date if objects else 0,
-        }
-        data.append(loan)
-
+    """
+    number of loans and subscriptions of each borrower, and the date of the last one,
+    computed in one query per page, eg: url/?page=2&agent=2&branch=1
+    A loan is a subscription if its lines have some subscription due.
+    """
+    contracted = Q(loans__state__in=[LOAN_DISBURSED, LOAN_REPAID])
+    subscription_lines = Q(loans__lines__subscription__gt=0) | Q(loans__lines__subscription__lt=0)
+    borrowers = Borrower.objects.annotate(
+        number_of_loans=Count("loans", filter=contracted, distinct=True),
+        subs=Count("loans", filter=contracted & subscription_lines, distinct=True),
+        last_loan=Max("loans__contract_date", filter=contracted),
+    ).annotate(
+        # "loans" would clash with the Borrower.loans relation
+        non_subs=F("number_of_loans") - F("subs"),
+    ).order_by("pk")
+
+    # optional filters, eg: url/?agent=2&branch=1, ignored if invalid
+    try:
+        borrowers = borrowers.filter(agent=Agent.objects.get(pk=request.GET.get("agent")))
+    except (Agent.DoesNotExist, ValueError):
+        pass
+    try:
+        mfi_branch = MFIBranch.objects.get(pk=request.GET.get("branch"))
+        borrowers = borrowers.filter(agent__field_officer__mfi_branch=mfi_branch)
+    except (MFIBranch.DoesNotExist, ValueError):
+        pass
+
+    page = Paginator(borrowers, RETENTION_REPORT_PAGE_SIZE).get_page(request.GET.get("page"))
+    # keep the filters in the pagination links
+    filters = request.GET.copy()
+    filters.pop("page", None)
     context = {
-        "all_subscriber": data,
+        "all_subscriber": page,
+        "filters": filters.urlencode(),
     }
     return render(request, "loans/customer_retention_report.html", context)